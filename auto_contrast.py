@@ -0,0 +1,71 @@
+"""Viewer limits from percentiles of a running histogram of frame subsamples"""
+
+import threading
+import numpy as np
+
+
+class AutoContrast(object):
+    """
+    Calling with a frame returns (low, high) at the *low* and *high*
+    percentiles of the pixel values. Only every n-th pixel in both directions
+    is looked at, about *samples* of them, and their histogram is averaged
+    with earlier frames: hist = (1 - smoothing) * hist + smoothing * new.
+    Limits therefore follow a change of illumination within a few frames
+    but do not flicker with noise.
+
+    The histogram has *bins* bins over a range taken from the first frame,
+    which is taken again after reset() or when more than 5 % of the pixels
+    fall outside of it (e.g. flat correction of the live view switched on).
+    """
+
+    def __init__(self, low=0.5, high=99.5, samples=2**14, bins=1024, smoothing=0.3):
+        self.low = low
+        self.high = high
+        self.samples = samples
+        self.bins = bins
+        self.smoothing = smoothing
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.hist = None
+        self.start = 0.0
+        self.width = 1.0
+
+    def subsample(self, frame):
+        step = max(int(np.sqrt(float(frame.size) / self.samples)), 1)
+        return frame[::step, ::step].ravel()
+
+    def _counts(self, sample):
+        if sample.dtype.kind == 'f':
+            sample = sample[np.isfinite(sample)]
+        if not sample.size:
+            return None
+        index = np.floor((sample - self.start) / self.width).astype(np.int64)
+        outside = np.count_nonzero((index < 0) | (index >= self.bins))
+        if self.hist is None or outside > 0.05 * sample.size:
+            lo, hi = float(sample.min()), float(sample.max())
+            margin = 0.1 * (hi - lo) if hi > lo else 1.0
+            self.start = lo - margin
+            self.width = (hi - lo + 2 * margin) / self.bins
+            self.hist = None
+            index = np.floor((sample - self.start) / self.width).astype(np.int64)
+        np.clip(index, 0, self.bins - 1, out=index)
+        return np.bincount(index, minlength=self.bins)
+
+    def __call__(self, frame):
+        with self.lock:
+            counts = self._counts(self.subsample(frame))
+            if counts is None:
+                return None
+            counts = counts.astype(np.float64)
+            if self.hist is None:
+                self.hist = counts
+            else:
+                self.hist *= 1.0 - self.smoothing
+                self.hist += self.smoothing * counts
+            cdf = np.cumsum(self.hist)
+            i_low, i_high = np.searchsorted(cdf, [cdf[-1] * self.low / 100.0,
+                                                  cdf[-1] * self.high / 100.0])
+            return (self.start + i_low * self.width,
+                    self.start + (i_high + 1) * self.width)
@@ -0,0 +1,225 @@
+"""
+Throughput benchmark of the acquisitions against the simulated beamline.
+Every mode runs in its own process through a real Concert Experiment
+with the writer and viewer consumers attached, results are printed as
+JSON lines (or written to a JSON file) to compare releases.
+
+    python benchmark.py --roi 2560x2160 --fps 100 --steps 1000 -o results.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from concert.coroutines.base import coroutine
+from concert.experiments.addons import Consumer
+from concert.quantities import q
+from concert.storage import DirectoryWalker
+from pco_timestamp import decode, STAMP_PIXELS
+from scans_concert import ConcertScanThread
+from simulation import SimBeamline
+
+# acquisition of ACQsetup and camera model it needs
+MODES = {
+    "tomo_softr": ("tomo_softr", "PCO Edge"),
+    "tomo_auto": ("tomo_auto", "PCO Edge"),
+    "tomo_ext": ("tomo_ext", "PCO Edge"),
+    "tomo_ext_dimax": ("tomo_ext_dimax", "PCO Dimax"),
+    "tomo_auto_dimax": ("tomo_auto_dimax", "PCO Dimax"),
+    "radio_timelaps": ("radio_timelaps", "PCO Edge"),
+    "flats": ("flats_softr", "PCO Edge"),
+    "darks": ("darks_softr", "PCO Edge"),
+}
+
+
+class LatencyProbe(object):
+    """
+    Consumer which decodes binary time stamps of the frames and records
+    the delay between the start of exposure and the arrival of the frame
+    """
+
+    def __init__(self, nframes):
+        self.stamps = np.zeros((max(nframes, 1), STAMP_PIXELS), dtype=np.uint16)
+        self.arrivals = np.zeros(max(nframes, 1))
+        self.count = 0
+
+    @coroutine
+    def __call__(self):
+        while True:
+            frame = yield
+            if self.count >= len(self.arrivals):
+                self.stamps = np.concatenate((self.stamps, np.zeros_like(self.stamps)))
+                self.arrivals = np.concatenate((self.arrivals,
+                                                np.zeros_like(self.arrivals)))
+            self.arrivals[self.count] = time.time()
+            self.stamps[self.count] = frame[0, :STAMP_PIXELS]
+            self.count += 1
+
+    def results(self):
+        counters, seconds = decode(self.stamps[:self.count])
+        arrivals = self.arrivals[:self.count]
+        # time stamps are local time of day
+        midnight = np.array([time.mktime(time.localtime(t)[:3] + (0, 0, 0, 0, 0, -1))
+                             for t in arrivals])
+        latency = (arrivals - midnight - seconds) * 1000.0
+        steps = np.diff(counters)
+        res = {"frames": int(self.count),
+               "dropped": int(np.sum(steps[steps > 1] - 1)) if steps.size else 0}
+        if self.count > 1 and arrivals[-1] > arrivals[0]:
+            res["fps_sustained"] = (self.count - 1) / (arrivals[-1] - arrivals[0])
+        if self.count:
+            res["latency_ms"] = {"mean": float(latency.mean()),
+                                 "p50": float(np.percentile(latency, 50)),
+                                 "p99": float(np.percentile(latency, 99)),
+                                 "max": float(latency.max())}
+        return res
+
+
+def bytes_in(directory):
+    total = 0
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def make_viewer(name):
+    if name == "pyplot":
+        from concert.ext.viewers import PyplotImageViewer
+        return PyplotImageViewer()
+    # consumes frames without showing them
+    @coroutine
+    def null_viewer():
+        while True:
+            yield
+    return null_viewer
+
+
+def run_mode(mode, args):
+    acq_name, model = MODES[mode]
+    log = logging.getLogger("benchmark")
+    width, height = [int(i) for i in args.roi.split("x")]
+    beamline = SimBeamline(model)
+    camera = beamline.camera
+    camera.roi_width = width * q.pixel
+    camera.roi_height = height * q.pixel
+    camera.frame_rate = args.fps / q.s
+    period = 1000.0 / args.fps
+    exp_time = min(args.exposure, period)
+    camera.exposure_time = exp_time * q.msec
+    camera.num_buffers = args.buffers
+    camera.timestamp_mode = camera.uca.enum_values.timestamp_mode.BINARY
+    if model == "PCO Dimax":
+        camera.storage_mode = camera.uca.enum_values.storage_mode.RECORDER
+        camera.record_mode = camera.uca.enum_values.record_mode.RING_BUFFER
+
+    concert_scan = ConcertScanThread(make_viewer(args.viewer), camera)
+    concert_scan.log = log
+    acq_setup = concert_scan.acq_setup
+    acq_setup.log = log
+    beamline.setup(concert_scan)
+    acq_setup.exp_time = exp_time
+    acq_setup.dead_time = period - exp_time
+    acq_setup.nsteps = args.steps
+    acq_setup.num_flats = args.steps
+    acq_setup.num_darks = args.steps
+    acq_setup.pipelined_softr = args.pipelined
+    acq_setup.fps = args.fps
+    acq_setup.start = 0.0
+    acq_setup.endp = False
+    if acq_name == "radio_timelaps":
+        acq_setup.units = q.s
+        acq_setup.range = 0.0
+    else:
+        acq_setup.range = args.range
+    acq_setup.calc_step()
+
+    root = tempfile.mkdtemp(prefix="ezconcert-bench-", dir=args.dir)
+    try:
+        concert_scan.walker = DirectoryWalker(
+            root=root, dsetname="frame_{:>06}.tif",
+            bytes_per_file=2**37 if args.bigtiff else 0)
+        acquisition = getattr(acq_setup, acq_name)
+        concert_scan.create_experiment([acquisition], "scan_{:>03}", False)
+        concert_scan.attach_writer(async=args.async_writer)
+        concert_scan.attach_viewer()
+        probe = LatencyProbe(args.steps)
+        Consumer(concert_scan.exp.acquisitions, probe)
+        t0 = time.time()
+        concert_scan.exp.run().join()
+        duration = time.time() - t0
+        written = bytes_in(root)
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    res = {"mode": mode, "camera": model, "roi": [width, height], "steps": args.steps,
+           "fps_requested": args.fps, "exposure_ms": exp_time,
+           "viewer": args.viewer, "async_writer": args.async_writer,
+           "duration_s": duration, "bytes_written": written,
+           "write_MBps": written / duration / 2**20 if duration > 0 else None,
+           # kB on Linux
+           "peak_rss_MB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+           "camera_lost": camera.lost}
+    res.update(probe.results())
+    return res
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("modes", nargs="*", default=sorted(MODES),
+                        help="acquisitions to run: {}".format(", ".join(sorted(MODES))))
+    parser.add_argument("--roi", default="2560x2160", help="WIDTHxHEIGHT")
+    parser.add_argument("--fps", type=float, default=100.0)
+    parser.add_argument("--exposure", type=float, default=5.0,
+                        help="exposure time [ms]")
+    parser.add_argument("--steps", type=int, default=500, help="frames per acquisition")
+    parser.add_argument("--range", type=float, default=180.0,
+                        help="angular range [deg]")
+    parser.add_argument("--buffers", type=int, default=100, help="libuca buffers")
+    parser.add_argument("--viewer", choices=["pyplot", "none"], default="pyplot")
+    parser.add_argument("--async-writer", action="store_true")
+    parser.add_argument("--bigtiff", action="store_true")
+    parser.add_argument("--pipelined", action="store_true",
+                        help="move during read-out in tomo_softr")
+    parser.add_argument("--dir", default=None, help="where to write the data")
+    parser.add_argument("--keep", action="store_true",
+                        help="do not delete written data")
+    parser.add_argument("-o", "--output", help="JSON file with results of all modes")
+    parser.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    for mode in args.modes:
+        if mode not in MODES:
+            sys.exit("Unknown mode {}".format(mode))
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    if args.single:
+        print(json.dumps(run_mode(args.modes[0], args)))
+        return
+    # own process for every mode, so that peak RSS belongs to one mode
+    options = [a for a in sys.argv[1:] if a not in args.modes]
+    results = []
+    for mode in args.modes:
+        out = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                       "--single", mode] + options)
+        res = json.loads(out.strip().splitlines()[-1])
+        results.append(res)
+        print(json.dumps(res))
+        sys.stdout.flush()
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
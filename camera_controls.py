@@ -1,5 +1,6 @@
 import atexit
 from random import choice
+import threading
 import time
 
 from PyQt5.QtCore import QThread, pyqtSignal, QObject, Qt
@@ -19,6 +20,12 @@ from matplotlib import pyplot as plt
 from concert.devices.cameras.base import CameraError
 from concert.storage import write_tiff
 from concert.writers import TiffWriter
+from queued_writer import QueuedTiffWriter
+from raw_stream import RawStreamWriter
+from direct_writer import DirectRawWriter
+from latest_frame import LatestFrame
+from auto_contrast import AutoContrast
+from frame_stats import FrameStatistics
 from concert.experiments.base import Acquisition, Experiment
 from time import sleep
 import os
@@ -61,6 +68,13 @@ class CameraControlsGroup(QGroupBox):
         self.bigtiff.setChecked(True)
         self.bpf = 2**37
         #self.bigtiff.stateChanged.connect(self.switch_bigtiff)
+        # stream into one memory-mapped raw file instead of tiffs
+        self.raw_stream = QCheckBox("Stream raw (memmap)")
+        self.raw_stream.setChecked(False)
+        self.lv_raw_writer = None
+        # raw file written with O_DIRECT, for streams and Dimax sequences
+        self.direct_io = QCheckBox("Raw with O_DIRECT")
+        self.direct_io.setChecked(False)
 
         self.live_off_button = QPushButton("LIVE OFF")
         self.live_off_button.setEnabled(False)
@@ -224,10 +238,39 @@ class CameraControlsGroup(QGroupBox):
         # TIMESTAMP
         self.time_stamp = QCheckBox("Add timestamp to camera frames")
         self.time_stamp.setChecked(False)
+        self.blank_time_stamp = QCheckBox("Blank timestamp pixels")
+        self.blank_time_stamp.setChecked(False)
+
+        # flat-field corrected live view with flats/darks of the last scan
+        self.ffc_preview = QCheckBox("Flat-corrected live view")
+        self.ffc_preview.setChecked(False)
+        # block-mean binning of previewed frames
+        self.preview_binning_label = QLabel()
+        self.preview_binning_label.setText("Preview binning")
+        self.preview_binning_entry = QComboBox()
+        self.preview_binning_entry.addItems(["auto", "1", "2", "4", "8"])
+        # viewer limits from percentiles of the frames instead of the entries
+        self.auto_contrast_live = QCheckBox("Auto contrast in live view")
+        self.auto_contrast_live.setChecked(False)
+        self.auto_contrast = AutoContrast()
+
+        # statistics of live view and scan frames
+        self.stats_roi_label = QLabel()
+        self.stats_roi_label.setText("Stats ROI x0,y0,w,h")
+        self.stats_roi_entry = QLineEdit()
+        self.stats_roi_entry.setPlaceholderText("full frame")
+        self.saturation_label = QLabel()
+        self.saturation_label.setText("Saturation warning [%]")
+        self.saturation_entry = QLineEdit()
+        self.saturation_entry.setText("0.1")
+        self.stats_label = QLabel()
+        self.stats_label.setText("Mean -, std -, min -, max -, saturated -")
+        self.frame_stats = FrameStatistics()
+        self.saturation_warned = False
 
         # Thread for live preview
         self.live_preview_thread = LivePreviewThread(
-            viewer=self.viewer, camera=self.camera)
+            viewer=self.viewer, camera=self.camera, stats=self.frame_stats)
         self.live_preview_thread.start()
 
         # Thread for live preview
@@ -240,7 +283,13 @@ class CameraControlsGroup(QGroupBox):
         self.roi_height_entry.editingFinished.connect(self.get_fps_max_estimate)
         # check that dead time is larger than readout time?
         self.readout_thread.readout_over_signal.connect(self.readout_over_func)
+        self.readout_thread.readout_progress_signal.connect(self.readout_progress_func)
         self.time_stamp.stateChanged.connect(self.set_time_stamp)
+        self.ffc_preview.stateChanged.connect(self.set_ffc_preview)
+        self.preview_binning_entry.currentIndexChanged.connect(self.set_preview_binning)
+        self.auto_contrast_live.stateChanged.connect(self.switch_auto_contrast_live)
+        self.stats_roi_entry.editingFinished.connect(self.set_stats_roi)
+        self.frame_stats.stats_signal.connect(self.show_frame_stats)
         self.trigger_entry.currentIndexChanged.connect(self.restrict_params_depending_on_trigger)
         #self.roi_height_entry.editingFinished.connect(self.roi_y0)
         #self.roi_width_entry.editingFinished.connect(self.roi_x0)
@@ -269,6 +318,7 @@ class CameraControlsGroup(QGroupBox):
         #layout.addWidget(self.connect_to_dummy_camera_button, 1, 2)
         layout.addWidget(self.ttl_scan, 1, 2)
         #layout.addWidget(self.bigtiff, 1, 3, Qt.AlignRight)
+        layout.addWidget(self.raw_stream, 1, 3)
 
         layout.addWidget(self.save_lv_sequence_button, 1, 4)
         layout.addWidget(self.abort_transfer_button, 1, 5)
@@ -312,6 +362,12 @@ class CameraControlsGroup(QGroupBox):
         layout.addWidget(self.sensor_pix_rate_entry, 5, 5)
 
         layout.addWidget(self.time_stamp, 6, 4)
+        layout.addWidget(self.ffc_preview, 6, 5)
+        layout.addWidget(self.blank_time_stamp, 7, 4)
+        layout.addWidget(self.direct_io, 7, 5)
+        layout.addWidget(self.preview_binning_label, 8, 4)
+        layout.addWidget(self.preview_binning_entry, 8, 5)
+        layout.addWidget(self.auto_contrast_live, 9, 4)
 
         #layout.addWidget(self.lv_session_info, 8, 4, 1, 2)
 
@@ -329,6 +385,12 @@ class CameraControlsGroup(QGroupBox):
         layout.addWidget(self.roi_x0_entry, 5, 3)
         layout.addWidget(self.roi_width_label, 6, 2)
         layout.addWidget(self.roi_width_entry, 6, 3)
+
+        layout.addWidget(self.stats_roi_label, 7, 0)
+        layout.addWidget(self.stats_roi_entry, 7, 1)
+        layout.addWidget(self.saturation_label, 7, 2)
+        layout.addWidget(self.saturation_entry, 7, 3)
+        layout.addWidget(self.stats_label, 8, 0, 1, 4)
         # layout.addWidget(self.sensor_hor_bin_label, 7, 2)
         # layout.addWidget(self.sensor_hor_bin_entry, 7, 3)
 
@@ -432,6 +494,11 @@ class CameraControlsGroup(QGroupBox):
         if self.camera.acquire_mode != self.camera.uca.enum_values.acquire_mode.AUTO:
             self.camera.acquire_mode = self.camera.uca.enum_values.acquire_mode.AUTO
         self.camera.timestamp_mode = self.camera.uca.enum_values.timestamp_mode.NONE
+        try:
+            bitdepth = int(self.camera.sensor_bitdepth)
+            self.frame_stats.saturation_level = 2 ** bitdepth - 1
+        except:
+            self.frame_stats.saturation_level = None
         # set default values
         self.exposure_entry.setText("{:.02f}".format(
             self.camera.exposure_time.magnitude*1000))
@@ -512,6 +579,67 @@ class CameraControlsGroup(QGroupBox):
         else:
             self.camera.timestamp_mode = self.camera.uca.enum_values.timestamp_mode.NONE
 
+    def set_ffc_preview(self):
+        self.live_preview_thread.ffc_correct = self.ffc_preview.isChecked()
+
+    def set_preview_binning(self):
+        # plain viewers without a preview transform show full frames
+        transform = getattr(self.viewer, 'transform', None)
+        if transform is not None:
+            transform.binning = self.preview_binning_entry.currentText()
+
+    def set_auto_contrast(self, on):
+        # plain viewers without a preview wrapper keep manual limits
+        if not hasattr(self.viewer, 'auto_contrast'):
+            return
+        if on:
+            self.auto_contrast.reset()
+            self.viewer.auto_contrast = self.auto_contrast
+        else:
+            self.viewer.auto_contrast = None
+            self.viewer.limits = [self.view_low, self.view_high]
+
+    def switch_auto_contrast_live(self):
+        if self.live_on:
+            self.set_auto_contrast(self.auto_contrast_live.isChecked())
+
+    def set_stats_roi(self):
+        text = self.stats_roi_entry.text().strip()
+        if not text:
+            self.frame_stats.roi = None
+            return
+        try:
+            roi = [int(v) for v in text.split(',')]
+            if len(roi) != 4 or min(roi) < 0 or roi[2] == 0 or roi[3] == 0:
+                raise ValueError
+        except ValueError:
+            self.stats_roi_entry.setText('')
+            self.frame_stats.roi = None
+            error_message('Stats ROI must be four non-negative integers '
+                          'x0,y0,width,height')
+            return
+        self.frame_stats.roi = roi
+
+    @property
+    def saturation_warning(self):
+        try:
+            return float(self.saturation_entry.text())
+        except:
+            self.saturation_entry.setText('0.1')
+            error_message('Saturation warning must be a number')
+            return 0.1
+
+    def show_frame_stats(self, stats):
+        percent = stats['saturated'] * 100
+        self.stats_label.setText(
+            "Mean {mean:.1f}, std {std:.1f}, min {min:.0f}, max {max:.0f}, "
+            "saturated {percent:.3f} %".format(percent=percent, **stats))
+        saturated = percent > self.saturation_warning
+        if saturated and not self.saturation_warned and self.log is not None:
+            self.log.warning("{:.3f} % of pixels are saturated".format(percent))
+        self.stats_label.setStyleSheet("color: red" if saturated else "")
+        self.saturation_warned = saturated
+
     def setROI(self):
         try:
             self.camera.roi_x0 = self.roi_x0 * q.pixels
@@ -532,7 +660,9 @@ class CameraControlsGroup(QGroupBox):
             if self.camera.trigger_source != self.camera.trigger_sources.AUTO:
                 self.camera.trigger_source = self.camera.trigger_sources.AUTO
         self.set_camera_params(buff=False)
+        self.set_auto_contrast(self.auto_contrast_live.isChecked())
         self.camera.start_recording()
+        self.live_preview_thread.latest.reset()
         self.live_preview_thread.live_on = True
         self.live_on = True
         self.lv_duration = time.time()
@@ -561,7 +691,18 @@ class CameraControlsGroup(QGroupBox):
             walker=self.lv_dirwalker,
             separate_scans=True,
             name_fmt="live_view_seq_{:>03}")
-        self.cons_writer = ImageWriter(self.lv_acquisitions, self.lv_dirwalker, async=True)
+        if self.direct_io.isChecked():
+            self.lv_raw_writer = DirectRawWriter(walker=self.lv_dirwalker)
+            self.lv_raw_writer.log = self.log
+            self.cons_writer = Consumer(self.lv_acquisitions, self.lv_raw_writer)
+        elif self.raw_stream.isChecked():
+            self.lv_raw_writer = RawStreamWriter(self.lv_dirwalker)
+            self.lv_raw_writer.log = self.log
+            self.cons_writer = Consumer(self.lv_acquisitions, self.lv_raw_writer)
+        else:
+            self.lv_raw_writer = None
+            self.cons_writer = ImageWriter(self.lv_acquisitions, self.lv_dirwalker,
+                                           async=True)
         self.cons_viewer = Consumer(self.lv_acquisitions, self.viewer)
         # self.log.info("Streaming lv sequence to disk")
         # self.ena_disa_buttons(False)
@@ -589,6 +730,10 @@ class CameraControlsGroup(QGroupBox):
                 yield self.camera.grab()
         except Exception as exp:
             self.log.error(exp)
+        finally:
+            # truncate raw file to the frames written
+            if self.lv_raw_writer is not None:
+                self.lv_raw_writer.close()
 
     def live_on_func_stream2disk(self):
         if self.stream_dir == None or self.lv_experiment is None:
@@ -602,6 +747,8 @@ class CameraControlsGroup(QGroupBox):
     def stop_and_delete_concert_exp_objects(self):
         try:
             self.lv_experiment.abort()
+            if self.lv_raw_writer is not None:
+                self.lv_raw_writer.close()
             self.lv_experiment = None
             self.lv_writer = None
             self.lv_dirwalker = None
@@ -627,6 +774,11 @@ class CameraControlsGroup(QGroupBox):
             # if self.camera_model_label.text() != 'Dummy camera':
             #    error_message("Cannot stop recording")
         self.lv_duration = time.time() - self.lv_duration
+        if self.live_preview_thread.grabbed:
+            thread = self.live_preview_thread
+            self.log.info("Live view grabbed {} frames, displayed {}, dropped {}"
+                          .format(thread.grabbed, thread.displayed, thread.dropped))
+            self.live_preview_thread.latest.reset()
         self.frames_in_last_lv_seq = 0.0
         self.live_off_button.setEnabled(False)
         self.live_on_button.setEnabled(True)
@@ -649,11 +801,15 @@ class CameraControlsGroup(QGroupBox):
         #    f += "/im-seq-00"
         self.last_dir = os.path.dirname(f)
         # setup Filewriter in readout thread
-        if self.bpf > 0:
+        self.readout_thread.direct = self.direct_io.isChecked()
+        if self.readout_thread.direct:
+            self.readout_thread.filename = f + '.raw'
+        elif self.bpf > 0:
             self.readout_thread.filename = f + '.tif'
         else:
-            self.readout_thread.filename = f + '{-:>04}.tif'
+            self.readout_thread.filename = f + '-{:>04}.tif'
         # Start readout
+        self.readout_thread.log = self.log
         self.readout_thread.readout_on = True
 
 
@@ -662,7 +818,12 @@ class CameraControlsGroup(QGroupBox):
         self.readout_thread.abort_transfer = True
         self.abort_transfer_button.setEnabled(False)
 
+    def readout_progress_func(self, frames_grabbed, queue_depth):
+        self.abort_transfer_button.setText(
+            "Abort transfer ({} read, {} queued)".format(frames_grabbed, queue_depth))
+
     def readout_over_func(self, frames_grabbed, time_s):
+        self.abort_transfer_button.setText("Abort transfer")
         info_message("Saved {0} images in {1} sec".
                      format(frames_grabbed, time_s))
         self.live_on_button.setEnabled(True)
@@ -738,6 +899,8 @@ class CameraControlsGroup(QGroupBox):
         self.save_one_image_button.setEnabled(val)
         self.live_on_button_stream2disk.setEnabled(val)
         self.live_on_stream_select_file_button.setEnabled(val)
+        self.raw_stream.setEnabled(val)
+        self.direct_io.setEnabled(val)
         self.live_on_button.setEnabled(val)
         if self.camera_model_label.text() == 'PCO Dimax':
             self.save_lv_sequence_button.setEnabled(val)
@@ -760,6 +923,7 @@ class CameraControlsGroup(QGroupBox):
             self.trigger_entry.setEnabled(val)
         self.sensor_hor_bin_entry.setEnabled(val)
         self.time_stamp.setEnabled(val)
+        self.blank_time_stamp.setEnabled(val)
         self.bigtiff.setEnabled(val)
 
     # getters/setters
@@ -1010,29 +1174,84 @@ class CameraControlsGroup(QGroupBox):
         self.readout_thread.bpf = self.bpf
 
 class LivePreviewThread(QThread):
-    def __init__(self, viewer, camera):
+    """
+    Grabs frames as fast as the camera delivers them so that its buffers
+    never fill up; a display thread shows the newest frame at most
+    *display_rate* times per second, frames in between are dropped
+    """
+    def __init__(self, viewer, camera, display_rate=20.0, stats=None):
         super(LivePreviewThread, self).__init__()
+        self.log = None
         self.viewer = viewer
         self.camera = camera
+        # FrameStatistics of the frames shown, before flat correction
+        self.stats = stats
         self.thread_running = True
         self.live_on = False
+        # averaged flats/darks from the scan thread
+        self.ffc = None
+        self.ffc_correct = False
+        self.display_rate = display_rate
+        self.latest = LatestFrame()
+        self.display_thread = threading.Thread(target=self.display)
+        self.display_thread.daemon = True
+        self.display_thread.start()
         atexit.register(self.stop)
 
+    # frames of the current live view
+    @property
+    def grabbed(self):
+        return self.latest.grabbed
+
+    @property
+    def displayed(self):
+        return self.latest.displayed
+
+    @property
+    def dropped(self):
+        return self.latest.dropped
+
     def stop(self):
         self.thread_running = False
         self.wait()
+        self.display_thread.join()
 
     def run(self):
         while self.thread_running:
             if self.live_on:
-                self.viewer.show(self.camera.grab())
-                time.sleep(0.05)
+                try:
+                    frame = self.camera.grab()
+                except Exception as exp:
+                    # e.g. recording stopped by live off while grab() waited,
+                    # the thread must survive for the next live view
+                    if self.live_on and self.log is not None:
+                        self.log.error("Live view cannot grab: {}".format(exp))
+                    time.sleep(0.1)
+                    continue
+                # a frame which arrives after live off is not shown
+                if self.live_on:
+                    self.latest.put(frame)
             else:
                 time.sleep(1)
 
+    def display(self):
+        while self.thread_running:
+            frame = self.latest.get(timeout=1.0)
+            if frame is None:
+                continue
+            t0 = time.time()
+            if self.stats is not None:
+                self.stats.put(frame, live=True)
+            if self.ffc_correct and self.ffc is not None and self.ffc.ready:
+                frame = self.ffc.correct(frame)
+            self.viewer.show(frame)
+            time.sleep(max(1.0 / self.display_rate - (time.time() - t0), 0))
+
 
 class ReadoutThread(QThread):
     readout_over_signal = pyqtSignal(int, int)
+    # frames grabbed so far, frames waiting in the writer queue
+    readout_progress_signal = pyqtSignal(int, int)
     def __init__(self, camera):
         super(ReadoutThread, self).__init__()
         self.camera = camera
@@ -1044,6 +1263,12 @@ class ReadoutThread(QThread):
         self.filename = None
         atexit.register(self.stop)
         self.bpf = 2**37
+        self.log = None
+        # file-per-frame writer threads and memory limit of the writer queue
+        self.num_writers = 4
+        self.queue_bytes = 2**31
+        # one raw file written with O_DIRECT instead of tiffs
+        self.direct = False
 
     def stop(self):
         self.thread_running = False
@@ -1057,17 +1282,36 @@ class ReadoutThread(QThread):
                 tmp = time.time()
                 self.abort_transfer = False
                 self.camera.uca.start_readout()
-                wrtr = TiffWriter(self.filename, bytes_per_file=self.bpf)
+                if self.direct:
+                    wrtr = DirectRawWriter(self.filename)
+                else:
+                    wrtr = QueuedTiffWriter(self.filename, bytes_per_file=self.bpf,
+                                            num_threads=self.num_writers,
+                                            max_bytes=self.queue_bytes)
+                wrtr.log = self.log
+                reported = tmp
                 while not self.abort_transfer and \
                         self.frames_grabbed_so_far < tot_frames:
                     try:
-                        wrtr.write(self.camera.grab())
+                        # blocks while the writer queue is full
+                        wrtr.put(self.camera.grab())
                         self.frames_grabbed_so_far += 1
                     except CameraError:
                         # No more frames
                         self.abort_transfer = True
+                    except Exception:
+                        # writer failed
+                        self.abort_transfer = True
+                    if time.time() - reported > 1.0:
+                        reported = time.time()
+                        self.readout_progress_signal.emit(self.frames_grabbed_so_far,
+                                                          wrtr.depth)
                 self.camera.uca.stop_readout()
                 wrtr.close()
+                if self.log is not None:
+                    self.log.info(
+                        "Read-out of {} frames, {} written, max writer queue {}".format(
+                            self.frames_grabbed_so_far, wrtr.written, wrtr.max_depth))
                 self.readout_over_signal.emit(self.frames_grabbed_so_far, int(time.time() - tmp))
                 self.readout_on = False
             else:
@@ -0,0 +1,143 @@
+"""SQLite catalog of the scans in an experiment directory"""
+
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+CATALOG = 'catalog.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scans (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    idx INTEGER,
+    finished REAL,
+    duration REAL,
+    outer_position REAL,
+    params TEXT
+);
+CREATE TABLE IF NOT EXISTS acquisitions (
+    scan_id INTEGER REFERENCES scans(id),
+    name TEXT,
+    frames INTEGER,
+    bytes INTEGER,
+    duration REAL,
+    fps REAL
+);
+"""
+
+
+def scan_index(name, name_fmt):
+    """Number of scan *name* made from pattern *name_fmt* like scan_{:>03}, None
+    if the name does not follow the pattern"""
+    prefix = name_fmt.split('{')[0]
+    suffix = name_fmt.split('}')[-1]
+    if not name.startswith(prefix) or not name.endswith(suffix):
+        return None
+    number = name[len(prefix):len(name) - len(suffix)]
+    if not number.isdigit():
+        return None
+    return int(number)
+
+
+def directory_size(path):
+    total = 0
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+class ScanCatalog(object):
+    """
+    catalog.sqlite in the root dir with one row per finished scan (name,
+    number, outer position, duration, YAML dump of the settings) and one
+    row per acquisition of the scan (frames, bytes, duration, achieved fps).
+    Connections are opened per call, so the catalog can be used from any
+    thread and read while a scan is running.
+    """
+
+    def __init__(self, root, fname=CATALOG):
+        self.root = root
+        self.path = os.path.join(root, fname)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30.0)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def add_scan(self, name, name_fmt, acquisitions, duration=None, outer_position=None,
+                 params=None):
+        """Add scan *name*; *acquisitions* is a list of dicts with keys name,
+        frames, duration, fps and optionally bytes"""
+        with self._connect() as conn:
+            cur = conn.execute(
+                "INSERT INTO scans "
+                "(name, idx, finished, duration, outer_position, params) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (name, scan_index(name, name_fmt), time.time(), duration,
+                 outer_position, params))
+            conn.executemany(
+                "INSERT INTO acquisitions "
+                "(scan_id, name, frames, bytes, duration, fps) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(cur.lastrowid, a['name'], a['frames'], a.get('bytes'), a['duration'],
+                  a['fps']) for a in acquisitions])
+
+    def record_scan(self, name, name_fmt, acquisitions, log=None, **kwargs):
+        """add_scan in a background thread, bytes of the acquisitions are
+        summed up from their 'directories' (where the writer put the frames)"""
+        def run():
+            try:
+                for acq in acquisitions:
+                    paths = [p for p in acq.get('directories', []) if os.path.exists(p)]
+                    if paths:
+                        acq['bytes'] = sum(directory_size(p) for p in paths)
+                self.add_scan(name, name_fmt, acquisitions, **kwargs)
+            except Exception as exp:
+                if log is not None:
+                    log.error(exp)
+                    log.error("Cannot add {} to scan catalog".format(name))
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def next_free_index(self, name_fmt):
+        """First scan number above all catalogued scans of *name_fmt*"""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT name FROM scans").fetchall()
+        numbers = [scan_index(row[0], name_fmt) for row in rows]
+        numbers = [n for n in numbers if n is not None]
+        return max(numbers) + 1 if numbers else 1
+
+    def summary(self, limit=None):
+        """Rows (name, acquisitions, frames, GB, duration [s], mean fps) of the
+        scans, newest last"""
+        query = ("SELECT s.name, group_concat(a.name, ' '), sum(a.frames), "
+                 "sum(a.bytes) / 1073741824.0, s.duration, avg(a.fps) "
+                 "FROM scans s LEFT JOIN acquisitions a ON a.scan_id = s.id "
+                 "GROUP BY s.id ORDER BY s.id")
+        with self._connect() as conn:
+            rows = conn.execute(query).fetchall()
+        if limit is not None:
+            rows = rows[-limit:]
+        return rows
+
+    def format_summary(self, limit=None):
+        lines = ["{:<16} {:<24} {:>8} {:>8} {:>9} {:>8}".format(
+            "Scan", "Acquisitions", "Frames", "GB", "Time [s]", "FPS")]
+        for row in self.summary(limit):
+            name, acqs, frames, gb, duration, fps = row
+            lines.append("{:<16} {:<24} {:>8} {:>8.2f} {:>9.1f} {:>8.1f}".format(
+                name, acqs or "", frames or 0, gb or 0.0, duration or 0.0, fps or 0.0))
+        return "\n".join(lines)
@@ -0,0 +1,196 @@
+"""Lossless compression of frames in a pool of threads before they hit the disk"""
+
+import io
+import json
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import threading
+import zlib
+from collections import deque
+from concert.coroutines.base import coroutine
+from concert.storage import DirectoryWalker
+from frame_pool import detach
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import blosc
+except ImportError:
+    blosc = None
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+
+# thread pools by number of threads, kept for the lifetime of the GUI
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def compression_pool(num_threads):
+    """Pool of *num_threads* threads shared by all walkers. Threads and not
+    processes: forking the GUI with its Qt and EPICS threads can deadlock,
+    and the codecs release the GIL while they compress."""
+    with _pools_lock:
+        if num_threads not in _pools:
+            _pools[num_threads] = ThreadPool(num_threads)
+        return _pools[num_threads]
+
+
+def available_codecs():
+    """Codecs which can be used here, tiff deflate first"""
+    codecs = []
+    if tifffile is not None:
+        codecs.append("tiff deflate")
+    codecs.append("zlib")
+    if zstandard is not None:
+        codecs.append("zstd")
+    if blosc is not None:
+        codecs.append("blosc")
+    return codecs
+
+
+def compress(frame, codec, level):
+    """Compressed bytes of *frame*, runs in the pool threads"""
+    if codec == "tiff deflate":
+        buf = io.BytesIO()
+        tifffile.imwrite(buf, frame, compression='zlib',
+                         compressionargs={'level': level})
+        return buf.getvalue()
+    if codec == "zlib":
+        return zlib.compress(frame.tobytes(), level)
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=level).compress(frame.tobytes())
+    if codec == "blosc":
+        return blosc.compress(frame.tobytes(), typesize=frame.dtype.itemsize,
+                              clevel=level)
+    raise ValueError("Unknown codec {}".format(codec))
+
+
+class CompressingWalker(DirectoryWalker):
+    """
+    DirectoryWalker which compresses every frame with *codec* in a pool of
+    *num_threads* threads (see compression_pool). Results are collected in
+    frame order by one writer thread, every frame is a separate file. With
+    "tiff deflate" the files are ordinary compressed tiffs, other codecs give
+    raw compressed buffers <dsetname>.<codec> described by compression.json
+    in the acquisition directory. At most *max_frames* frames are in flight, the
+    acquisition waits when the pool cannot keep up. Compression ratio is
+    logged every *report_every* frames.
+    """
+
+    def __init__(self, root, dsetname='frame_{:>06}.tif', codec='tiff deflate', level=6,
+                 num_threads=None, max_frames=64, report_every=500):
+        super(CompressingWalker, self).__init__(root=root, dsetname=dsetname)
+        if codec not in available_codecs():
+            raise ValueError("Codec {} is not available".format(codec))
+        if level is None:
+            raise ValueError("Compression level is not defined")
+        self.log = None
+        self.dsetname = dsetname
+        self.codec = codec
+        self.level = level
+        self.num_threads = num_threads or max(multiprocessing.cpu_count() - 1, 1)
+        self.max_frames = max_frames
+        self.report_every = report_every
+        self.pool = None
+        self.pending = deque()
+        self.slots = threading.Semaphore(max_frames)
+        self.cond = threading.Condition()
+        self.thread = None
+        self.running = False
+        self.error = None
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.written = 0
+
+    @property
+    def ratio(self):
+        if not self.compressed_bytes:
+            return 1.0
+        return float(self.raw_bytes) / self.compressed_bytes
+
+    def _start(self):
+        self.pool = compression_pool(self.num_threads)
+        self.running = True
+        self.thread = threading.Thread(target=self._collect)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _collect(self):
+        while True:
+            with self.cond:
+                while not self.pending and self.running:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+                fname, nbytes, result = self.pending.popleft()
+            try:
+                data = result.get()
+                with open(fname, 'wb') as f:
+                    f.write(data)
+                self.raw_bytes += nbytes
+                self.compressed_bytes += len(data)
+                self.written += 1
+                if self.log is not None and self.written % self.report_every == 0:
+                    self.log.info("Compression ratio {:.2f} after {} frames".format(
+                        self.ratio, self.written))
+            except Exception as exp:
+                if self.error is None and self.log is not None:
+                    self.log.error(exp)
+                    self.log.error("Compression failed, frames are being dropped")
+                self.error = exp
+            finally:
+                self.slots.release()
+
+    def write(self, data=None, dsetname=None):
+        coro = self._write_coroutine(self.current, dsetname or self.dsetname)
+        if data is None:
+            return coro
+        for frame in data:
+            coro.send(frame)
+
+    @coroutine
+    def _write_coroutine(self, directory, dsetname):
+        if self.codec != "tiff deflate":
+            dsetname = os.path.splitext(dsetname)[0] + '.' + self.codec
+        i = 0
+        while True:
+            frame = yield
+            if self.error is not None:
+                raise self.error
+            if self.pool is None:
+                self._start()
+            if i == 0 and self.codec != "tiff deflate":
+                meta = {'codec': self.codec, 'level': self.level,
+                        'dtype': frame.dtype.str, 'shape': list(frame.shape),
+                        'files': dsetname}
+                with open(os.path.join(directory, 'compression.json'), 'w') as f:
+                    json.dump(meta, f)
+            self.slots.acquire()
+            # compression starts later in a thread of the pool, by then a
+            # pooled frame may hold the pixels of a later one
+            result = self.pool.apply_async(compress,
+                                           (detach(frame), self.codec, self.level))
+            with self.cond:
+                self.pending.append((os.path.join(directory, dsetname.format(i)),
+                                     frame.nbytes, result))
+                self.cond.notify()
+            i += 1
+
+    def close(self):
+        """Wait until all frames are compressed and written"""
+        if self.pool is None:
+            return
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join()
+        # the shared pool stays for the next scan
+        self.pool = None
+        if self.log is not None and self.written:
+            self.log.info("Compressed {} frames, ratio {:.2f}".format(
+                self.written, self.ratio))
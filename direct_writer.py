@@ -0,0 +1,197 @@
+"""Raw frame streams written with O_DIRECT from page-aligned buffers"""
+
+import json
+import mmap
+import os
+import threading
+import time
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+import numpy as np
+from concert.coroutines.base import coroutine
+
+ALIGN = mmap.PAGESIZE
+
+
+def aligned_empty(nbytes, align=ALIGN):
+    """Byte array of *nbytes* whose data start on an *align* boundary"""
+    raw = np.empty(nbytes + align, dtype=np.uint8)
+    offset = (-raw.ctypes.data) % align
+    return raw[offset:offset + nbytes]
+
+
+def open_direct(path):
+    """File descriptor of *path* opened for writing with O_DIRECT if the
+    platform and the file system allow it and whether O_DIRECT is on"""
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    direct = getattr(os, 'O_DIRECT', 0)
+    if direct:
+        try:
+            return os.open(path, flags | direct, 0o644), True
+        except OSError:
+            # tmpfs and some network file systems refuse O_DIRECT
+            pass
+    return os.open(path, flags, 0o644), False
+
+
+class DirectRawWriter(object):
+    """
+    Appends frames to one raw file bypassing the page cache, so that a long
+    acquisition cannot fill RAM with dirty pages and stall the grabbing
+    thread once the kernel starts writeback. Frames are copied into
+    *num_buffers* page-aligned buffers of *chunk_bytes* which one thread
+    writes with O_DIRECT; put() blocks while all buffers wait for the disk.
+    Without O_DIRECT every chunk is followed by fdatasync to the same end.
+    close() pads the last chunk, truncates the file to the frames written
+    and writes the same JSON sidecar as RawStreamWriter.
+
+    The file is *filename*, or *fname* in the current directory of *walker*
+    when frames come through a Consumer (calling the object gives a coroutine).
+    """
+
+    def __init__(self, filename=None, walker=None, fname='frames.raw',
+                 chunk_bytes=2**26, num_buffers=4):
+        self.log = None
+        self.filename = filename
+        self.walker = walker
+        self.fname = fname
+        self.chunk_bytes = chunk_bytes - chunk_bytes % ALIGN
+        self.num_buffers = num_buffers
+        self.path = None
+        self.fd = None
+        self.direct = False
+        self.buffers = []
+        self.free = None
+        self.filled = None
+        self.thread = None
+        self.current = None
+        self.fill = 0
+        self.shape = None
+        self.dtype = None
+        self.count = 0
+        self.written = 0
+        self.max_depth = 0
+        self.stamps = []
+        self.error = None
+        self.lock = threading.Lock()
+
+    def _open(self, frame):
+        if self.filename is not None:
+            self.path = self.filename
+        else:
+            self.path = os.path.join(self.walker.current, self.fname)
+        self.fd, self.direct = open_direct(self.path)
+        if self.log is not None and not self.direct:
+            self.log.warning("O_DIRECT not available for {}, syncing every chunk"
+                             .format(self.path))
+        self.buffers = [aligned_empty(self.chunk_bytes)
+                        for i in range(self.num_buffers)]
+        self.free = Queue()
+        self.filled = Queue()
+        for i in range(self.num_buffers):
+            self.free.put(i)
+        self.thread = threading.Thread(target=self._write_chunks)
+        self.thread.daemon = True
+        self.thread.start()
+        self.current = self.free.get()
+        self.fill = 0
+        self.shape = frame.shape
+        self.dtype = frame.dtype
+        self.count = 0
+        self.written = 0
+        self.stamps = []
+
+    def _write_all(self, data):
+        """os.write until all of *data* is written, short writes happen e.g. on
+        a full disk or a signal. With O_DIRECT the rest stays aligned as long as
+        the kernel writes whole blocks, otherwise the next write fails."""
+        done = 0
+        while done < len(data):
+            count = os.write(self.fd, data[done:])
+            if count <= 0:
+                raise IOError("Short write to {} after {} of {} bytes".format(
+                    self.path, done, len(data)))
+            done += count
+
+    def _write_chunks(self):
+        while True:
+            item = self.filled.get()
+            if item is None:
+                return
+            index, nbytes = item
+            try:
+                if self.error is None:
+                    self._write_all(memoryview(self.buffers[index])[:nbytes])
+                    if not self.direct:
+                        os.fdatasync(self.fd)
+            except Exception as exp:
+                if self.log is not None:
+                    self.log.error(exp)
+                    self.log.error("Direct writer failed, frames are being dropped")
+                self.error = exp
+            finally:
+                self.free.put(index)
+
+    def _submit(self, nbytes):
+        self.filled.put((self.current, nbytes))
+        self.max_depth = max(self.max_depth, self.filled.qsize())
+        self.current = self.free.get()
+        self.fill = 0
+
+    @property
+    def depth(self):
+        return 0 if self.filled is None else self.filled.qsize()
+
+    def put(self, frame):
+        with self.lock:
+            if self.error is not None:
+                raise self.error
+            if self.fd is None:
+                self._open(frame)
+            data = np.ascontiguousarray(frame).view(np.uint8).ravel()
+            pos = 0
+            while pos < data.size:
+                n = min(data.size - pos, self.chunk_bytes - self.fill)
+                self.buffers[self.current][self.fill:self.fill + n] = data[pos:pos + n]
+                self.fill += n
+                pos += n
+                if self.fill == self.chunk_bytes:
+                    self._submit(self.fill)
+            self.stamps.append(time.time())
+            self.count += 1
+
+    @coroutine
+    def __call__(self):
+        self.close()
+        while True:
+            frame = yield
+            self.put(frame)
+
+    def close(self):
+        """Write the rest, truncate the file and write the sidecar"""
+        with self.lock:
+            if self.fd is None:
+                return
+            if self.fill:
+                # O_DIRECT needs whole blocks, the padding is cut off below
+                padded = self.fill + (-self.fill) % ALIGN
+                self.buffers[self.current][self.fill:padded] = 0
+                self.filled.put((self.current, padded))
+            self.filled.put(None)
+            self.thread.join()
+            if self.error is None:
+                self.written = self.count
+            nbytes = self.count * int(np.prod(self.shape)) * self.dtype.itemsize
+            os.ftruncate(self.fd, nbytes)
+            os.close(self.fd)
+            self.fd = None
+            self.buffers = []
+            meta = {'shape': list(self.shape), 'dtype': self.dtype.str,
+                    'count': self.count, 'timestamps': self.stamps}
+            with open(self.path + '.json', 'w') as f:
+                json.dump(meta, f)
+            if self.log is not None:
+                self.log.info("Direct writer closed: {} frames in {}".format(
+                    self.count, self.path))
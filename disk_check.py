@@ -0,0 +1,70 @@
+"""Measurement of sustained write speed of the output disk"""
+
+import os
+import threading
+import time
+import numpy as np
+
+# mount point -> (time of measurement, bytes/s)
+_speeds = {}
+# one measurement of a mount point at a time
+_lock = threading.Lock()
+
+
+def mount_point(path):
+    path = os.path.realpath(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def writable_dirs(paths):
+    """Those of *paths* which are directories we can write into"""
+    return [path for path in paths if path and os.path.isdir(path) and
+            os.access(path, os.W_OK)]
+
+
+def measure_write_speed(directory, max_bytes=2**29, max_time=2.0, block=2**23):
+    """Write random blocks into a temporary file in *directory* for at most
+    *max_time* seconds or *max_bytes* and return sustained speed in bytes/s,
+    fsync is included so that page cache does not hide the disk"""
+    fname = os.path.join(directory, ".write_test_{}".format(os.getpid()))
+    # random data, compressing file systems must not cheat
+    data = np.random.randint(0, 2**16, block // 2).astype(np.uint16).tobytes()
+    written = 0
+    fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        t0 = time.time()
+        while written < max_bytes and time.time() - t0 < max_time:
+            written += os.write(fd, data)
+        os.fsync(fd)
+        duration = time.time() - t0
+    finally:
+        os.close(fd)
+        os.remove(fname)
+    return written / duration
+
+
+def cached_write_speed(directory, max_age=3600.0):
+    """Write speed of the file system of *directory* if it was measured
+    less than *max_age* seconds ago, None otherwise; never blocks"""
+    measured = _speeds.get(mount_point(directory))
+    if measured is None or time.time() - measured[0] > max_age:
+        return None
+    return measured[1]
+
+
+def write_speed(directory, max_age=3600.0):
+    """Sustained write speed of the file system of *directory*,
+    measured once per mount point and *max_age* seconds. Takes a few
+    seconds when a measurement is due, do not call it from the GUI thread"""
+    with _lock:
+        speed = cached_write_speed(directory, max_age)
+        if speed is None:
+            speed = measure_write_speed(directory)
+            _speeds[mount_point(directory)] = (time.time(), speed)
+        return speed
+
+
+def required_bandwidth(width, height, fps, bytes_per_pixel=2):
+    return width * height * bytes_per_pixel * fps
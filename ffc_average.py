@@ -0,0 +1,144 @@
+"""Averaged flats and darks computed while frames stream in"""
+
+import numpy as np
+from concert.coroutines.base import coroutine
+
+
+class RunningAverage(object):
+    """
+    Running mean and variance (Welford) of a stream of frames in float32
+    and a mask of pixels which deviated from the running mean by more than
+    *threshold* standard deviations in any frame (zingers, flickering pixels).
+    Calling the object gives a coroutine which can be attached to acquisitions
+    with a Consumer; every run of the acquisition starts a new average.
+    Other threads must use *average* and *outlier_mask*, copies published
+    when the acquisition is over, not the accumulators being updated.
+    """
+
+    def __init__(self, threshold=5.0, min_frames=5):
+        self.threshold = threshold
+        # outliers are not searched for before statistics settle down
+        self.min_frames = min_frames
+        self.count = 0
+        self.runs = 0
+        self.mean = None
+        self.m2 = None
+        self.outliers = None
+        self.average = None
+        self.outlier_mask = None
+        self._delta = None
+        self._tmp = None
+        self._sq = None
+        self._hit = None
+
+    def reset(self):
+        self.count = 0
+        self.runs += 1
+
+    def publish(self):
+        if self.count > 0:
+            self.outlier_mask = self.outliers.copy()
+            self.average = self.mean.copy()
+
+    def _allocate(self, shape):
+        if self.mean is None or self.mean.shape != shape:
+            self.mean = np.empty(shape, dtype=np.float32)
+            self.m2 = np.empty(shape, dtype=np.float32)
+            self.outliers = np.empty(shape, dtype=np.bool_)
+            self._delta = np.empty(shape, dtype=np.float32)
+            self._tmp = np.empty(shape, dtype=np.float32)
+            self._sq = np.empty(shape, dtype=np.float32)
+            self._hit = np.empty(shape, dtype=np.bool_)
+        self.mean.fill(0)
+        self.m2.fill(0)
+        self.outliers.fill(False)
+
+    def add(self, frame):
+        if self.count == 0:
+            self._allocate(frame.shape)
+        delta, tmp = self._delta, self._tmp
+        np.subtract(frame, self.mean, out=delta, dtype=np.float32)
+        if self.count >= self.min_frames:
+            # (frame - mean)**2 > threshold**2 * variance, no sqrt needed
+            np.multiply(self.m2, self.threshold ** 2 / (self.count - 1), out=tmp)
+            np.square(delta, out=self._sq)
+            np.greater(self._sq, tmp, out=self._hit)
+            self.outliers |= self._hit
+        self.count += 1
+        np.multiply(delta, 1.0 / self.count, out=tmp)
+        self.mean += tmp
+        np.subtract(frame, self.mean, out=tmp, dtype=np.float32)
+        np.multiply(delta, tmp, out=delta)
+        self.m2 += delta
+
+    @property
+    def ready(self):
+        return self.average is not None
+
+    @property
+    def variance(self):
+        if self.count < 2:
+            return None
+        return self.m2 / (self.count - 1)
+
+    @coroutine
+    def __call__(self):
+        self.reset()
+        run = self.runs
+        try:
+            while True:
+                frame = yield
+                self.add(frame)
+        except GeneratorExit:
+            # the acquisition is over; a newer run may have reset the
+            # accumulators already if this generator was closed late
+            if run == self.runs:
+                self.publish()
+            raise
+
+
+class FlatDarkAverage(object):
+    """
+    Averaged flat and dark fields of the last flats/darks acquisitions
+    kept in memory for online reconstruction and flat-corrected previews.
+    Flats taken before (flats) and after (flats2) the projections are
+    averaged separately, correction uses the ones before.
+    """
+
+    def __init__(self, threshold=5.0):
+        self.flat = RunningAverage(threshold)
+        self.flat2 = RunningAverage(threshold)
+        self.dark = RunningAverage(threshold)
+        self._norm = None
+        self._out = None
+
+    @property
+    def ready(self):
+        return self.flat.ready
+
+    @property
+    def outliers(self):
+        if not self.ready:
+            return None
+        flat, dark = self.flat.outlier_mask, self.dark.outlier_mask
+        if dark is not None and dark.shape == flat.shape:
+            return flat | dark
+        return flat
+
+    def correct(self, frame):
+        """(frame - dark) / (flat - dark), returned array is reused by the next call"""
+        flat, dark = self.flat.average, self.dark.average
+        shape = flat.shape
+        if frame.shape != shape:
+            return frame
+        if self._out is None or self._out.shape != shape:
+            self._norm = np.empty(shape, dtype=np.float32)
+            self._out = np.empty(shape, dtype=np.float32)
+        if dark is None or dark.shape != shape:
+            dark = 0
+        np.subtract(flat, dark, out=self._norm)
+        # avoid division by zero in dead pixels
+        np.maximum(self._norm, 1, out=self._norm)
+        np.subtract(frame, dark, out=self._out, dtype=np.float32)
+        np.divide(self._out, self._norm, out=self._out)
+        return self._out
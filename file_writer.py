@@ -1,12 +1,18 @@
 from PyQt5.QtWidgets import QGridLayout, QLabel, QGroupBox, QLineEdit, QPushButton, QFileDialog, QCheckBox
+from PyQt5.QtWidgets import QComboBox
+from PyQt5.QtCore import pyqtSignal
 import os
 from message_dialog import info_message, error_message
+from compressed_writer import available_codecs
 
 class FileWriterGroup(QGroupBox):
     """
     Write to file settings
     """
 
+    # root or stripe directory chosen in a dialog
+    dirs_selected_signal = pyqtSignal()
+
     def __init__(self, *args, **kwargs):
         super(FileWriterGroup, self).__init__(*args, **kwargs)
         self.setCheckable(True)
@@ -38,6 +44,37 @@ class FileWriterGroup(QGroupBox):
 
         self.bigtiff_checkbox = QCheckBox("Use bigtiff containers")
         self.bigtiff_checkbox.setChecked(False)
+
+        # HDF5: one file per scan, one dataset per acquisition
+        self.format_label = QLabel()
+        self.format_label.setText("File format")
+        self.format_entry = QComboBox()
+        self.format_entry.addItems(["TIFF", "HDF5"])
+        self.compression_label = QLabel()
+        self.compression_label.setText("HDF5 compression")
+        self.compression_entry = QComboBox()
+        self.compression_entry.addItems(["none", "lzf", "gzip"])
+        self.compression_entry.setEnabled(False)
+        self.format_entry.currentIndexChanged.connect(self.format_changed)
+
+        # frames go round-robin to root dir and these dirs (one per disk)
+        self.stripe_dirs_label = QLabel()
+        self.stripe_dirs_label.setText("Stripe over dirs:")
+        self.stripe_dirs_entry = QLineEdit()
+        self.stripe_dirs_entry.setToolTip("Additional root dirs separated by ;")
+        self.stripe_dirs_add_button = QPushButton("+")
+        self.stripe_dirs_add_button.clicked.connect(self.add_stripe_directory)
+
+        # lossless compression of tiff output in a process pool
+        self.codec_label = QLabel()
+        self.codec_label.setText("Frame compression")
+        self.codec_entry = QComboBox()
+        self.codec_entry.addItems(["none"] + available_codecs())
+        self.codec_level_label = QLabel()
+        self.codec_level_label.setText("Compression level")
+        self.codec_level_entry = QLineEdit()
+        self.codec_level_entry.setText("3")
+        self.codec_level_entry.setFixedWidth(200)
         self.set_layout()
 
     def set_layout(self):
@@ -54,6 +91,17 @@ class FileWriterGroup(QGroupBox):
         layout.addWidget(self.dsetname_label, 1, 5)
         layout.addWidget(self.dsetname_entry, 1, 6)
         #layout.addWidget(self.blank_label, 1, 7)
+        layout.addWidget(self.format_label, 2, 0)
+        layout.addWidget(self.format_entry, 2, 1)
+        layout.addWidget(self.compression_label, 2, 5)
+        layout.addWidget(self.compression_entry, 2, 6)
+        layout.addWidget(self.stripe_dirs_label, 3, 0)
+        layout.addWidget(self.stripe_dirs_entry, 3, 1, 1, 5)
+        layout.addWidget(self.stripe_dirs_add_button, 3, 6)
+        layout.addWidget(self.codec_label, 4, 0)
+        layout.addWidget(self.codec_entry, 4, 1)
+        layout.addWidget(self.codec_level_label, 4, 5)
+        layout.addWidget(self.codec_level_entry, 4, 6)
 
         # Make directory entry 10x wider
         layout.setColumnStretch(0, 1)
@@ -69,6 +117,27 @@ class FileWriterGroup(QGroupBox):
                                                     options=options)
         if root_dir:
             self.root_dir_entry.setText(root_dir)
+            self.dirs_selected_signal.emit()
+
+    def add_stripe_directory(self):
+        options = QFileDialog.Options()
+        options |= QFileDialog.DontUseNativeDialog
+        stripe_dir = QFileDialog.getExistingDirectory(
+            self, "Select directory on another disk", "", options=options)
+        if stripe_dir:
+            dirs = self.stripe_dirs + [stripe_dir]
+            self.stripe_dirs_entry.setText(";".join(dirs))
+            self.dirs_selected_signal.emit()
+
+    def format_changed(self):
+        hdf5 = self.file_format == "HDF5"
+        self.compression_entry.setEnabled(hdf5)
+        self.stripe_dirs_entry.setEnabled(not hdf5)
+        self.stripe_dirs_add_button.setEnabled(not hdf5)
+        self.codec_entry.setEnabled(not hdf5)
+        self.codec_level_entry.setEnabled(not hdf5)
+        self.bigtiff_checkbox.setEnabled(not hdf5)
+        self.dsetname_entry.setEnabled(not hdf5)
 
     # getters
     @property
@@ -83,6 +152,23 @@ class FileWriterGroup(QGroupBox):
             error_message("Cannot write into root dir. Check filewriter params")
             return None
 
+    @property
+    def stripe_dirs(self):
+        dirs = self.stripe_dirs_entry.text().split(";")
+        return [d.strip() for d in dirs if d.strip()]
+
+    @property
+    def root_dirs(self):
+        # all roots frames are striped over, the first one holds index files
+        root = self.root_dir
+        if root is None:
+            return None
+        for d in self.stripe_dirs:
+            if not os.access(d, os.W_OK):
+                error_message("Cannot write into {}. Check filewriter params".format(d))
+                return None
+        return [root] + [d for d in self.stripe_dirs if d != root]
+
     @property
     def dsetname(self):
         try:
@@ -104,3 +190,29 @@ class FileWriterGroup(QGroupBox):
     @property
     def bigtiff(self):
         return self.bigtiff_checkbox.isChecked()
+
+    @property
+    def file_format(self):
+        return self.format_entry.currentText()
+
+    @property
+    def codec(self):
+        tmp = self.codec_entry.currentText()
+        if tmp == "none":
+            return None
+        return tmp
+
+    @property
+    def codec_level(self):
+        try:
+            return int(self.codec_level_entry.text())
+        except ValueError:
+            error_message("Compression level must be integer")
+            return None
+
+    @property
+    def compression(self):
+        tmp = self.compression_entry.currentText()
+        if tmp == "none":
+            return None
+        return tmp
@@ -0,0 +1,172 @@
+"""Preallocated frame buffers for the on-the-fly grab loops"""
+
+import threading
+import time
+import numpy as np
+from concert.devices.cameras.base import CameraError
+
+
+class PooledFrame(np.ndarray):
+    """Frame in a buffer of a FramePool, views of it know the buffer too"""
+
+    def __array_finalize__(self, obj):
+        self.pool = getattr(obj, 'pool', None)
+        self.slot = getattr(obj, 'slot', None)
+        self.generation = getattr(obj, 'generation', None)
+
+
+def hold(frame):
+    """
+    Keep *frame* from being overwritten until release(frame), to be called by
+    every consumer which queues a frame or hands it to another thread.
+    Frames which do not come from a FramePool are not affected.
+    """
+    pool = getattr(frame, 'pool', None)
+    if pool is not None:
+        pool.hold(frame)
+    return frame
+
+
+def release(frame):
+    pool = getattr(frame, 'pool', None)
+    if pool is not None:
+        pool.release(frame)
+
+
+def detach(frame):
+    """Plain copy of a pooled *frame* for consumers which cannot release it,
+    other frames are returned as they are"""
+    if getattr(frame, 'pool', None) is None:
+        return frame
+    return np.array(frame)
+
+
+class FramePool(object):
+    """
+    Ring of preallocated frame buffers which libuca grabs into directly.
+    Frame handed out by grab() belongs to the producer until the next grab(),
+    by then all synchronous consumers of the experiment are done with it.
+    Consumers which keep a frame for later (queues, other threads) must call
+    hold() on it and release() when they are finished, or keep a copy made
+    by detach(); a buffer is not overwritten while it is held.
+    """
+
+    def __init__(self, max_bytes=2**30, min_buffers=8, timeout=0.0):
+        self.log = None
+        # upper limit for memory kept in the pool
+        self.max_bytes = max_bytes
+        self.min_buffers = min_buffers
+        # how long grab() waits for a held buffer before allocating a new one,
+        # a streaming camera drops frames while grab() waits
+        self.timeout = timeout
+        self.buffers = []
+        self.refs = []
+        # frames of buffers replaced by allocate() or clear() are not counted
+        self.generation = 0
+        self.current = None
+        # off when a consumer queues frames without holding them
+        self.enabled = True
+        self.condition = threading.Condition()
+
+    @staticmethod
+    def _pointer(frame):
+        return frame.__array_interface__['data'][0]
+
+    def allocate(self, shape, nframes, dtype=np.uint16):
+        """Make sure there are enough buffers of *shape* for *nframes* frames.
+        Buffers are kept between acquisitions as long as ROI does not change."""
+        shape = tuple(int(i) for i in shape)
+        dtype = np.dtype(dtype)
+        frame_bytes = int(np.prod(shape)) * dtype.itemsize
+        num = min(int(nframes), max(self.min_buffers, self.max_bytes // frame_bytes))
+        num = max(num, 1)
+        with self.condition:
+            if self.current is not None:
+                self._unref(self.current)
+                self.current = None
+            # frames still held by writers of the last acquisition stay held
+            if self.buffers and self.buffers[0].shape == shape and \
+                    self.buffers[0].dtype == dtype and len(self.buffers) >= num:
+                return
+            self.generation += 1
+            self.buffers = []
+            for i in range(num):
+                buf = np.empty(shape, dtype=dtype)
+                # touch every page now and not in the middle of the scan
+                buf.fill(0)
+                self.buffers.append(buf)
+            self.refs = [0] * num
+        if self.log is not None:
+            self.log.debug("Frame pool: {} buffers of {} {}".format(num, shape, dtype))
+
+    def clear(self):
+        with self.condition:
+            self.generation += 1
+            self.buffers = []
+            self.refs = []
+            self.current = None
+
+    def _unref(self, index):
+        if self.refs[index] > 0:
+            self.refs[index] -= 1
+        if self.refs[index] == 0:
+            self.condition.notify_all()
+
+    def _next_free(self):
+        """Index of the next buffer nobody holds, None if all are held after
+        waiting *timeout* for a release"""
+        deadline = time.time() + self.timeout
+        start = 0 if self.current is None else self.current + 1
+        while True:
+            for i in range(len(self.buffers)):
+                index = (start + i) % len(self.buffers)
+                if self.refs[index] == 0:
+                    return index
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            self.condition.wait(remaining)
+
+    def grab(self, camera):
+        """Grab next frame from *camera* into a pooled buffer"""
+        if not self.enabled or not self.buffers or not hasattr(camera, 'uca'):
+            # dummy camera or pool not prepared
+            return camera.grab()
+        with self.condition:
+            if self.current is not None:
+                self._unref(self.current)
+                self.current = None
+            index = self._next_free()
+            if index is None:
+                if self.log is not None:
+                    self.log.warning("Frame pool exhausted, allocating a new frame")
+                return camera.grab()
+            self.refs[index] = 1
+            self.current = index
+            buf = self.buffers[index]
+            generation = self.generation
+        if not camera.uca.grab(self._pointer(buf)):
+            raise CameraError('No frame grabbed')
+        # convert() may flip or slice, the result is still a view of buf
+        frame = np.asarray(camera.convert(buf)).view(PooledFrame)
+        frame.pool = self
+        frame.slot = index
+        frame.generation = generation
+        return frame
+
+    def hold(self, frame):
+        with self.condition:
+            if frame.generation == self.generation:
+                self.refs[frame.slot] += 1
+
+    def release(self, frame):
+        with self.condition:
+            if frame.generation == self.generation:
+                self._unref(frame.slot)
+
+    def finish(self):
+        """Drop producer's reference to the last frame at the end of acquisition"""
+        with self.condition:
+            if self.current is not None:
+                self._unref(self.current)
+                self.current = None
@@ -0,0 +1,99 @@
+"""Statistics of a region of frames and their saturation, published to the GUI"""
+
+import threading
+import time
+import numpy as np
+from PyQt5.QtCore import QObject, pyqtSignal
+from concert.coroutines.base import coroutine
+from frame_pool import detach
+from latest_frame import LatestFrame
+
+
+def roi_statistics(frame, roi=None, saturation_level=None):
+    """
+    Mean, std, min, max and the fraction of pixels at or above
+    *saturation_level* (the largest value of the dtype by default) of *frame*
+    within *roi* = (x0, y0, width, height). The whole frame is used for roi
+    None or a roi outside of the frame.
+    """
+    region = frame
+    if roi is not None:
+        x0, y0, width, height = roi
+        region = frame[y0:y0 + height, x0:x0 + width]
+        if not region.size:
+            region, roi = frame, None
+    if saturation_level is None:
+        if frame.dtype.kind in 'ui':
+            saturation_level = np.iinfo(frame.dtype).max
+        else:
+            saturation_level = np.inf
+    mean = region.mean(dtype=np.float64)
+    var = np.square(region, dtype=np.float64).mean() - mean ** 2
+    return {'time': time.time(), 'roi': roi, 'shape': region.shape,
+            'mean': float(mean), 'std': float(np.sqrt(max(var, 0.0))),
+            'min': float(region.min()), 'max': float(region.max()),
+            'saturated':
+                float(np.count_nonzero(region >= saturation_level)) / region.size}
+
+
+class FrameStatistics(QObject):
+    """
+    Takes every *every*-th frame given to put() (or sent to the coroutine,
+    e.g. by a Consumer of the scan acquisitions) and emits stats_signal with
+    the dict of roi_statistics. Computation runs in a thread of its own
+    which always takes the newest of the frames, so neither the grabbing nor
+    the display waits for it. The last result is kept in *last*, the last one
+    of a live view frame (put with live=True) also in *last_live*.
+    """
+
+    stats_signal = pyqtSignal(object)
+
+    def __init__(self, every=5):
+        super(FrameStatistics, self).__init__()
+        self.log = None
+        self.every = every
+        self.roi = None
+        self.saturation_level = None
+        self.count = 0
+        self.last = None
+        self.last_live = None
+        self.latest = LatestFrame()
+        self.running = True
+        self.thread = threading.Thread(target=self._compute)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, frame, live=False):
+        self.count += 1
+        if self.count % self.every == 0:
+            # pooled buffers are reused by the camera while the frame waits
+            self.latest.put((detach(frame), live))
+
+    def _compute(self):
+        while self.running:
+            item = self.latest.get(timeout=1.0)
+            if item is None:
+                continue
+            frame, live = item
+            if frame.ndim != 2:
+                continue
+            try:
+                stats = roi_statistics(frame, self.roi, self.saturation_level)
+            except Exception as exp:
+                if self.log is not None:
+                    self.log.error(exp)
+                continue
+            self.last = stats
+            if live:
+                self.last_live = stats
+            self.stats_signal.emit(stats)
+
+    @coroutine
+    def __call__(self):
+        while True:
+            frame = yield
+            self.put(frame)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
@@ -3,7 +3,7 @@
 from PyQt5.QtWidgets import QGroupBox, QDialog, QApplication, QGridLayout
 from PyQt5.QtWidgets import QLabel, QPushButton, QFileDialog, QHBoxLayout
 from PyQt5.QtWidgets import QLineEdit, QComboBox, QCheckBox
-from PyQt5.QtCore import QTimer, QEventLoop, QFile, QTextStream
+from PyQt5.QtCore import QTimer, QEventLoop, QFile, QTextStream, pyqtSignal
 # GUI groups and objects
 from camera_controls import CameraControlsGroup
 from login_dialog import Login
@@ -16,9 +16,19 @@ from message_dialog import info_message, error_message, warning_message
 from motor_controls import EpicsMonitorFloat, EpicsMonitorFIS, MotionThread, HomeThread
 from scans_concert import ConcertScanThread
 from on_the_fly_reco_settings import RecoSettingsGroup
+from hdf5_writer import Hdf5Walker
+from striped_writer import StripedWalker
+from compressed_writer import CompressingWalker
+from journal import ScanJournal, read_journal
+from metadata import monitored
+from catalog import ScanCatalog, CATALOG
+from disk_check import write_speed, cached_write_speed, required_bandwidth, \
+    writable_dirs
 # Concert imports
 from concert.storage import DirectoryWalker
 from concert.ext.viewers import PyplotImageViewer
+from preview import PreviewViewer
+from qt_viewer import QtImageViewer
 from concert.devices.shutters.dummy import Shutter as DummyShutter
 from concert.quantities import q
 import sys
@@ -26,11 +36,12 @@ import sys
 import logging
 import concert
 # Miscellaneous imports
-from numpy import linspace
+from numpy import linspace, allclose
 import yaml
 import time
 import argparse
 import os
+import threading
 import numpy as np
 from datetime import date
 # Dark style
@@ -45,6 +56,12 @@ concert.require("0.11.0")
 def process_cl_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--debug', action='store_const', const=True)  # optional flags
+    parser.add_argument('--viewer', choices=['qt', 'pyplot'], default='qt',
+                        help='qt draws in the GUI, '
+                             'pyplot in a separate matplotlib process')
+    parser.add_argument('--journal-checksums', action='store_true',
+                        help='record adler32 of the files of every scan in the '
+                             'journal, reads all data back after each scan')
     parsed_args, unparsed_args = parser.parse_known_args()
     return parsed_args, unparsed_args
 
@@ -55,8 +72,10 @@ class GUI(QDialog):
     provides start/abort controls for Concert scans, and holds
     4 groups where parameters can be entered
     '''
+    # write speed of the output disks has been measured in the background
+    disk_speed_measured_signal = pyqtSignal()
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, viewer='qt', journal_checksums=False, *args, **kwargs):
         super(GUI, self).__init__(*args, **kwargs)
         self.setWindowTitle('BMIT GUI')
 
@@ -72,7 +91,11 @@ class GUI(QDialog):
 
         # CAMERA
         self.camera = None
-        self.viewer = PyplotImageViewer()
+        # frames are binned to the viewer size before they are rendered
+        if viewer == 'pyplot':
+            self.viewer = PreviewViewer(PyplotImageViewer())
+        else:
+            self.viewer = PreviewViewer(QtImageViewer())
 
         # Thread in which concert.experiment will be started
         self.concert_scan = None
@@ -90,6 +113,8 @@ class GUI(QDialog):
         self.abort_button.clicked.connect(self.abort)
         self.return_button = QPushButton("RETURN")
         self.return_button.clicked.connect(self.return_to_start)
+        self.resume_button = QPushButton("RESUME")
+        self.resume_button.clicked.connect(self.resume)
         self.scan_fps_entry = QLabel()
 
         # external subgroups to set parameters
@@ -105,8 +130,19 @@ class GUI(QDialog):
         self.ffc_controls_group.setEnabled(False)
         self.file_writer_group = FileWriterGroup(title="File-writer settings")
         self.file_writer_group.setEnabled(False)
+        # measure output disks when they are selected, not when a scan starts;
+        # a few changes in a row start one measurement
+        self.disk_speed_timer = QTimer()
+        self.disk_speed_timer.setSingleShot(True)
+        self.disk_speed_timer.setInterval(1000)
+        self.disk_speed_timer.timeout.connect(self.measure_disk_speed)
+        self.file_writer_group.dirs_selected_signal.connect(self.disk_speed_timer.start)
+        self.file_writer_group.stripe_dirs_entry.editingFinished.connect(
+            self.disk_speed_timer.start)
+        self.disk_speed_measured_signal.connect(self.check_disk_bandwidth)
         self.ring_status_group = RingStatusGroup(title="Ring status")
         self.scan_controls_group = ScanControlsGroup(self.start_button, self.abort_button, self.return_button,
+                                                     self.resume_button,
                                                      self.scan_fps_entry,
                                                      self.motor_inner, self.motor_outer, title="Scan controls")
         self.scan_controls_group.setEnabled(False)
@@ -133,6 +169,17 @@ class GUI(QDialog):
         self.outer_region = []
         self.outer_step = 0.0
         self.outer_unit = q.mm
+        # pipelined read-out: outer motor goes to the next point during read-out
+        self.outer_move_ahead = False
+        self.outer_move_over = False
+        self.scan_waits_for_outer_move = False
+        # journal of the outer loop in the root dir, first scan when resuming
+        self.journal = None
+        self.journal_checksums = journal_checksums
+        self.first_scan = 0
+        # catalog of finished scans in the root dir
+        self.catalog = None
+        self.scan_start_time = 0
 
         # various timers
         self.scan_timer = QTimer()
@@ -166,6 +213,8 @@ class GUI(QDialog):
         self.button_save_params = QPushButton("Export settings and params to file")
         self.button_load_params = QPushButton("Read settings and params from file")
         self.button_log_file = QPushButton("Select log file")
+        self.button_catalog = QPushButton("Scans in root dir")
+        self.button_catalog.clicked.connect(self.show_catalog)
         self.button_save_params.clicked.connect(self.dump2yaml)
         self.button_load_params.clicked.connect(self.load_from_yaml)
         self.button_log_file.clicked.connect(self.select_log_file_func)
@@ -181,6 +230,8 @@ class GUI(QDialog):
         self.viewer_highlim_label = QLabel()
         self.viewer_highlim_label.setText("Viewer high limit")
         self.viewer_highlim_entry = QLineEdit()
+        self.auto_contrast_scan = QCheckBox("Auto contrast in scan")
+        self.auto_contrast_scan.setChecked(False)
         button_grp_layout = QHBoxLayout()
         button_grp_layout.addWidget(self.time_elapsed_label)
         button_grp_layout.addWidget(self.time_elapsed_entry)
@@ -189,9 +240,11 @@ class GUI(QDialog):
         button_grp_layout.addWidget(self.viewer_lowlim_entry)
         button_grp_layout.addWidget(self.viewer_highlim_label)
         button_grp_layout.addWidget(self.viewer_highlim_entry)
+        button_grp_layout.addWidget(self.auto_contrast_scan)
         button_grp_layout.addWidget(self.spacer)
         button_grp_layout.addWidget(self.button_save_params)
         button_grp_layout.addWidget(self.button_load_params)
+        button_grp_layout.addWidget(self.button_catalog)
         #button_grp_layout.addWidget(self.select_log_file_func)
         self.exp_imp_button_grp.setLayout(button_grp_layout)
         self.exp_imp_button_grp.setEnabled(False)
@@ -225,6 +278,7 @@ class GUI(QDialog):
             self.exit()
         else:
             self.file_writer_group.root_dir_entry.setText(self.login_parameters['expdir'])
+            self.disk_speed_timer.start()
             self.camera_controls_group.last_dir = self.login_parameters['expdir']
             td = date.today()
             tdstr = "{}.{}.{}".format(td.year, td.month, td.day)
@@ -248,6 +302,9 @@ class GUI(QDialog):
             self.motor_control_group.connect_CT_mot_button.animateClick()
             self.motor_control_group.connect_shutter_button.animateClick()
             self.camera_controls_group.log = self.log
+            self.camera_controls_group.frame_stats.log = self.log
+            self.camera_controls_group.live_preview_thread.log = self.log
+            self.viewer.log = self.log
 
     def exit(self):
         self.close()
@@ -292,7 +349,9 @@ class GUI(QDialog):
 
     def on_camera_connected(self, camera):
         self.concert_scan = ConcertScanThread(self.viewer, camera)
+        self.concert_scan.frame_stats = self.camera_controls_group.frame_stats
         self.concert_scan.scan_finished_signal.connect(self.end_of_scan)
+        self.concert_scan.recording_done_signal.connect(self.on_recording_done)
         self.concert_scan.start()
         self.scan_controls_group.setEnabled(True)
         self.ffc_controls_group.setEnabled(True)
@@ -301,9 +360,22 @@ class GUI(QDialog):
         self.reco_settings_group.setEnabled(True)
         self.ring_status_group.status_monitor.i0_state_changed_signal2.connect(
             self.send_inj_info_to_acqsetup)
+        self.ring_status_group.countdown_monitor.i0_state_changed_signal2.connect(
+            self.concert_scan.acq_setup.topup.update_countdown)
+        self.ring_status_group.lead_monitor.i0_state_changed_signal2.connect(
+            self.concert_scan.acq_setup.topup.update_lead)
         self.ring_status_group.sync_daq_inj.stateChanged.connect(self.enable_sync_daq_ring)
+        self.enable_sync_daq_ring()
         self.concert_scan.acq_setup.log = self.log
         self.concert_scan.log = self.log
+        live_preview_thread = self.camera_controls_group.live_preview_thread
+        live_preview_thread.ffc = self.concert_scan.ffc_average
+        # cached values of EPICS monitors recorded with every frame
+        self.concert_scan.metadata_sources = {
+            'angle_rbv': monitored(self.motor_control_group, 'CT_mot_monitor'),
+            'ring_current': monitored(self.ring_status_group, 'epics_monitor'),
+            'veto': monitored(self.ring_status_group, 'status_monitor'),
+            'shutter': monitored(self.motor_control_group, 'shutter_monitor')}
 
     def ena_disa_all(self, val=True):
         self.motor_control_group.setEnabled(val)
@@ -343,19 +415,39 @@ class GUI(QDialog):
             return None
 
     def check_data_overwrite(self):
-        if self.file_writer_group.isChecked():
-            if os.path.exists(os.path.join( \
-                    self.file_writer_group.root_dir, \
-                    self.file_writer_group.ctsetname.format(1))):
-                warning_message("Output directory exists. \n"
-                                "Change root dir or name pattern"
-                                "and start again")
-                self.abort()
-                return None
+        # separate scans go to the next free scan name, only data written
+        # straight into the root dir can be overwritten
+        if self.file_writer_group.isChecked() and \
+                not self.file_writer_group.separate_scans:
+            root = self.file_writer_group.root_dir
+            for name in ("flats", "darks", "flats2", "tomo", "radios"):
+                tmp = os.path.join(root, name)
+                if os.path.exists(tmp) or os.path.exists(tmp + '.h5'):
+                    warning_message("Output directory exists. \n"
+                                    "Change root dir or name pattern"
+                                    "and start again")
+                    self.abort()
+                    return True
+
+    def next_scan_index(self):
+        # catalog knows the scans without listing the root dir
+        if not self.file_writer_group.isChecked():
+            return None
+        root = self.file_writer_group.root_dir
+        if root is None or not os.path.exists(os.path.join(root, CATALOG)):
+            return None
+        try:
+            index = ScanCatalog(root).next_free_index(self.file_writer_group.ctsetname)
+        except Exception as exp:
+            self.log.error(exp)
+            return None
+        self.log.info("Scans will be numbered from {}".format(index))
+        return index
 
     def start(self):
         self.ena_disa_all(False)
         self.start_button.setEnabled(False)
+        self.resume_button.setEnabled(False)
         self.abort_button.setEnabled(True)
         self.return_button.setEnabled(False)
         self.log.info("** {:}, {:}".format(self.camera_controls_group.live_on,self.camera_controls_group.lv_stream2disk_on ))
@@ -372,17 +464,141 @@ class GUI(QDialog):
         else:
             self.abort()
 
+    def resume(self):
+        # continue the outer loop of an interrupted experiment after its last
+        # finished scan
+        root = self.file_writer_group.root_dir
+        if not self.file_writer_group.isChecked() or root is None:
+            warning_message("File-writer must be enabled and "
+                            "root dir must hold the journal")
+            return
+        plan = read_journal(root)
+        if plan is None or plan['finished']:
+            info_message("No interrupted experiment in {}".format(root))
+            return
+        region = self.get_outer_motor_grid()
+        if region is None:
+            return
+        if plan['outer_motor'] != self.scan_controls_group.outer_motor or \
+                len(region) != len(plan['outer_region']) or \
+                (self.scan_controls_group.outer_steps > 0 and
+                 not allclose(region, plan['outer_region'])):
+            warning_message("Outer loop settings differ from the interrupted "
+                            "experiment.\nLoad its parameters and try again")
+            return
+        first = 0
+        while first in plan['completed']:
+            first += 1
+        if first >= len(region):
+            info_message("All scans of the interrupted experiment are done")
+            return
+        self.log.info("***** RESUMING EXPERIMENT FROM SCAN {} *****".format(first + 1))
+        for index in sorted(plan['completed']):
+            # new scans are numbered after the existing directories
+            self.log.info("Scan {} was written to {}".format(
+                index + 1, plan['directories'].get(index)))
+        if first > 0 and self.scan_controls_group.ffc_before_outer and \
+                not self.scan_controls_group.ffc_before:
+            # flats before the outer loop belong to its first scan only
+            self.log.warning("Flats before the outer loop are not taken again")
+            info_message("Flats before the outer loop were taken before the "
+                         "interruption and are not taken again.\nEnable flats "
+                         "before every scan to have them for the resumed scans")
+        self.first_scan = first
+        self.start()
+
+    def open_journal(self):
+        self.journal = None
+        if not self.file_writer_group.isChecked():
+            return
+        try:
+            self.journal = ScanJournal(self.file_writer_group.root_dir,
+                                       checksums=self.journal_checksums)
+            self.journal.log = self.log
+            self.journal.start(self.scan_controls_group.outer_motor, self.outer_region,
+                               self.first_scan)
+        except Exception as exp:
+            self.log.error(exp)
+            self.log.error("Cannot write scan journal, experiment cannot be resumed")
+            self.journal = None
+
+    def open_catalog(self):
+        self.catalog = None
+        if not self.file_writer_group.isChecked():
+            return
+        try:
+            self.catalog = ScanCatalog(self.file_writer_group.root_dir)
+        except Exception as exp:
+            self.log.error(exp)
+            self.log.error("Cannot open scan catalog, scans will not be catalogued")
+
+    def catalog_scan(self):
+        # sizes are summed up and the row is added in a background thread
+        if self.catalog is None:
+            return
+        try:
+            # directory of the scan as recorded when it started
+            scan_dir = self.concert_scan.scan_dir
+            if scan_dir is None:
+                return
+            name = os.path.relpath(scan_dir, self.catalog.root)
+            records = self.concert_scan.acq_setup.acq_records
+            acquisitions = [{'name': r['name'], 'frames': r['frames'],
+                             'duration': r['duration'], 'fps': r['fps'],
+                             'directories': self.concert_scan.data_dirs(r['name'])}
+                            for r in records]
+            self.catalog.record_scan(
+                name, self.file_writer_group.ctsetname, acquisitions, log=self.log,
+                duration=time.time() - self.scan_start_time,
+                outer_position=float(self.outer_region[self.scan_index]),
+                params=yaml.safe_dump(self.scan_parameters(), default_flow_style=False))
+        except Exception as exp:
+            self.log.error(exp)
+            self.log.error("Cannot add scan to catalog")
+
+    def show_catalog(self):
+        root = self.file_writer_group.root_dir
+        if root is None:
+            return
+        if not os.path.exists(os.path.join(root, CATALOG)):
+            info_message("No scan catalog in {}".format(root))
+            return
+        summary = ScanCatalog(root).format_summary(limit=50)
+        self.log.info(summary)
+        info_message(summary)
+
+    def write_journal(self, method, *args):
+        # a journal problem must never stop the experiment
+        if self.journal is None:
+            return
+        try:
+            getattr(self.journal, method)(*args)
+        except Exception as exp:
+            self.log.error(exp)
+            self.log.error("Cannot write scan journal")
+
+    @property
+    def scan_index(self):
+        # index of the current scan in the outer loop starting from 0
+        return max(self.scan_controls_group.outer_steps - self.number_of_scans, 0)
+
     def update_elapsed_time(self):
         self.time_elapsed_entry.setText("{:0.1f}".format(time.time() - self.start_time_elapsed))
 
     def start_real(self):
-        #self.check_data_overwrite()
+        # a resumed experiment writes into its root dir on purpose
+        if not self.first_scan and self.check_data_overwrite():
+            return
         self.auto_set_buffers_ext_edge()
         if self.check_discrepancy_starting_point():
             return
+        self.check_disk_bandwidth()
+        self.check_saturation()
         #if self.scan_controls_group.inner_loop_continuous:
         #    self.validate_velocity()
         self.log.info("***** EXPERIMENT STARTED *****")
+        # an abort of the previous experiment must not stop waiting in this one
+        self.concert_scan.acq_setup.topup.reset()
         time.sleep(0.5)
         self.number_of_scans = 1 # we expect to make at least one scan
         self.scan_controls_group.setTitle("Scan controls. Status: Experiment is running")
@@ -392,6 +608,9 @@ class GUI(QDialog):
             self.camera_controls_group.live_on_func_ext_trig()
         self.outer_region = self.get_outer_motor_grid()
         if self.outer_region is not None:
+            self.number_of_scans -= self.first_scan
+            self.open_journal()
+            self.open_catalog()
             self.move_to_start(begin_exp=True)
 
     def move_to_start(self, begin_exp=True):
@@ -418,7 +637,7 @@ class GUI(QDialog):
         # used one of the fixed internal names which can be aborted if necessary
         self.motor_control_group.motion_vert = MotionThread(
                             self.motors[self.scan_controls_group.outer_motor],
-                            self.outer_region[0])
+                            self.outer_region[self.first_scan if begin_exp else 0])
         if begin_exp:
             self.motor_control_group.motion_CT.motion_over_signal.connect(self.begin_scans)
             self.motor_control_group.motion_vert.motion_over_signal.connect(self.begin_scans)
@@ -454,6 +673,10 @@ class GUI(QDialog):
         tmp = self.scan_controls_group.outer_steps - self.number_of_scans + 1
         self.scan_controls_group.setTitle("Experiment is running; doing scan {}".format(tmp))
         self.log.info("STARTING SCAN {:}".format(tmp))
+        self.write_journal('scan_begin', self.scan_index,
+                           self.outer_region[self.scan_index])
+        self.concert_scan.acq_setup.acq_records = []
+        self.scan_start_time = time.time()
         # before starting scan we have to create new experiment and update parameters
         # of acquisitions, flat-field correction, camera, consumers, etc based on the user input
         self.add_acquisitions_to_exp()
@@ -461,9 +684,27 @@ class GUI(QDialog):
 
     def end_of_scan(self):
         # in the end of scan next outer loop step is made if applicable
+        acquisitions = []
+        data_dirs = []
+        if self.concert_scan.exp is not None:
+            acquisitions = [a.name for a in self.concert_scan.exp.acquisitions]
+            for name in acquisitions:
+                data_dirs += self.concert_scan.data_dirs(name)
+        self.write_journal('scan_done', self.scan_index,
+                           self.outer_region[self.scan_index], acquisitions,
+                           self.concert_scan.scan_dir, data_dirs)
+        self.catalog_scan()
         self.number_of_scans -= 1
         if self.number_of_scans > 0:
-            if self.scan_controls_group.outer_motor == 'Timer [sec]':
+            if self.outer_move_ahead:
+                # outer motor was sent to the next point during read-out
+                self.outer_move_ahead = False
+                if self.outer_move_over:
+                    self.doscan()
+                else:
+                    self.log.info("WAITING FOR THE OUTER MOTOR")
+                    self.scan_waits_for_outer_move = True
+            elif self.scan_controls_group.outer_motor == 'Timer [sec]':
                 self.log.info("DELAYING THE NEXT SCAN")
                 self.scan_controls_group.setTitle("Experiment is running; delaying the next scan")
                 self.scan_timer.singleShot((self.outer_region[1] - self.outer_region[0]) * 1000,
@@ -482,11 +723,15 @@ class GUI(QDialog):
             # This section runs only if scan was finished normally, not aborted
             self.lv_timer_stop_func()
             self.log.info("***** EXPERIMENT finished without errors ****")
+            self.write_journal('finished')
+            self.journal = None
+            self.first_scan = 0
             # End of section
             self.scan_controls_group.setTitle(
                 "Scan controls. Status: scans were finished without errors. \
                 Total acquisition time {:} seconds".format(int(time.time() - self.total_experiment_time)))
             self.start_button.setEnabled(True)
+            self.resume_button.setEnabled(True)
             self.abort_button.setEnabled(False)
             self.ena_disa_all(True)
             self.concert_scan.delete_exp()
@@ -496,6 +741,30 @@ class GUI(QDialog):
             self.move_to_start(begin_exp=False)
 
 
+    def on_recording_done(self):
+        # camera memory is still being read out, but the next outer loop
+        # point can already be approached
+        if self.number_of_scans < 2 or \
+                self.scan_controls_group.outer_motor == 'Timer [sec]':
+            return
+        self.log.info("MOVING TO THE NEXT OUTER MOTOR POINT DURING READ-OUT")
+        self.outer_move_ahead = True
+        self.outer_move_over = False
+        self.scan_waits_for_outer_move = False
+        tmp = self.scan_controls_group.outer_steps - self.number_of_scans + 1
+        self.motor_control_group.motion_vert = MotionThread(
+            self.motors[self.scan_controls_group.outer_motor],
+            self.outer_region[tmp])
+        self.motor_control_group.motion_vert.motion_over_signal.connect(
+            self.outer_motion_over)
+        self.motor_control_group.motion_vert.start()
+
+    def outer_motion_over(self):
+        self.outer_move_over = True
+        if self.scan_waits_for_outer_move:
+            self.scan_waits_for_outer_move = False
+            self.doscan()
+
     def return_to_start(self):
         self.move_to_start(begin_exp=False)
 
@@ -524,6 +793,19 @@ class GUI(QDialog):
             self.concert_scan.acq_setup.calc_step()
             self.concert_scan.acq_setup.flats_before = self.scan_controls_group.ffc_before
             self.concert_scan.acq_setup.flats_after = self.scan_controls_group.ffc_after
+            acq_setup = self.concert_scan.acq_setup
+            acq_setup.pipelined_softr = self.scan_controls_group.pipelined_softr
+            acq_setup.trigger_latency = self.scan_controls_group.trigger_latency
+            # requested frame rate, compared to the achieved one in timing summaries
+            if self.camera_controls_group.trig_mode != "SOFTWARE":
+                self.concert_scan.acq_setup.fps = self.camera_controls_group.fps
+            else:
+                self.concert_scan.acq_setup.fps = None
+            # frame-loss detection in on-the-fly scans
+            self.concert_scan.acq_setup.check_timestamps = \
+                self.camera_controls_group.time_stamp.isChecked()
+            self.concert_scan.acq_setup.stamp_check.blank = \
+                self.camera_controls_group.blank_time_stamp.isChecked()
             # SET shutter
             if self.shutter is None:
                 self.concert_scan.ffc_setup.shutter = DummyShutter()
@@ -560,16 +842,66 @@ class GUI(QDialog):
             bpf = 0
             if self.file_writer_group.bigtiff:
                 bpf = 2**37
-            self.concert_scan.walker = DirectoryWalker(root=self.file_writer_group.root_dir,
-                                                       dsetname=self.file_writer_group.dsetname,
-                                                       bytes_per_file=bpf)
+            self.concert_scan.walker = None
+            if self.file_writer_group.file_format == "HDF5":
+                try:
+                    self.concert_scan.walker = Hdf5Walker(
+                        root=self.file_writer_group.root_dir,
+                        compression=self.file_writer_group.compression)
+                    self.concert_scan.walker.log = self.log
+                except Exception as exp:
+                    self.log.error(exp)
+                    self.log.error("Cannot write HDF5, writing tiff files instead")
+                    warning_message("Cannot write HDF5, writing tiff files instead")
+                if self.concert_scan.walker is not None and \
+                        self.concert_scan.acq_setup.region is not None:
+                    # angle of every projection next to the frames
+                    self.concert_scan.walker.angles['tomo'] = \
+                        self.concert_scan.acq_setup.region.magnitude
+            elif self.file_writer_group.stripe_dirs:
+                if bpf:
+                    self.log.warning("Striped writing stores every frame "
+                                     "in a separate file")
+                if self.file_writer_group.codec is not None:
+                    self.log.warning("Striped frames are written without compression")
+                try:
+                    self.concert_scan.walker = StripedWalker(
+                        self.file_writer_group.root_dirs,
+                        dsetname=self.file_writer_group.dsetname)
+                    self.concert_scan.walker.log = self.log
+                except Exception as exp:
+                    self.log.error(exp)
+                    msg = "Cannot stripe over dirs, writing into root dir only"
+                    self.log.error(msg)
+                    warning_message(msg)
+            elif self.file_writer_group.codec is not None:
+                if bpf:
+                    self.log.warning("Compressed frames are written into "
+                                     "separate files")
+                try:
+                    self.concert_scan.walker = CompressingWalker(
+                        root=self.file_writer_group.root_dir,
+                        dsetname=self.file_writer_group.dsetname,
+                        codec=self.file_writer_group.codec,
+                        level=self.file_writer_group.codec_level)
+                    self.concert_scan.walker.log = self.log
+                except Exception as exp:
+                    self.log.error(exp)
+                    self.log.error("Cannot compress frames, writing them uncompressed")
+                    warning_message("Cannot compress frames, writing them uncompressed")
+            if self.concert_scan.walker is None:
+                self.concert_scan.walker = DirectoryWalker(
+                    root=self.file_writer_group.root_dir,
+                    dsetname=self.file_writer_group.dsetname,
+                    bytes_per_file=bpf)
         else:
             # if writer is disabled we do not need walker as well
             self.concert_scan.walker = None
         # create experiment
         self.concert_scan.create_experiment(acquisitions,
                                             self.file_writer_group.ctsetname,
-                                            self.file_writer_group.separate_scans)
+                                            self.file_writer_group.separate_scans,
+                                            self.next_scan_index())
         if self.reco_settings_group.isChecked():
             try:
                 self.reco_settings_group.set_args(
@@ -629,26 +961,47 @@ class GUI(QDialog):
             else:
                 self.concert_scan.exp.add(self.concert_scan.acq_setup.tomo_softr)
         # ffc after
-        if self.scan_controls_group.ffc_after or \
+        flats_after = self.scan_controls_group.ffc_after or \
                 (self.scan_controls_group.ffc_after_outer and \
-                    self.number_of_scans == 1):
+                    self.number_of_scans == 1)
+        if flats_after:
             self.concert_scan.exp.add(self.concert_scan.acq_setup.flats2_softr)
+        # outer motor may move during read-out only if nothing comes after projections
+        self.concert_scan.acq_setup.pipelined_readout = \
+            self.scan_controls_group.pipelined and not flats_after
 
         # ATTACH CONSUMERS
         if self.file_writer_group.isChecked():
             self.concert_scan.attach_writer()
+            self.concert_scan.commanded_angles = None
+            if self.scan_controls_group.inner_motor == 'CT stage [deg]' and \
+                    self.concert_scan.acq_setup.region is not None:
+                self.concert_scan.commanded_angles = \
+                    self.concert_scan.acq_setup.region.magnitude
+            self.concert_scan.attach_metadata()
         #if not self.reco_enabled:
         #    self.concert_scan.attach_viewer()
         #else:
+        self.camera_controls_group.set_auto_contrast(
+            self.auto_contrast_scan.isChecked())
         self.concert_scan.attach_viewer()
+        self.concert_scan.attach_stats()
+        self.concert_scan.attach_ffc_average()
         if self.reco_settings_group.isChecked():
             self.log.info("Attaching online reco add on")
             self.concert_scan.attach_online_reco()
 
     def abort(self):
         self.number_of_scans = 0
+        self.write_journal('aborted')
+        self.journal = None
+        self.first_scan = 0
+        self.outer_move_ahead = False
+        self.scan_waits_for_outer_move = False
         self.scan_timer.stop()
         self.lv_timer_stop_func()
+        # release acquisition waiting for injection
+        self.concert_scan.acq_setup.topup.cancel()
         self.concert_scan.abort_scan()
         self.motor_control_group.stop_motors_func()
         self.motor_control_group.close_shutter_func()
@@ -672,6 +1025,7 @@ class GUI(QDialog):
         except:
             pass
         self.start_button.setEnabled(True)
+        self.resume_button.setEnabled(True)
         self.abort_button.setEnabled(False)
         self.return_button.setEnabled(True)
         self.scan_controls_group.setTitle(
@@ -758,9 +1112,12 @@ class GUI(QDialog):
 
     def enable_sync_daq_ring(self):
         self.concert_scan.acq_setup.top_up_veto_enabled = self.ring_status_group.sync_daq_inj.isChecked()
+        self.concert_scan.acq_setup.topup.enabled = \
+            self.ring_status_group.sync_daq_inj.isChecked()
 
     def send_inj_info_to_acqsetup(self, value):
         self.concert_scan.acq_setup.top_up_veto_state = value
+        self.concert_scan.acq_setup.topup.update_veto(value)
 
     def select_log_file_func(self):
         f, fext = self.QFD.getSaveFileName(
@@ -775,6 +1132,96 @@ class GUI(QDialog):
 
         return
 
+    def check_saturation(self):
+        # statistics of the live view used for alignment, not of the last scan
+        stats = self.camera_controls_group.frame_stats.last_live
+        if stats is None or time.time() - stats['time'] > 300:
+            return
+        percent = stats['saturated'] * 100
+        if percent <= self.camera_controls_group.saturation_warning:
+            return
+        warning_message("{:.3f} % of pixels were saturated in the last frames "
+                        "(maximum {:.0f}).\n"
+                        "Consider shorter exposure or lower beam intensity.\n"
+                        "Experiment will continue.".format(percent, stats['max']))
+
+    def output_roots(self):
+        # entries as they are, the root_dir property would complain in dialogs
+        root = self.file_writer_group.root_dir_entry.text()
+        roots = [root]
+        if self.file_writer_group.file_format == "TIFF":
+            roots += [d for d in self.file_writer_group.stripe_dirs if d != root]
+        roots = writable_dirs(roots)
+        if not roots or roots[0] != root:
+            return None
+        return roots
+
+    def measure_disk_speed(self, notify=False):
+        # a few seconds of writing per disk, off the GUI thread
+        roots = self.output_roots()
+        if roots:
+            thread = threading.Thread(target=self._measure_disk_speed,
+                                      args=(roots, notify))
+            thread.daemon = True
+            thread.start()
+
+    def _measure_disk_speed(self, roots, notify):
+        try:
+            for root in roots:
+                write_speed(root)
+        except Exception as exp:
+            if self.log is not None:
+                self.log.error(exp)
+                self.log.error("Cannot measure write speed of {}".format(
+                    ", ".join(roots)))
+            return
+        if notify:
+            self.disk_speed_measured_signal.emit()
+
+    def check_disk_bandwidth(self):
+        # frames go to disk while they are acquired only in on-the-fly Edge scans
+        if not self.file_writer_group.isChecked() or \
+                self.camera_controls_group.ttl_scan.isChecked() or \
+                self.scan_controls_group.readout_intheend.isChecked() or \
+                self.camera_controls_group.camera_model_label.text() != "PCO Edge" or \
+                self.camera_controls_group.trig_mode == "SOFTWARE":
+            return
+        roots = self.output_roots()
+        if not roots:
+            return
+        speeds = [cached_write_speed(root) for root in roots]
+        if None in speeds:
+            # not measured yet; the check is repeated when the measurement is done
+            self.log.info("Measuring write speed of {}".format(", ".join(roots)))
+            self.measure_disk_speed(notify=True)
+            return
+        if self.camera_controls_group.trig_mode == "AUTO":
+            fps = self.camera_controls_group.fps
+        else:
+            fps = 1000.0 / (self.camera_controls_group.exp_time +
+                            self.camera_controls_group.dead_time)
+        required = required_bandwidth(self.camera_controls_group.roi_width,
+                                      self.camera_controls_group.roi_height, fps)
+        # round-robin striping goes at the pace of the slowest disk
+        measured = min(speeds) * len(speeds)
+        self.log.info("Acquisition needs {:.0f} MB/s, {} writes {:.0f} MB/s".format(
+            required / 2**20, ", ".join(roots), measured / 2**20))
+        if measured >= required:
+            return
+        inner_steps = self.scan_controls_group.inner_steps
+        if self.camera_controls_group.buffered and \
+                self.camera_controls_group.buffnum >= inner_steps:
+            self.log.info("Disk is slower than acquisition, "
+                          "frames wait in libuca buffers")
+            return
+        warning_message("Disk writes {:.0f} MB/s but acquisition needs {:.0f} MB/s.\n"
+                        "Frames will be lost when libuca buffer overflows.\n"
+                        "Consider buffered mode with at least {} buffers, "
+                        "readout in the end, lower fps or smaller ROI.\n"
+                        "Experiment will continue.".format(
+                            measured / 2**20, required / 2**20,
+                            self.scan_controls_group.inner_steps))
+
     def auto_set_buffers_ext_edge(self):
         if self.camera_controls_group.trig_mode == "EXTERNAL" and \
                 self.camera_controls_group.camera_model == "PCO Edge":
@@ -788,6 +1235,17 @@ class GUI(QDialog):
         if f == '':
             warning_message('Select file')
             return
+        params = self.scan_parameters()
+
+        def my_unicode_repr(data):
+            return self.represent_str(data.encode('utf-8'))
+
+        yaml.representer.Representer.add_representer(unicode, my_unicode_repr)
+
+        with open(f+'.yaml', 'w') as f:
+            yaml.safe_dump(params, f, allow_unicode=True, default_flow_style=False)
+
+    def scan_parameters(self):
         params ={"Camera":
                     {'Model': self.camera_controls_group.camera_model_label.text(),
                      'External camera': self.camera_controls_group.ttl_scan.isChecked(),
@@ -835,16 +1293,16 @@ class GUI(QDialog):
                    'CT scan name': self.file_writer_group.ctsetname,
                    'Filename': self.file_writer_group.dsetname,
                    'Big tiffs': self.file_writer_group.bigtiff,
-                   'Separate scans': self.file_writer_group.separate_scans}
+                   'Separate scans': self.file_writer_group.separate_scans,
+                   'File format': self.file_writer_group.file_format,
+                   'HDF5 compression':
+                       self.file_writer_group.compression_entry.currentText(),
+                   'Stripe dirs': self.file_writer_group.stripe_dirs_entry.text(),
+                   'Frame compression':
+                       self.file_writer_group.codec_entry.currentText(),
+                   'Compression level': self.file_writer_group.codec_level_entry.text()}
             }
-
-        def my_unicode_repr(data):
-            return self.represent_str(data.encode('utf-8'))
-
-        yaml.representer.Representer.add_representer(unicode, my_unicode_repr)
-
-        with open(f+'.yaml', 'w') as f:
-            yaml.safe_dump(params, f, allow_unicode=True, default_flow_style=False)
+        return params
 
     def load_from_yaml(self):
         fname, _ = QFileDialog.getOpenFileName(self, "Select yaml file with BMITgui params",
@@ -918,6 +1376,27 @@ class GUI(QDialog):
             self.file_writer_group.dsetname_entry.setText(p['Writer']['Filename'])
             self.file_writer_group.bigtiff_checkbox.setChecked(p['Writer']['Big tiffs'])
             self.file_writer_group.separate_scans_checkbox.setChecked(p['Writer']['Separate scans'])
+            if 'Stripe dirs' in p['Writer']:
+                self.file_writer_group.stripe_dirs_entry.setText(
+                    p['Writer']['Stripe dirs'])
+            self.disk_speed_timer.start()
+            if 'Frame compression' in p['Writer']:
+                tmp = self.file_writer_group.codec_entry.findText(
+                    p['Writer']['Frame compression'])
+                if tmp < 0:
+                    self.log.warning("Frame compression {} is not available".format(
+                        p['Writer']['Frame compression']))
+                    tmp = 0
+                self.file_writer_group.codec_entry.setCurrentIndex(tmp)
+                self.file_writer_group.codec_level_entry.setText(
+                    str(p['Writer']['Compression level']))
+            if 'File format' in p['Writer']:
+                format_entry = self.file_writer_group.format_entry
+                format_entry.setCurrentIndex(
+                    format_entry.findText(p['Writer']['File format']))
+                self.file_writer_group.compression_entry.setCurrentIndex(
+                    self.file_writer_group.compression_entry.findText(
+                        p['Writer']['HDF5 compression']))
         except:
             warning_message('Cannot enter file-writer settings correctly')
 
@@ -935,5 +1414,5 @@ if __name__ == '__main__':
     stream = QTextStream(style_file)
     # Set application style to dark; Comment following line to unset
     # app.setStyleSheet(stream.readAll())
-    ex = GUI()
+    ex = GUI(viewer=parsed_args.viewer, journal_checksums=parsed_args.journal_checksums)
     sys.exit(app.exec_())
@@ -0,0 +1,196 @@
+"""HDF5 containers as an alternative to directories of tiff files"""
+
+import os
+import threading
+import time
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+import numpy as np
+from concert.coroutines.base import coroutine
+from concert.storage import Walker, StorageError
+from frame_pool import hold, release
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+class Hdf5Walker(Walker):
+    """
+    Walker which writes into HDF5 files instead of directories.
+    The first level below root is a file <name>.h5 (one per scan if scans
+    are separated, <default_file>.h5 otherwise), deeper levels are groups.
+    Frames of every acquisition go into dataset *dsetname* chunked by frame,
+    next to datasets 'angle' and 'timestamp' with one value per frame.
+    Angles are taken from *angles* (acquisition name -> array) if given.
+
+    Frames are compressed and written by one thread fed through a queue of at
+    most *max_bytes*, the acquisition only waits when the queue is full.
+    Datasets grow by *grow_frames* frames at a time and are cut to the frames
+    written by close().
+    """
+
+    def __init__(self, root, dsetname='data', compression=None, default_file='data',
+                 flush_every=100, grow_frames=64, max_bytes=2**30):
+        if h5py is None:
+            raise StorageError("h5py is not installed, cannot write HDF5")
+        super(Hdf5Walker, self).__init__(root, dsetname=dsetname)
+        self._root = root
+        self._path = []
+        self.dsetname = dsetname
+        # None, 'gzip' or 'lzf'
+        self.compression = compression
+        self.default_file = default_file
+        self.flush_every = flush_every
+        self.grow_frames = grow_frames
+        self.max_bytes = max_bytes
+        self.log = None
+        self.angles = {}
+        self._files = {}
+        # (file, group, dataset) -> [data, angle, timestamp, frames written]
+        self._sets = {}
+        self._lock = threading.Lock()
+        self.queue = None
+        self.thread = None
+        self.error = None
+
+    @property
+    def current(self):
+        return os.path.join(self._root, *self._path)
+
+    def home(self):
+        self._path = []
+
+    def descend(self, name):
+        self._path.append(name)
+        return self
+
+    def ascend(self):
+        if self._path:
+            self._path.pop()
+        return self
+
+    def _location(self, path):
+        """File name and group of *path* below root"""
+        if len(path) > 1:
+            return os.path.join(self._root, path[0] + '.h5'), '/'.join(path[1:])
+        return os.path.join(self._root, self.default_file + '.h5'), '/'.join(path)
+
+    def exists(self, *paths):
+        path = self._path + list(paths)
+        if len(path) == 1 and os.path.exists(os.path.join(self._root, path[0] + '.h5')):
+            return True
+        fname, group = self._location(path)
+        if not group or not os.path.exists(fname):
+            return False
+        with self._lock:
+            return group in self._open(fname)
+
+    def _open(self, fname):
+        if fname not in self._files:
+            self._files[fname] = h5py.File(fname, 'a')
+        return self._files[fname]
+
+    def write(self, data=None, dsetname=None):
+        fname, group = self._location(self._path)
+        coro = self._write_coroutine(fname, group or '/', dsetname or self.dsetname,
+                                     self._path[-1] if self._path else None)
+        if data is None:
+            return coro
+        for frame in data:
+            coro.send(frame)
+
+    def _datasets(self, fname, group, dsetname, frame):
+        grp = self._open(fname).require_group(group)
+        if dsetname in grp:
+            # repeated acquisition, append to it
+            return grp[dsetname], grp['angle'], grp['timestamp']
+        shape = (0,) + frame.shape
+        data = grp.create_dataset(dsetname, shape=shape, maxshape=(None,) + frame.shape,
+                                  chunks=(1,) + frame.shape, dtype=frame.dtype,
+                                  compression=self.compression,
+                                  shuffle=self.compression is not None)
+        angle = grp.create_dataset('angle', shape=(0,), maxshape=(None,),
+                                   dtype=np.float64)
+        stamp = grp.create_dataset('timestamp', shape=(0,), maxshape=(None,),
+                                   dtype=np.float64)
+        return data, angle, stamp
+
+    def _start(self, frame):
+        self.error = None
+        self.queue = Queue(maxsize=max(2, self.max_bytes // frame.nbytes))
+        self.thread = threading.Thread(target=self._write_frames)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _write_frame(self, key, frame, angle_value, now):
+        entry = self._sets.get(key)
+        if entry is None:
+            data, angle, stamp = self._datasets(key[0], key[1], key[2], frame)
+            entry = self._sets[key] = [data, angle, stamp, data.shape[0]]
+        data, angle, stamp, i = entry
+        if i >= data.shape[0]:
+            # resizing is not free, grow by a chunk of frames at a time
+            for dset in (data, angle, stamp):
+                dset.resize(i + self.grow_frames, axis=0)
+        data[i] = frame
+        angle[i] = angle_value
+        stamp[i] = now
+        entry[3] = i + 1
+        if (i + 1) % self.flush_every == 0:
+            data.file.flush()
+
+    def _write_frames(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            key, frame, angle_value, now = item
+            try:
+                if self.error is None:
+                    with self._lock:
+                        self._write_frame(key, frame, angle_value, now)
+            except Exception as exp:
+                if self.log is not None:
+                    self.log.error(exp)
+                    self.log.error("HDF5 writer failed, frames are being dropped")
+                self.error = exp
+            finally:
+                release(frame)
+
+    @coroutine
+    def _write_coroutine(self, fname, group, dsetname, acq_name):
+        angles = self.angles.get(acq_name)
+        n = 0
+        while True:
+            frame = yield
+            if self.error is not None:
+                raise self.error
+            if self.queue is None:
+                self._start(frame)
+            angle_value = np.nan
+            if angles is not None and n < len(angles):
+                angle_value = angles[n]
+            # pooled frames must not be overwritten before they are written
+            self.queue.put(((fname, group, dsetname), hold(frame), angle_value,
+                            time.time()))
+            n += 1
+
+    def close(self):
+        """Write the queued frames, cut datasets to the frames written and
+        close the files"""
+        if self.queue is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.queue = None
+            self.thread = None
+        with self._lock:
+            for data, angle, stamp, count in self._sets.values():
+                for dset in (data, angle, stamp):
+                    dset.resize(count, axis=0)
+            self._sets = {}
+            for f in self._files.values():
+                f.close()
+            self._files = {}
@@ -0,0 +1,126 @@
+"""Append-only journal of the outer loop for resuming interrupted experiments"""
+
+import json
+import os
+import threading
+import time
+import zlib
+
+
+def checksum(fname, block=2**22):
+    value = 1
+    with open(fname, 'rb') as f:
+        while True:
+            data = f.read(block)
+            if not data:
+                return value & 0xffffffff
+            value = zlib.adler32(data, value)
+
+
+class ScanJournal(object):
+    """
+    JSON lines in <root>/<fname>, every record is flushed and fsync'ed so
+    that the journal survives a crash of the program or of the computer.
+    Records: "start" (outer loop plan), "scan_begin", "scan_done" (outer
+    position, acquisitions and the directory the scan was written to),
+    "files" (adler32 of the files in the data directories of the scan,
+    computed in a background thread, one scan at a time, only with
+    *checksums* as reading the files back competes with the next scan for
+    the disk), "aborted" and "finished".
+    """
+
+    def __init__(self, root, fname='journal.jsonl', checksums=False):
+        self.log = None
+        self.path = os.path.join(root, fname)
+        self.root = root
+        self.checksums = checksums
+        self.lock = threading.Lock()
+        self.files_lock = threading.Lock()
+
+    def append(self, event, **kwargs):
+        kwargs['event'] = event
+        kwargs['time'] = time.time()
+        line = json.dumps(kwargs) + '\n'
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def start(self, outer_motor, outer_region, first_scan=0):
+        self.append('start', outer_motor=outer_motor,
+                    outer_region=[float(x) for x in outer_region],
+                    first_scan=first_scan)
+
+    def scan_begin(self, index, outer_position):
+        self.append('scan_begin', scan=index, outer_position=float(outer_position))
+
+    def scan_done(self, index, outer_position, acquisitions, directory=None,
+                  data_dirs=()):
+        """*directory* is the one of the scan (its name does not follow the
+        index when scans were resumed), *data_dirs* the ones with its frames"""
+        self.append('scan_done', scan=index, outer_position=float(outer_position),
+                    acquisitions=acquisitions, directory=directory)
+        if data_dirs and self.checksums:
+            thread = threading.Thread(target=self._record_files,
+                                      args=(index, list(data_dirs)))
+            thread.daemon = True
+            thread.start()
+
+    def _record_files(self, index, data_dirs):
+        # files were just written, mostly they are read back from page cache
+        files = {}
+        total = 0
+        try:
+            with self.files_lock:
+                for path in data_dirs:
+                    for dirpath, dirnames, filenames in os.walk(path):
+                        for name in filenames:
+                            fname = os.path.join(dirpath, name)
+                            files[os.path.relpath(fname, self.root)] = checksum(fname)
+                            total += os.path.getsize(fname)
+            self.append('files', scan=index, files=files, bytes=total)
+        except Exception as exp:
+            if self.log is not None:
+                self.log.error(exp)
+                self.log.error("Cannot record checksums of scan {}".format(index))
+
+    def aborted(self):
+        self.append('aborted')
+
+    def finished(self):
+        self.append('finished')
+
+
+def read_journal(root, fname='journal.jsonl'):
+    """
+    Plan of the last experiment journalled in *root* as a dict with keys
+    outer_motor, outer_region, completed (indices of finished scans),
+    directories (index -> directory of the finished scan) and finished,
+    None if there is no journal
+    """
+    path = os.path.join(root, fname)
+    if not os.path.exists(path):
+        return None
+    plan = None
+    with open(path) as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                # last line of a crash may be incomplete
+                continue
+            if rec['event'] == 'start':
+                if plan is None or rec['first_scan'] == 0:
+                    plan = {'outer_motor': rec['outer_motor'],
+                            'outer_region': rec['outer_region'],
+                            'completed': set(), 'directories': {}}
+                plan['finished'] = False
+            elif plan is None:
+                continue
+            elif rec['event'] == 'scan_done':
+                plan['completed'].add(rec['scan'])
+                plan['directories'][rec['scan']] = rec.get('directory')
+            elif rec['event'] == 'finished':
+                plan['finished'] = True
+    return plan
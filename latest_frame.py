@@ -0,0 +1,45 @@
+"""Single-slot hand-over of the newest frame from a grab loop to a display"""
+
+import threading
+
+
+class LatestFrame(object):
+    """
+    Holds only the most recent frame. put() never blocks and replaces a
+    frame nobody has taken yet (counted as dropped), get() waits for a frame
+    newer than the last one taken. The producer therefore runs at camera
+    speed while the consumer sees the newest frame at its own pace.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.frame = None
+        self.grabbed = 0
+        self.displayed = 0
+        self.dropped = 0
+
+    def reset(self):
+        with self.condition:
+            self.frame = None
+            self.grabbed = 0
+            self.displayed = 0
+            self.dropped = 0
+
+    def put(self, frame):
+        with self.condition:
+            if self.frame is not None:
+                self.dropped += 1
+            self.frame = frame
+            self.grabbed += 1
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """Newest frame not taken yet, None after *timeout* seconds without one"""
+        with self.condition:
+            if self.frame is None:
+                self.condition.wait(timeout)
+            frame = self.frame
+            self.frame = None
+            if frame is not None:
+                self.displayed += 1
+            return frame
@@ -0,0 +1,129 @@
+"""Context of every frame (angle, time, ring current, veto, shutter) next to
+the images"""
+
+import os
+import threading
+import time
+import numpy as np
+from concert.coroutines.base import coroutine
+
+COLUMNS = ('frame', 'time', 'angle_cmd', 'angle_rbv', 'ring_current', 'veto', 'shutter')
+
+
+def monitored(owner, name):
+    """Callable giving the last value of EPICS monitor *owner.name*,
+    None while the monitor does not exist yet (device not connected)"""
+    def value():
+        return getattr(getattr(owner, name, None), 'value', None)
+    return value
+
+
+class FrameMetadata(object):
+    """
+    Consumer which records one row of COLUMNS per frame of acquisition *name*.
+    Values of *sources* (column -> callable) are the cached values of
+    monitors, so reading them costs nothing and never waits for the network;
+    readback angle therefore lags by the monitor update period.
+    Commanded angle of frame i is commanded[i] if given. Rows are collected
+    in a columnar buffer and appended as CSV in batches of *batch* frames to
+    <name>_metadata.csv in the current directory of *walker*.
+    """
+
+    def __init__(self, name, walker, sources=None, commanded=None, batch=256):
+        self.log = None
+        self.name = name
+        self.walker = walker
+        self.sources = sources or {}
+        self.commanded = commanded
+        self.buffer = np.empty((batch, len(COLUMNS)))
+        self.rows = 0
+        self.count = 0
+        self.path = None
+        self.disabled = False
+        self.lock = threading.Lock()
+
+    def _open(self):
+        current = self.walker.current
+        if os.path.isdir(current):
+            self.path = os.path.join(current, self.name + '_metadata.csv')
+        else:
+            # HDF5 walker, current level is a group in a file
+            self.path = current + '_' + self.name + '_metadata.csv'
+        with open(self.path, 'w') as f:
+            f.write(','.join(COLUMNS) + '\n')
+
+    def _value(self, column):
+        source = self.sources.get(column)
+        if source is None:
+            return np.nan
+        value = source()
+        return np.nan if value is None else float(value)
+
+    def add(self, frame):
+        with self.lock:
+            if self.disabled:
+                return
+            if self.path is None:
+                try:
+                    self._open()
+                except Exception as exp:
+                    # metadata must not stop the acquisition
+                    if self.log is not None:
+                        self.log.error(exp)
+                        self.log.error("Cannot record frame metadata of {}".format(
+                            self.name))
+                    self.disabled = True
+                    return
+            row = self.buffer[self.rows]
+            row[0] = self.count
+            row[1] = time.time()
+            if self.commanded is not None and self.count < len(self.commanded):
+                row[2] = self.commanded[self.count]
+            else:
+                row[2] = np.nan
+            for i, column in enumerate(COLUMNS[3:], 3):
+                row[i] = self._value(column)
+            self.rows += 1
+            self.count += 1
+            if self.rows == len(self.buffer):
+                try:
+                    self._flush()
+                except Exception as exp:
+                    if self.log is not None:
+                        self.log.error(exp)
+                        self.log.error("Cannot save frame metadata of {}".format(
+                            self.name))
+                    self.disabled = True
+
+    def _flush(self):
+        if self.rows:
+            with open(self.path, 'a') as f:
+                np.savetxt(f, self.buffer[:self.rows], delimiter=',',
+                           fmt=['%d', '%.6f', '%.6g', '%.6g', '%.4g', '%.0f', '%.0f'])
+            self.rows = 0
+
+    @coroutine
+    def __call__(self):
+        self.close()
+        while True:
+            frame = yield
+            self.add(frame)
+
+    def close(self):
+        """Write the remaining rows, next run of the acquisition starts a new file"""
+        with self.lock:
+            self.disabled = False
+            if self.path is None:
+                return
+            try:
+                self._flush()
+                if self.log is not None:
+                    self.log.debug("Metadata of {} frames saved to {}".format(
+                        self.count, self.path))
+            except Exception as exp:
+                if self.log is not None:
+                    self.log.error(exp)
+                    self.log.error("Cannot save frame metadata of {}".format(self.name))
+            self.path = None
+            self.rows = 0
+            self.count = 0
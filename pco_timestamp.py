@@ -0,0 +1,102 @@
+"""Decoding of PCO binary time stamps and frame-loss detection"""
+
+import numpy as np
+
+# PCO binary time stamp occupies first 14 pixels of the first line,
+# every pixel holds two BCD digits:
+# 0-3 image counter, 4-5 year, 6 month, 7 day, 8 hour, 9 min, 10 s, 11-13 us
+STAMP_PIXELS = 14
+
+
+def decode_bcd(pixels):
+    pixels = pixels.astype(np.int64) & 0xFF
+    return (pixels >> 4) * 10 + (pixels & 0x0F)
+
+
+def decode(stamps):
+    """Image counters and time of day in seconds of stamps with shape (n, 14)"""
+    digits = decode_bcd(stamps)
+    counters = digits[:, 0] * 1000000 + digits[:, 1] * 10000 + \
+        digits[:, 2] * 100 + digits[:, 3]
+    seconds = digits[:, 8] * 3600.0 + digits[:, 9] * 60.0 + digits[:, 10] + \
+        (digits[:, 11] * 10000 + digits[:, 12] * 100 + digits[:, 13]) * 1e-6
+    return counters, seconds
+
+
+class TimestampChecker(object):
+    """
+    Collects time stamps of the frames as they are grabbed and decodes them
+    in batches to find lost and duplicated frames during the acquisition.
+    Optionally replaces stamp pixels by the pixels of the second line so that
+    they do not end up in the data.
+    """
+
+    def __init__(self, batch=64):
+        self.log = None
+        self.batch = batch
+        self.blank = False
+        self.stamps = None
+        self.count = 0
+        self.checked = 0
+        self.lost = 0
+        self.duplicated = 0
+
+    def reset(self, nframes):
+        nframes = max(int(nframes), 1)
+        if self.stamps is None or len(self.stamps) < nframes:
+            self.stamps = np.zeros((nframes, STAMP_PIXELS), dtype=np.uint16)
+        self.count = 0
+        self.checked = 0
+        self.lost = 0
+        self.duplicated = 0
+
+    def check(self, frame):
+        if self.count >= len(self.stamps):
+            self.stamps = np.concatenate((self.stamps, np.zeros_like(self.stamps)))
+        self.stamps[self.count] = frame[0, :STAMP_PIXELS]
+        if self.blank:
+            frame[0, :STAMP_PIXELS] = frame[1, :STAMP_PIXELS]
+        self.count += 1
+        if self.count - self.checked >= self.batch:
+            self.analyze()
+        return frame
+
+    def analyze(self):
+        """Decode stamps grabbed since the last call and report gaps"""
+        # include last checked frame to see the gap at the batch border
+        start = max(self.checked - 1, 0)
+        if self.count - start < 2:
+            return
+        counters, _ = decode(self.stamps[start:self.count])
+        steps = np.diff(counters)
+        for i in np.nonzero(steps != 1)[0]:
+            frame = start + i + 1
+            if steps[i] > 1:
+                self.lost += steps[i] - 1
+                if self.log is not None:
+                    self.log.warning("Lost {} frame(s) before frame {}".format(
+                        steps[i] - 1, frame))
+            else:
+                self.duplicated += 1
+                if self.log is not None:
+                    self.log.warning(
+                        "Frame {} repeats or goes back in image counter".format(frame))
+        self.checked = self.count
+
+    def summary(self, fps=None):
+        self.analyze()
+        lines = ["Time stamps of {} frames: {} lost, {} duplicated".format(
+            self.count, self.lost, self.duplicated)]
+        if self.count > 2:
+            _, seconds = decode(self.stamps[:self.count])
+            intervals = np.diff(seconds)
+            # midnight
+            intervals[intervals < 0] += 86400.0
+            intervals *= 1000.0
+            line = "  frame interval mean {:.3f} ms, std {:.3f} ms, min {:.3f} ms, " \
+                "max {:.3f} ms".format(intervals.mean(), intervals.std(),
+                                       intervals.min(), intervals.max())
+            if fps:
+                line += ", expected {:.3f} ms".format(1000.0 / fps)
+            lines.append(line)
+        return lines
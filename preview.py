@@ -0,0 +1,141 @@
+"""Binning of frames before they are shown, nobody can see all sensor pixels"""
+
+import threading
+import time
+import numpy as np
+from concert.coroutines.base import coroutine
+from frame_pool import detach
+from latest_frame import LatestFrame
+
+
+class PreviewTransform(object):
+    """
+    Block mean over *binning* x *binning* pixels into float32 (the display
+    dtype, values keep the scale of the input so viewer limits still apply).
+    With binning 'auto' the factor is the smallest one which makes the frame
+    fit into *target_shape* (height, width), e.g. the size of the widget.
+    Results go into a ring of *num_buffers* reused arrays, so a frame
+    handed to the viewer is not overwritten by the next few.
+    """
+
+    def __init__(self, binning='auto', target_shape=(1024, 1024), num_buffers=3):
+        self.binning = binning
+        self.target_shape = target_shape
+        self.num_buffers = num_buffers
+        self.buffers = []
+        self.index = 0
+        self.lock = threading.Lock()
+
+    def factor(self, shape):
+        if self.binning != 'auto':
+            return max(int(self.binning), 1)
+        return max(int(np.ceil(max(float(shape[0]) / self.target_shape[0],
+                                   float(shape[1]) / self.target_shape[1]))), 1)
+
+    def _buffer(self, shape):
+        if not self.buffers or self.buffers[0].shape != shape:
+            self.buffers = [np.empty(shape, dtype=np.float32)
+                            for i in range(self.num_buffers)]
+        self.index = (self.index + 1) % len(self.buffers)
+        return self.buffers[self.index]
+
+    def __call__(self, frame):
+        if frame.ndim != 2:
+            return frame
+        f = self.factor(frame.shape)
+        if f == 1:
+            return frame
+        height, width = frame.shape[0] // f, frame.shape[1] // f
+        with self.lock:
+            out = self._buffer((height, width))
+            # f*f strided adds are several times faster than a sum over
+            # the axes of a (height, f, width, f) view
+            out[...] = frame[0:height * f:f, 0:width * f:f]
+            for i in range(f):
+                for j in range(f):
+                    if i or j:
+                        out += frame[i:height * f:f, j:width * f:f]
+            out *= 1.0 / (f * f)
+            return out
+
+
+class PreviewViewer(object):
+    """
+    Viewer with the interface of *viewer* (show(), limits, calling gives a
+    coroutine) which passes frames through *transform* first. With an
+    *auto_contrast* callable the limits of the viewer follow its result.
+
+    The coroutine (e.g. a Consumer of the scan) only hands at most
+    *display_rate* frames per second to a display thread which does the rest,
+    so the acquisition does not wait for binning and contrast.
+    """
+
+    def __init__(self, viewer, transform=None, auto_contrast=None, display_rate=20.0):
+        self.log = None
+        self.viewer = viewer
+        self.transform = PreviewTransform() if transform is None else transform
+        self.auto_contrast = auto_contrast
+        self.display_rate = display_rate
+        self.latest = LatestFrame()
+        self.display_thread = threading.Thread(target=self.display)
+        self.display_thread.daemon = True
+        self.display_thread.start()
+
+    def display(self):
+        while True:
+            frame = self.latest.get(timeout=1.0)
+            if frame is None:
+                continue
+            try:
+                self.show(frame)
+            except Exception as exp:
+                # the display must outlive a bad frame
+                if self.log is not None:
+                    self.log.error(exp)
+
+    def set_limits_from(self, auto_contrast, frame):
+        limits = auto_contrast(frame)
+        if limits is None:
+            return
+        current = self.viewer.limits
+        if current != 'auto' and current is not None and len(current) == 2:
+            # the pyplot viewer sends every change to its process
+            tol = 0.01 * abs(current[1] - current[0])
+            if abs(limits[0] - current[0]) <= tol and \
+                    abs(limits[1] - current[1]) <= tol:
+                return
+        self.viewer.limits = [limits[0], limits[1]]
+
+    def show(self, frame, *args, **kwargs):
+        auto_contrast = self.auto_contrast
+        if auto_contrast is not None and frame.ndim == 2:
+            self.set_limits_from(auto_contrast, frame)
+        # viewers with a window of known size bin to that size
+        target_shape = getattr(self.viewer, 'target_shape', None)
+        if target_shape is not None and min(target_shape) > 0:
+            self.transform.target_shape = target_shape
+        self.viewer.show(self.transform(frame), *args, **kwargs)
+
+    @property
+    def limits(self):
+        return self.viewer.limits
+
+    @limits.setter
+    def limits(self, value):
+        self.viewer.limits = value
+
+    @coroutine
+    def __call__(self, *args, **kwargs):
+        shown = 0
+        while True:
+            frame = yield
+            if time.time() - shown >= 1.0 / self.display_rate:
+                shown = time.time()
+                # pooled buffers are reused by the camera while the frame waits
+                self.latest.put(detach(frame))
+
+    def __getattr__(self, name):
+        # everything else of the wrapped viewer
+        if name == 'viewer':
+            raise AttributeError(name)
+        return getattr(self.viewer, name)
@@ -0,0 +1,136 @@
+"""Image viewer drawing with QImage/QPixmap in the Qt event loop of the GUI"""
+
+import threading
+import numpy as np
+from PyQt5.QtCore import QObject, Qt, pyqtSignal, pyqtSlot
+from PyQt5.QtGui import QImage, QPixmap, qRgb
+from PyQt5.QtWidgets import QLabel, QSizePolicy
+from concert.coroutines.base import coroutine
+
+
+def colormap_table(name='gray'):
+    """256 qRgb values of matplotlib colormap *name*, gray without matplotlib"""
+    if name != 'gray':
+        try:
+            from matplotlib import cm
+            colors = (cm.get_cmap(name)(np.arange(256))[:, :3] * 255).astype(int)
+            return [qRgb(*c) for c in colors]
+        except (ImportError, ValueError):
+            pass
+    return [qRgb(i, i, i) for i in range(256)]
+
+
+class QtImageViewer(QObject):
+    """
+    Viewer with the interface of concert viewers (show(), limits, calling
+    gives a coroutine). show() may be called from any thread: it scales the
+    frame into 8-bit indices of a lookup-table colormap right there and only
+    asks the GUI thread to draw through a queued signal, widgets are only
+    touched there. Frames arriving while a drawing is pending replace the
+    pending one, so the GUI thread never falls behind the camera.
+    The window opens with the first frame; its size is available as
+    target_shape for automatic preview binning.
+    """
+
+    frame_ready_signal = pyqtSignal()
+
+    def __init__(self, title="Preview", colormap='gray'):
+        super(QtImageViewer, self).__init__()
+        self.widget = QLabel()
+        self.widget.setWindowTitle(title)
+        self.widget.setAlignment(Qt.AlignCenter)
+        self.widget.setMinimumSize(64, 64)
+        self.widget.setSizePolicy(QSizePolicy.Ignored, QSizePolicy.Ignored)
+        self.widget.resize(800, 800)
+        # size of the widget for other threads, updated by draw()
+        self._target_shape = (800, 800)
+        self.lut = colormap_table(colormap)
+        self._limits = 'auto'
+        self.lock = threading.Lock()
+        # one caller at a time fills a buffer (live view and scan may both show)
+        self.fill_lock = threading.Lock()
+        # three 8-bit buffers: one being drawn, one pending, one being filled
+        self.buffers = []
+        self.pending = None
+        self.drawing = None
+        self._scaled = None
+        self.shown = 0
+        self.drawn = 0
+        # explicitly queued, show() runs in the live view and scan threads
+        self.frame_ready_signal.connect(self.draw, Qt.QueuedConnection)
+
+    @property
+    def limits(self):
+        return self._limits
+
+    @limits.setter
+    def limits(self, value):
+        # 'auto' or (low, high)
+        self._limits = value
+
+    @property
+    def target_shape(self):
+        return self._target_shape
+
+    def _free_buffer(self, shape):
+        if not self.buffers or self.buffers[0].shape != shape:
+            # rows padded to 4 bytes as QImage wants them
+            width = shape[1] + (-shape[1]) % 4
+            self.buffers = [np.zeros((shape[0], width), dtype=np.uint8)[:, :shape[1]]
+                            for i in range(3)]
+            self._scaled = np.empty(shape, dtype=np.float32)
+            self.pending = None
+        for i in range(len(self.buffers)):
+            if i != self.pending and i != self.drawing:
+                return i
+
+    def show(self, frame, *args, **kwargs):
+        if self._limits == 'auto' or self._limits is None:
+            low, high = float(frame.min()), float(frame.max())
+        else:
+            low, high = [float(x) for x in self._limits]
+        with self.fill_lock:
+            with self.lock:
+                index = self._free_buffer(frame.shape)
+                scaled = self._scaled
+                buffer = self.buffers[index]
+            # draw() only holds *lock* briefly, it does not wait for the scaling
+            np.subtract(frame, low, out=scaled, dtype=np.float32)
+            scaled *= 255.0 / (high - low) if high > low else 0.0
+            np.clip(scaled, 0, 255, out=scaled)
+            buffer[...] = scaled
+            with self.lock:
+                notify = self.pending is None
+                self.pending = index
+                self.shown += 1
+        if notify:
+            # queued to the GUI thread when called from another thread
+            self.frame_ready_signal.emit()
+
+    @pyqtSlot()
+    def draw(self):
+        with self.lock:
+            if self.pending is None:
+                return
+            self.drawing, self.pending = self.pending, None
+            data = self.buffers[self.drawing]
+        height, width = data.shape
+        image = QImage(data.base.data, width, height, data.strides[0],
+                       QImage.Format_Indexed8)
+        image.setColorTable(self.lut)
+        # fromImage copies, the buffer is free again afterwards
+        pixmap = QPixmap.fromImage(image).scaled(self.widget.size(), Qt.KeepAspectRatio,
+                                                 Qt.FastTransformation)
+        with self.lock:
+            self.drawing = None
+        self._target_shape = (self.widget.height(), self.widget.width())
+        self.widget.setPixmap(pixmap)
+        self.drawn += 1
+        if not self.widget.isVisible():
+            self.widget.show()
+
+    @coroutine
+    def __call__(self, *args, **kwargs):
+        while True:
+            frame = yield
+            self.show(frame)
@@ -0,0 +1,118 @@
+"""TIFF writing decoupled from grabbing by a bounded queue and writer threads"""
+
+import threading
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+from concert.storage import write_tiff
+from concert.writers import TiffWriter
+from frame_pool import hold, release
+
+
+class QueuedTiffWriter(object):
+    """
+    Writes frames in background threads fed through a bounded queue.
+    With bytes_per_file > 0 frames go in order into (big)tiff files written
+    by one thread, otherwise every frame is a separate file named
+    filename.format(index) and a pool of threads encodes and writes them.
+    put() blocks while the queue holds max_bytes of frames, so memory use
+    stays bounded and the camera read-out is slowed down to the disk speed.
+    """
+
+    def __init__(self, filename, bytes_per_file=0, num_threads=4, max_bytes=2**30):
+        self.log = None
+        self.filename = filename
+        self.bytes_per_file = bytes_per_file
+        self.num_threads = 1 if bytes_per_file > 0 else max(int(num_threads), 1)
+        self.max_bytes = max_bytes
+        self.queue = None
+        self.threads = []
+        self.count = 0
+        self.written = 0
+        self.max_depth = 0
+        self.error = None
+        self.lock = threading.Lock()
+
+    def _start(self, frame):
+        self.queue = Queue(maxsize=max(2, self.max_bytes // frame.nbytes))
+        target = self._write_sequence if self.bytes_per_file > 0 else self._write_files
+        for i in range(self.num_threads):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, frame):
+        if self.error is not None:
+            raise self.error
+        if self.queue is None:
+            self._start(frame)
+        # pooled frames must not be overwritten before they are written
+        self.queue.put((self.count, hold(frame)))
+        self.count += 1
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    @property
+    def depth(self):
+        return 0 if self.queue is None else self.queue.qsize()
+
+    def _failed(self, exp):
+        if self.log is not None:
+            self.log.error(exp)
+            self.log.error("Writer thread failed, frames are being dropped")
+        self.error = exp
+
+    def _write_files(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            index, frame = item
+            if self.error is not None:
+                # keep draining so that put() does not block forever
+                release(frame)
+                continue
+            try:
+                write_tiff(self.filename.format(index), frame)
+                with self.lock:
+                    self.written += 1
+            except Exception as exp:
+                self._failed(exp)
+            finally:
+                release(frame)
+
+    def _write_sequence(self):
+        wrtr = None
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                if self.error is not None:
+                    release(item[1])
+                    continue
+                try:
+                    if wrtr is None:
+                        wrtr = TiffWriter(self.filename,
+                                          bytes_per_file=self.bytes_per_file)
+                    wrtr.write(item[1])
+                    self.written += 1
+                except Exception as exp:
+                    self._failed(exp)
+                finally:
+                    release(item[1])
+        finally:
+            if wrtr is not None:
+                wrtr.close()
+
+    def close(self):
+        """Wait until all queued frames are written"""
+        if self.queue is None:
+            return
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.queue = None
@@ -0,0 +1,89 @@
+"""Streaming of frames into a memory-mapped raw file"""
+
+import json
+import os
+import threading
+import time
+import numpy as np
+from concert.coroutines.base import coroutine
+
+
+class RawStreamWriter(object):
+    """
+    Consumer which copies frames into a large preallocated file mapped with
+    numpy memmap, without per-frame headers or file creation. The file is
+    created in the current directory of *walker* when the acquisition starts
+    and truncated to the frames actually written by close(); a JSON sidecar
+    <fname>.json describes shape, dtype, count and time stamps of the frames.
+    Read it back with np.memmap(fname, dtype, 'r', shape=(count,) + shape).
+    """
+
+    def __init__(self, walker, fname='frames.raw', max_bytes=2**40):
+        self.log = None
+        self.walker = walker
+        self.fname = fname
+        # upper limit of the file size, free disk space limits it as well
+        self.max_bytes = max_bytes
+        self.path = None
+        self.mm = None
+        self.capacity = 0
+        self.count = 0
+        self.stamps = []
+        self.lock = threading.Lock()
+
+    def _open(self, frame):
+        directory = self.walker.current
+        self.path = os.path.join(directory, self.fname)
+        stat = os.statvfs(directory)
+        free = stat.f_bavail * stat.f_frsize
+        self.capacity = int(min(self.max_bytes, 0.95 * free) // frame.nbytes)
+        if self.capacity < 1:
+            raise IOError("No space left for raw stream in {}".format(directory))
+        self.mm = np.memmap(self.path, dtype=frame.dtype, mode='w+',
+                            shape=(self.capacity,) + frame.shape)
+        self.count = 0
+        self.stamps = []
+        if self.log is not None:
+            self.log.info("Streaming up to {} frames into {}".format(
+                self.capacity, self.path))
+
+    def write(self, frame):
+        with self.lock:
+            if self.mm is None:
+                self._open(frame)
+            if self.count >= self.capacity:
+                if self.count == self.capacity and self.log is not None:
+                    self.log.warning("Raw stream file is full, frames are dropped")
+                self.count = self.capacity + 1
+                return
+            self.mm[self.count] = frame
+            self.stamps.append(time.time())
+            self.count += 1
+
+    @coroutine
+    def __call__(self):
+        self.close()
+        while True:
+            frame = yield
+            self.write(frame)
+
+    def close(self):
+        """Flush, truncate the file to the written frames and write the sidecar"""
+        with self.lock:
+            if self.mm is None:
+                return
+            count = min(self.count, self.capacity)
+            shape = self.mm.shape[1:]
+            dtype = self.mm.dtype
+            self.mm.flush()
+            # unmap before truncating
+            self.mm = None
+            with open(self.path, 'r+b') as f:
+                f.truncate(count * int(np.prod(shape)) * dtype.itemsize)
+            meta = {'shape': list(shape), 'dtype': dtype.str, 'count': count,
+                    'timestamps': self.stamps[:count]}
+            with open(self.path + '.json', 'w') as f:
+                json.dump(meta, f)
+            if self.log is not None:
+                self.log.info("Raw stream closed: {} frames in {}".format(
+                    count, self.path))
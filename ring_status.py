@@ -92,6 +92,7 @@ class EpicsMonitor(QObject):
 
     def __init__(self):
         super(EpicsMonitor, self).__init__()
+        self.value = None
         self.i0 = PV(I0_PV, callback=self.on_i0_state_changed)
 
     def on_i0_state_changed(self, value, **kwargs):
@@ -100,6 +101,7 @@ class EpicsMonitor(QObject):
         :param kwargs: the rest of arguments
         :return: None
         """
+        self.value = value
         self.i0_state_changed_signal.emit("{:.1f}".format(value))
 
 
@@ -107,6 +109,7 @@ TOPUP_TIMER_PV = "TRG2400:topup:timer"
 
 class CountdownMonitor(QObject):
     i0_state_changed_signal = pyqtSignal(str)
+    i0_state_changed_signal2 = pyqtSignal(float)
 
     def __init__(self):
         super(CountdownMonitor, self).__init__()
@@ -114,6 +117,7 @@ class CountdownMonitor(QObject):
 
     def on_state_changed(self, value, **kwargs):
         self.i0_state_changed_signal.emit("{}".format(value))
+        self.i0_state_changed_signal2.emit(value)
 
 
 ID_VETO_PV = "TRG1605-1-I20-01:topup:veto"
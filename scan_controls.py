@@ -9,7 +9,7 @@ class ScanControlsGroup(QGroupBox):
     Camera controls
     """
 
-    def __init__(self, start_button, abort_button, return_button,
+    def __init__(self, start_button, abort_button, return_button, resume_button,
                  scan_fps_entry,
                  motor_inner, motor_outer, *args, **kwargs):
         super(ScanControlsGroup, self).__init__(*args, **kwargs)
@@ -22,6 +22,7 @@ class ScanControlsGroup(QGroupBox):
         self.start_button = start_button
         self.abort_button = abort_button
         self.return_button = return_button
+        self.resume_button = resume_button
 
         # "Table headers"
         self.motor_label = QLabel()
@@ -92,6 +93,18 @@ class ScanControlsGroup(QGroupBox):
         self.DimaxAccuTTLsLabel.setText("For Dimax only")
         self.readout_intheend = QCheckBox("Readout in the end")
         self.readout_intheend.setEnabled(False)
+        # Dimax: move outer motor while camera memory is read out
+        self.pipelined_readout = QCheckBox("Move outer motor during readout")
+        self.pipelined_readout.setChecked(False)
+        # software trigger: move to the next angle while the frame is read out
+        self.pipelined_step = QCheckBox("Move during readout (soft trig)")
+        self.pipelined_step.setChecked(False)
+        # time between software trigger and start of exposure, user's estimate
+        self.trigger_latency_label = QLabel()
+        self.trigger_latency_label.setText("Trigger latency [ms]")
+        self.trigger_latency_entry = QLineEdit()
+        self.trigger_latency_entry.setText('10')
+        self.trigger_latency_entry.setFixedWidth(50)
 
         # delayed start
         self.delay_start_label = QLabel()
@@ -120,7 +133,12 @@ class ScanControlsGroup(QGroupBox):
         layout.addWidget(self.return_button, 0, 4, 1, 2)
         layout.addWidget(self.delay_start_label, 0, 6)
         layout.addWidget(self.delay_start_entry, 0, 7)
+        layout.addWidget(self.pipelined_readout, 0, 8)
         layout.addWidget(self.readout_intheend, 0, 9)
+        layout.addWidget(self.pipelined_step, 0, 10)
+        layout.addWidget(self.resume_button, 0, 11)
+        layout.addWidget(self.trigger_latency_label, 0, 12)
+        layout.addWidget(self.trigger_latency_entry, 0, 13)
 
         # Top labels
         layout.addWidget(self.motor_label, 1, 1)
@@ -358,8 +376,31 @@ class ScanControlsGroup(QGroupBox):
     def ffc_after_outer(self):
         return self.outer_loop_flats_1.isChecked()
 
+    @property
+    def pipelined(self):
+        return self.pipelined_readout.isChecked()
+
+    @property
+    def pipelined_softr(self):
+        return self.pipelined_step.isChecked()
+
+    @property
+    def trigger_latency(self):
+        # [s]
+        try:
+            x = float(self.trigger_latency_entry.text())
+        except ValueError:
+            x = -1
+        if x < 0:
+            error_message("Trigger latency must be non-negative number")
+            self.input_correct = False
+            return 0.0
+        return x / 1000.0
+
     def ena_disa_all_entries(self, v=True):
         self.readout_intheend.setEnabled(v)
+        self.pipelined_readout.setEnabled(v)
+        self.pipelined_step.setEnabled(v)
         self.outer_loop_motor.setEnabled(v)
         self.outer_loop_flats_0.setEnabled(v)
         self.outer_loop_start_entry.setEnabled(v)
@@ -1,8 +1,10 @@
 """CT scans with the ufo-kit Concert"""
 
+import os
 import time
 import numpy as np
 import atexit
+import threading
 from time import sleep
 from concert.quantities import q
 from concert.experiments.base import Acquisition, Experiment
@@ -10,6 +12,36 @@ from PyQt5.QtCore import QThread, pyqtSignal
 from concert.experiments.addons import Consumer, ImageWriter, OnlineReconstruction
 from concert.ext.ufo import (GeneralBackprojectArgs, GeneralBackprojectManager)
 from message_dialog import info_message, error_message
+from frame_pool import FramePool
+from ffc_average import FlatDarkAverage
+from timing import FrameTimer
+from pco_timestamp import TimestampChecker
+from topup import TopUpScheduler
+from metadata import FrameMetadata
+
+
+class ScanExperiment(Experiment):
+    """Experiment which remembers the directory its walker descended to for
+    the current run, i.e. the directory of the scan. Scans are numbered from
+    *first_iteration* (e.g. the next free index of the catalog) if it is
+    above the first free one Experiment finds."""
+
+    def __init__(self, *args, **kwargs):
+        first_iteration = kwargs.pop('first_iteration', None)
+        super(ScanExperiment, self).__init__(*args, **kwargs)
+        if first_iteration is None or self.walker is None or \
+                not kwargs.get('separate_scans', True):
+            first_iteration = None
+        if first_iteration is not None and first_iteration > self.iteration:
+            self.iteration = first_iteration
+            # a stale catalog must not lead to overwriting
+            while self.walker.exists(self.name_fmt.format(self.iteration)):
+                self.iteration += 1
+        self.scan_dir = None
+
+    def prepare(self):
+        super(ScanExperiment, self).prepare()
+        self.scan_dir = None if self.walker is None else self.walker.current
 
 
 class ConcertScanThread(QThread):
@@ -24,6 +56,8 @@ class ConcertScanThread(QThread):
 
     scan_finished_signal = pyqtSignal()
     data_changed_signal = pyqtSignal(str)
+    # emitted in pipelined mode when motors are free but read-out still goes on
+    recording_done_signal = pyqtSignal()
 
     def __init__(self, viewer, camera):
         super(ConcertScanThread, self).__init__()
@@ -32,15 +66,29 @@ class ConcertScanThread(QThread):
         self.ffc_setup = FFCsetup()
         # Collection of acquisitions we create it once
         self.acq_setup = ACQsetup(self.camera, self.ffc_setup, self.viewer)
+        self.acq_setup.recording_done_callback = self.recording_done_signal.emit
         self.exp = None  # That is experiment. We create it each time before run is pressed
         # before that all camera, acquisition, and ffc parameters must be set according to the
         # user input and consumers must be attached
         self.cons_viewer = None
+        # FrameStatistics of the camera controls, fed with scan frames
+        self.frame_stats = None
+        self.cons_stats = None
         self.walker = None
         self.cons_writer = None
+        # averaged flats/darks of the last scan, published in memory
+        self.ffc_average = FlatDarkAverage()
+        self.cons_ffc_average = []
+        # per-frame metadata next to the data: column -> callable giving its value
+        self.metadata_sources = {}
+        self.commanded_angles = None
+        self.cons_metadata = []
         self.thread_running = True
         atexit.register(self.stop)
-        self.starting_scan = False
+        # start requests and experiment completion are both signalled
+        # through this condition instead of polling
+        self.scan_condition = threading.Condition()
+        self.scan_requested = False
         self.running_experiment = None
         self.log = None
         #online reconstruction
@@ -49,52 +97,135 @@ class ConcertScanThread(QThread):
         self.manager = None
 
 
-    def create_experiment(self, acquisitions, ctsetname, sep_scans):
-        self.exp = Experiment(
+    def create_experiment(self, acquisitions, ctsetname, sep_scans,
+                          first_iteration=None):
+        self.exp = ScanExperiment(
             acquisitions=acquisitions,
             walker=self.walker,
             separate_scans=sep_scans,
             name_fmt=ctsetname,
+            first_iteration=first_iteration,
         )
+        # acquisitions dump their timing profiles next to the data
+        self.acq_setup.walker = self.walker
+
+    @property
+    def scan_dir(self):
+        return None if self.exp is None else self.exp.scan_dir
+
+    def data_dirs(self, name):
+        """Directories the writer put frames of acquisition *name* of the last
+        scan in, one per root for striped writing, none for HDF5 files"""
+        if self.scan_dir is None:
+            return []
+        path = os.path.join(self.scan_dir, name)
+        roots = getattr(self.walker, 'roots', None)
+        if roots:
+            rel = os.path.relpath(path, roots[0])
+            paths = [os.path.join(root, rel) for root in roots]
+        else:
+            paths = [path]
+        return [p for p in paths if os.path.isdir(p)]
 
     def attach_writer(self, async=False):
+        # concert's asynchronous writer queues frames without holding them,
+        # grab into new arrays then
+        self.acq_setup.frame_pool.enabled = not async
         self.cons_writer = ImageWriter(self.exp.acquisitions, self.walker, async=async)
 
     def attach_viewer(self):
         self.cons_viewer = Consumer(self.exp.acquisitions, self.viewer)
 
+    def attach_stats(self):
+        # acquisitions are reused between scans, do not attach twice
+        if self.cons_stats is not None:
+            self.cons_stats.detach()
+            self.cons_stats = None
+        # flats and darks would only hide the statistics of the sample
+        acqs = [a for a in self.exp.acquisitions
+                if a.name not in ("flats", "flats2", "darks")]
+        if self.frame_stats is not None and acqs:
+            self.cons_stats = Consumer(acqs, self.frame_stats)
+
+    def attach_ffc_average(self):
+        # acquisitions are reused between scans, do not attach twice
+        for cons in self.cons_ffc_average:
+            cons.detach()
+        self.cons_ffc_average = []
+        flats = [a for a in self.exp.acquisitions if a.name == "flats"]
+        flats2 = [a for a in self.exp.acquisitions if a.name == "flats2"]
+        darks = [a for a in self.exp.acquisitions if a.name == "darks"]
+        if flats:
+            self.cons_ffc_average.append(Consumer(flats, self.ffc_average.flat))
+        if flats2:
+            self.cons_ffc_average.append(Consumer(flats2, self.ffc_average.flat2))
+        if darks:
+            self.cons_ffc_average.append(Consumer(darks, self.ffc_average.dark))
+
+    def attach_metadata(self):
+        # acquisitions are reused between scans, do not attach twice
+        self.close_metadata()
+        for cons, recorder in self.cons_metadata:
+            cons.detach()
+        self.cons_metadata = []
+        for acq in self.exp.acquisitions:
+            angles = self.commanded_angles if acq.name == "tomo" else None
+            recorder = FrameMetadata(acq.name, self.walker, self.metadata_sources,
+                                     angles)
+            recorder.log = self.log
+            self.cons_metadata.append((Consumer([acq], recorder), recorder))
+
+    def close_metadata(self):
+        for cons, recorder in self.cons_metadata:
+            recorder.close()
+
     def stop(self):
-        self.thread_running = False
+        with self.scan_condition:
+            self.thread_running = False
+            self.scan_condition.notify_all()
         self.wait()
 
     def run(self):  # .start() calls this function
-        while self.thread_running:
-            if self.starting_scan:
+        while True:
+            with self.scan_condition:
+                while self.thread_running and not self.scan_requested:
+                    self.scan_condition.wait()
+                if not self.thread_running:
+                    return
+                self.scan_requested = False
                 self.running_experiment = self.exp.run()
-                self.starting_scan = False
-            else:
-                sleep(1)
-                self.check_scan_state()
-
-    def check_scan_state(self):
-        if self.running_experiment is not None:
-            try:
-                if self.running_experiment.done():
-                    self.detach_and_del_writer()
-                    self.scan_finished_signal.emit()
-                    self.running_experiment = None
-                    self.log.debug("Experiment done in Concert thread")
-            except:
-                pass
+                future = self.running_experiment
+            # called immediately if the experiment is already over
+            future.add_done_callback(self.check_scan_state)
+
+    def check_scan_state(self, future):
+        # runs in the thread which finished the experiment future
+        with self.scan_condition:
+            if future is not self.running_experiment:
+                # aborted or superseded, nobody waits for this one
+                return
+            self.running_experiment = None
+        try:
+            self.detach_and_del_writer()
+            self.scan_finished_signal.emit()
+            self.log.debug("Experiment done in Concert thread")
+        except:
+            pass
 
     def start_scan(self):
-        self.starting_scan = True
+        with self.scan_condition:
+            self.scan_requested = True
+            self.scan_condition.notify_all()
 
     def abort_scan(self):
         try:
             #self.exp.abort()
+            with self.scan_condition:
+                # forget the future first so that its done-callback
+                # does not report the aborted scan as finished
+                self.scan_requested = False
+                self.running_experiment = None
             self.delete_exp()
-            self.running_experiment = None
             self.log.debug("Abort scan executed correctly in Concert thread")
         except:
             pass
@@ -104,6 +235,10 @@ class ConcertScanThread(QThread):
             self.cons_writer.detach()
             #del self.cons_writer
             self.cons_writer = None
+        self.close_metadata()
+        # HDF5 files are closed after every scan so that data can be read
+        if getattr(self.walker, 'close', None) is not None:
+            self.walker.close()
 
     def delete_exp(self):
         try:
@@ -115,6 +250,7 @@ class ConcertScanThread(QThread):
             if self.walker is not None:
                 #del self.walker
                 self.walker = None
+                self.acq_setup.walker = None
             #del self.exp
             self.exp = None
             self.args = None
@@ -133,10 +269,20 @@ class ConcertScanThread(QThread):
         if self.args is None:
             self.log.debug('Args for online reconstruction not set')
             return
+        # flats are not acquired in every scan of the outer loop, the manager
+        # gets the ones averaged in memory during an earlier scan instead of
+        # waiting for flats/darks streams
+        names = [a.name for a in self.exp.acquisitions]
+        from_memory = "flats" not in names and self.ffc_average.ready and \
+            self.ffc_average.dark.ready
         self.manager = GeneralBackprojectManager(self.args)
         # This is the addon
-        self.reco = OnlineReconstruction(self.exp, self.args,
-                            consumer=self.viewer(), process_normalization=True)
+        self.reco = OnlineReconstruction(self.exp, self.args, consumer=self.viewer(),
+                                         process_normalization=not from_memory)
+        if from_memory:
+            self.log.debug('Using averaged flat/dark from memory for online reco')
+            self.reco.manager.flat = self.ffc_average.flat.average
+            self.reco.manager.dark = self.ffc_average.dark.average
         self.reco.manager.copy_inputs = True
         self.reco.manager.projection_sleep_time = 0 * q.s
         self.reco.walker = self.walker
@@ -199,14 +345,40 @@ class ACQsetup(object):
         self.exp = None
         self.top_up_veto_enabled = False
         self.top_up_veto_state = False
+        # holds off acquisition blocks which would be hit by injection
+        self.topup = TopUpScheduler()
         self.message_entry = None
 
+        # step-and-shoot: move to the next angle while the frame is read out
+        self.pipelined_softr = False
+        # delay between software trigger and start of exposure [s]; not
+        # measured, an estimate entered in scan controls (10 ms by default)
+        self.trigger_latency = 0.01
+
+        # Dimax: let the GUI move outer motor while camera memory is read out
+        self.pipelined_readout = False
+        self.recording_done_callback = None
+
         # TWO Variable to be read directly from GUI entries when camera is not connected
         self.ttl_exp_time = None
         self.ttl_dead_time = None
 
         self.glob_tmp = 0
 
+        # preallocated buffers for the on-the-fly grab loops
+        self.frame_pool = FramePool()
+
+        # per-frame timing of acquisitions, saved into current walker directory
+        self.walker = None
+        self.fps = None
+        self.timer = None
+        # name, frames, duration, fps and directory of acquisitions of the scan
+        self.acq_records = []
+
+        # frame-loss detection from PCO binary time stamps
+        self.check_timestamps = False
+        self.stamp_check = TimestampChecker()
+
     # HELPER FUNCTIONS
 
     def calc_step(self):
@@ -219,6 +391,67 @@ class ACQsetup(object):
         self.region *= self.units
         self.step = self.region[1] - self.region[0]
 
+    def prepare_frame_pool(self):
+        # must be called after ROI is set, buffers have the shape of the frame
+        self.frame_pool.log = self.log
+        try:
+            self.frame_pool.allocate((self.camera.roi_height.magnitude,
+                                      self.camera.roi_width.magnitude), self.nsteps)
+        except Exception as exp:
+            self.log.error(exp)
+            self.log.error("Cannot allocate frame buffers, grabbing into new arrays")
+            self.frame_pool.clear()
+
+    def recording_done(self):
+        # frames are in camera memory and the CT stage is on its way back,
+        # nothing but the read-out keeps the hardware busy any longer
+        if self.pipelined_readout and self.recording_done_callback is not None:
+            self.log.debug("Recording done, reading out while outer motor moves")
+            self.recording_done_callback()
+
+    def frame_period(self):
+        # rough duration of one frame [s] for scheduling around injections
+        period = (self.exp_time + self.dead_time) / 1000.0 + self.trigger_latency
+        if self.fps:
+            period = max(period, 1.0 / self.fps)
+        return period
+
+    def wait_for_injection(self, duration, what):
+        self.topup.log = self.log
+        self.topup.wait_for_window(duration, what)
+
+    def start_timer(self, name, nframes):
+        self.timer = FrameTimer(name, nframes)
+        return self.timer
+
+    def finish_timer(self):
+        if self.timer is None:
+            return
+        self.acq_records.append({
+            'name': self.timer.name, 'frames': self.timer.count,
+            'duration': time.time() - self.timer.t0, 'fps': self.timer.effective_fps()})
+        try:
+            for line in self.timer.summary(self.fps):
+                self.log.info(line)
+            # HDF5 walker has no directories to put the profile in
+            if self.walker is not None and os.path.isdir(self.walker.current):
+                self.log.debug("Timing profile saved to {}".format(
+                    self.timer.save(self.walker.current, self.fps)))
+        except Exception as exp:
+            self.log.error(exp)
+            self.log.error("Cannot save timing profile of {}".format(self.timer.name))
+        self.timer = None
+
+    def start_stamp_check(self):
+        if self.check_timestamps:
+            self.stamp_check.log = self.log
+            self.stamp_check.reset(self.nsteps)
+
+    def finish_stamp_check(self):
+        if self.check_timestamps:
+            for line in self.stamp_check.summary(self.fps):
+                self.log.info(line)
+
     # Use software trigger
     def take_darks_softr(self):
         self.log.info("Starting acquisition: darks")
@@ -239,15 +472,21 @@ class ACQsetup(object):
             self.log.error(
                 "Something is wrong with setting camera params for take_darks_softr"
             )
+        timer = self.start_timer("darks", self.num_darks)
         try:
             for i in range(self.num_darks):
                 self.camera.trigger()
-                yield self.camera.grab()
+                timer.lap('trigger')
+                frame = self.camera.grab()
+                timer.lap('grab')
+                yield frame
+                timer.done()
         except Exception as exp:
             self.log.error(exp)
             self.log.error("Something is wrong in take_darks_softr")
         finally:
             self.camera.stop_recording()
+            self.finish_timer()
             self.log.info("Acquired darks")
 
     def take_flats_softr(self):
@@ -270,15 +509,22 @@ class ACQsetup(object):
             self.log.error(
                 "Something is wrong with setting camera params in take_flats_softr"
             )
+        self.wait_for_injection(self.num_flats * self.frame_period(), "flats")
+        timer = self.start_timer("flats", self.num_flats)
         try:
             for i in range(self.num_flats):
                 self.camera.trigger()
-                yield self.camera.grab()
+                timer.lap('trigger')
+                frame = self.camera.grab()
+                timer.lap('grab')
+                yield frame
+                timer.done()
         except Exception as exp:
             self.log.error(exp)
             self.log.error("Something is wrong during acquisition of flats")
         finally:
             self.camera.stop_recording()
+            self.finish_timer()
             self.ffcsetup.close_shutter()
             self.ffcsetup.prepare_radios()
             self.log.info("Acquired flats")
@@ -302,19 +548,28 @@ class ACQsetup(object):
         except Exception as exp:
             self.log.error(exp)
             self.log.error("Something is wrong in preparations for tomo_softr")
+        timer = self.start_timer("tomo", len(self.region))
         try:
-            for pos in self.region:
-                # while True:
-                #    if self.top_up_veto_state:
-                #        sleep(0.1)
-                #    else:
-                self.motor["position"].set(pos).join()
-                self.camera.trigger()
-                yield self.camera.grab()
-                #        break
+            if self.pipelined_softr:
+                for frame in self.tomo_softr_pipelined(timer):
+                    yield frame
+            else:
+                for pos in self.region:
+                    self.motor["position"].set(pos).join()
+                    timer.lap('move')
+                    self.wait_for_injection(self.frame_period(), "projection")
+                    timer.start()
+                    self.camera.trigger()
+                    timer.lap('trigger')
+                    frame = self.camera.grab()
+                    timer.lap('grab')
+                    yield frame
+                    timer.done()
         except Exception as exp:
             self.log.error(exp)
             self.log.error("Something is wrong during tomo_softr")
+        finally:
+            self.finish_timer()
         try:
             self.ffcsetup.close_shutter()
             if self.camera.state == "recording":
@@ -327,6 +582,32 @@ class ACQsetup(object):
             self.log.error(exp)
             self.log.error("Something is wrong in final in tomo_softr")
 
+    def tomo_softr_pipelined(self, timer):
+        """Step-and-shoot which starts motion to the next angle as soon as
+        exposure is over, while the frame is still being read out and consumed.
+        Motion is always finished before the next trigger.
+        Time spent waiting for the stage is recorded as 'move' phase."""
+        exposure = self.exp_time / 1000.0 + self.trigger_latency
+        move = self.motor["position"].set(self.region[0])
+        try:
+            for i in range(len(self.region)):
+                move.join()
+                timer.lap('move')
+                self.wait_for_injection(self.frame_period(), "projection")
+                timer.start()
+                self.camera.trigger()
+                sleep(exposure)
+                if i + 1 < len(self.region):
+                    move = self.motor["position"].set(self.region[i + 1])
+                timer.lap('trigger')
+                frame = self.camera.grab()
+                timer.lap('grab')
+                yield frame
+                timer.done()
+        finally:
+            # do not leave stage moving if acquisition was interrupted
+            move.join()
+
     def take_softr_timelaps(self):
 
         self.log.info("Starting acqusition of images eveny x seconds")
@@ -337,10 +618,20 @@ class ACQsetup(object):
         self.camera.trigger_source = self.camera.trigger_sources.SOFTWARE
         self.camera.start_recording()
         sleep(0.01)
-        for i in range(self.nsteps):
-            self.camera.trigger()
-            yield self.camera.grab()
-            sleep(self.step.magnitude)
+        timer = self.start_timer("radios", self.nsteps)
+        try:
+            for i in range(self.nsteps):
+                self.wait_for_injection(self.frame_period(), "radiogram")
+                timer.start()
+                self.camera.trigger()
+                timer.lap('trigger')
+                frame = self.camera.grab()
+                timer.lap('grab')
+                yield frame
+                timer.done()
+                sleep(self.step.magnitude)
+        finally:
+            self.finish_timer()
         self.camera.stop_recording()
 
 
@@ -351,14 +642,29 @@ class ACQsetup(object):
 
         self.camera.buffered = True
         self.prep4ext_trig_scan_with_PSO()
+        self.prepare_frame_pool()
         self.camera.start_recording()
         sleep(0.01)
+        self.wait_for_injection(self.nsteps * (self.exp_time + self.dead_time) / 1000.0,
+                                "rotation")
         self.log.info("Sending PSO command")
         self.motor.PSO_multi(False)
         sleep(0.5) # EPICS delays? shouldn't matter for grab, but just in case
         self.log.info("Starting read-out from libuca buffer")
-        for i in range(self.nsteps):
-            yield self.camera.grab()
+        timer = self.start_timer("tomo", self.nsteps)
+        self.start_stamp_check()
+        try:
+            for i in range(self.nsteps):
+                frame = self.frame_pool.grab(self.camera)
+                timer.lap('grab')
+                if self.check_timestamps:
+                    frame = self.stamp_check.check(frame)
+                yield frame
+                timer.done()
+        finally:
+            self.frame_pool.finish()
+            self.finish_timer()
+        self.finish_stamp_check()
         self.log.info("Read-out done; finilizing acquisition")
         self.camera.stop_recording()
         self.ffcsetup.close_shutter()
@@ -375,6 +681,8 @@ class ACQsetup(object):
         try:
             self.camera.start_recording()
             sleep(0.01)
+            self.wait_for_injection(
+                self.nsteps * (self.exp_time + self.dead_time) / 1000.0, "rotation")
             self.motor.PSO_multi(False)
             #self.motor["state"].wait("moving", sleep_time=0.1, timeout=10)
             while self.motor.state == "standby":
@@ -396,9 +704,19 @@ class ACQsetup(object):
             return
         self.ffcsetup.close_shutter()
         self.return_ct_stage_to_start(block=False)
+        self.recording_done()
+        self.prepare_frame_pool()
         self.camera.uca.start_readout()
-        for i in range(self.nsteps):
-            yield self.camera.grab()
+        timer = self.start_timer("tomo", self.nsteps)
+        try:
+            for i in range(self.nsteps):
+                frame = self.frame_pool.grab(self.camera)
+                timer.lap('grab')
+                yield frame
+                timer.done()
+        finally:
+            self.frame_pool.finish()
+            self.finish_timer()
         self.camera.uca.stop_readout()
         while self.motor.state == "moving":
             sleep(0.5)
@@ -423,14 +741,26 @@ class ACQsetup(object):
         self.log.debug("time to sleep for scan: {}".format(sleep_time))
         self.log.debug("Velocity: {}, Range: {}".format(velocity, self.range))
         self.motor["velocity"].set(velocity).join()
+        # stage spins at constant speed, recording starts when whole rotation fits
+        self.wait_for_injection(sleep_time, "rotation")
         with self.camera.recording():
             time.sleep(self.nsteps / float(self.camera.frame_rate.magnitude) * 1.05)
         self.ffcsetup.close_shutter()
         self.motor.stop().join()
         self.return_ct_stage_to_start(block=False)
+        self.recording_done()
+        self.prepare_frame_pool()
         self.camera.uca.start_readout()
-        for i in range(self.nsteps):
-            yield self.camera.grab()
+        timer = self.start_timer("tomo", self.nsteps)
+        try:
+            for i in range(self.nsteps):
+                frame = self.frame_pool.grab(self.camera)
+                timer.lap('grab')
+                yield frame
+                timer.done()
+        finally:
+            self.frame_pool.finish()
+            self.finish_timer()
         self.camera.uca.stop_readout()
         while self.motor.state == "moving":
             sleep(0.5)
@@ -452,17 +782,31 @@ class ACQsetup(object):
             self.log.error("Cannot open shutter")
         if self.camera.buffered:
             self.camera.num_buffers = self.nsteps * 1.5
+        self.prepare_frame_pool()
         self.motor["velocity"].set(velocity).join()
         #time.sleep(1) # what is it for? Must proceed as soon as speed is constant
         #there must be signal from stage that it covered the 180/360 degrees
         #and as soon as it happens stage must be stopped and shutter closed
         #but grab cycle must go on at the same time
+        self.wait_for_injection(
+            self.nsteps / float(self.camera.frame_rate.magnitude), "rotation")
         try:
             with self.camera.recording():
+                timer = self.start_timer("tomo", self.nsteps)
+                self.start_stamp_check()
                 for i in range(self.nsteps):
-                    yield self.camera.grab()
+                    frame = self.frame_pool.grab(self.camera)
+                    timer.lap('grab')
+                    if self.check_timestamps:
+                        frame = self.stamp_check.check(frame)
+                    yield frame
+                    timer.done()
         except:
             self.log.exception('Error during data acquisition')
+        finally:
+            self.frame_pool.finish()
+            self.finish_timer()
+        self.finish_stamp_check()
         #self.viewer.limits = [-1e-3, 2e-3]
         self.ffcsetup.close_shutter()
         self.motor.stop().join()
@@ -624,8 +968,15 @@ class ACQsetup(object):
             with self.camera.recording():
                 sleep(2.0)
         self.camera.uca.start_readout()
-        for i in range(self.nsteps):
-            yield self.camera.grab()
+        timer = self.start_timer("seq", self.nsteps)
+        try:
+            for i in range(self.nsteps):
+                frame = self.camera.grab()
+                timer.lap('grab')
+                yield frame
+                timer.done()
+        finally:
+            self.finish_timer()
         self.camera.uca.stop_readout()
 
 
@@ -0,0 +1,673 @@
+"""
+Simulated beamline: in-process stand-ins for UcaCamera, ABRS, CLSLinear and
+CLSShutter with realistic timing, to run acquisitions without hardware
+"""
+
+import bisect
+import ctypes
+import threading
+import time
+import numpy as np
+from concert.async import async
+from concert.base import Quantity, State
+from concert.quantities import q
+from concert.devices.cameras import base as camera_base
+from concert.devices.cameras.base import CameraError
+from concert.devices.motors import base as motor_base
+from concert.devices.shutters import base as shutter_base
+
+
+# sensor size, time to read out one line [s], internal memory [bytes],
+# transfer rate of the internal memory to the host [bytes/s]
+CAMERA_MODELS = {
+    "PCO Edge": dict(sensor=(2560, 2160), line_time=4.63e-6, memory=0, transfer=None),
+    "PCO Dimax": dict(sensor=(2000, 2000), line_time=0.39e-6, memory=36 * 2**30,
+                      transfer=700e6),
+    "PCO 4000": dict(sensor=(4008, 2672), line_time=75e-6, memory=0, transfer=None),
+}
+
+
+class _Enum(object):
+    def __init__(self, *names):
+        for name in names:
+            setattr(self, name, name)
+
+
+class _Profile(object):
+    """
+    Motion of an axis as segments of constant acceleration
+    (start time, position, velocity, acceleration). Past segments are kept,
+    so that position at the moment of exposure can be asked for later.
+    """
+
+    def __init__(self, position=0.0):
+        self.segments = [(0.0, position, 0.0, 0.0)]
+        self.starts = [0.0]
+        self.end = 0.0
+        self.target = None
+        self._move = None
+
+    def state(self, t):
+        i = max(bisect.bisect_right(self.starts, t) - 1, 0)
+        ts, p, v, a = self.segments[i]
+        dt = t - ts
+        return p + v * dt + 0.5 * a * dt * dt, v + a * dt
+
+    def position(self, t):
+        if self.target is not None and t >= self.end:
+            return self.target
+        return self.state(t)[0]
+
+    def moving(self, t):
+        return t < self.end
+
+    def _add(self, t, accel):
+        p, v = self.state(t)
+        i = bisect.bisect_left(self.starts, t)
+        self.segments = self.segments[:i] + [(t, p, v, accel)]
+        self.starts = self.starts[:i] + [t]
+
+    def move(self, t, target, velocity, accel):
+        """Trapezoidal move from standstill, returns time of arrival"""
+        p = self.position(t)
+        self.target = None
+        distance = abs(target - p)
+        sign = 1.0 if target >= p else -1.0
+        peak = min(abs(velocity), np.sqrt(distance * accel))
+        if peak == 0:
+            self._add(t, 0.0)
+            self.end = t
+            self._move = None
+        else:
+            t_acc = peak / accel
+            t_cruise = (distance - peak * peak / accel) / peak
+            self._add(t, sign * accel)
+            self._add(t + t_acc, 0.0)
+            self._add(t + t_acc + t_cruise, -sign * accel)
+            self.end = t + 2 * t_acc + t_cruise
+            self._add(self.end, 0.0)
+            self._move = (t, accel, peak, t_acc, distance)
+        self.target = target
+        return self.end
+
+    def times_at(self, distances):
+        """Moments when the last move has travelled *distances*"""
+        distances = np.asarray(distances, dtype=np.float64)
+        if self._move is None:
+            return np.full(distances.shape, self.end)
+        t, accel, peak, t_acc, total = self._move
+        d_acc = 0.5 * accel * t_acc ** 2
+        accelerating = t + np.sqrt(2 * np.clip(distances, 0, d_acc) / accel)
+        cruising = t + t_acc + (distances - d_acc) / peak
+        braking = self.end - np.sqrt(2 * np.clip(total - distances, 0, None) / accel)
+        return np.where(distances <= d_acc, accelerating,
+                        np.where(distances <= total - d_acc, cruising, braking))
+
+    def rotate(self, t, velocity, accel):
+        p, v = self.state(t)
+        self.target = None
+        dv = velocity - v
+        self._add(t, np.sign(dv) * accel)
+        self._add(t + abs(dv) / accel, 0.0)
+        self.end = float('inf') if velocity != 0 else t + abs(dv) / accel
+
+    def stop(self, t, accel):
+        p, v = self.state(t)
+        self.target = None
+        self._add(t, -np.sign(v) * accel)
+        self.end = t + abs(v) / accel
+        self._add(self.end, 0.0)
+        return self.end
+
+
+class Phantom(object):
+    """
+    Parallel-beam projections of vertical cylinders in a container,
+    vertical beam profile, dark current and noise. Frames are separable
+    products of a beam row profile and a projection column profile,
+    noise is taken from a precomputed table, so rendering is a few
+    passes over the frame.
+    """
+
+    NOISE_ROWS = 64
+
+    def __init__(self, width, height, seed=1):
+        rng = np.random.RandomState(seed)
+        self.width, self.height = width, height
+        self.u = np.arange(width, dtype=np.float32) - width / 2.0 + 0.5
+        rows = np.arange(height, dtype=np.float32) - height / 2.0
+        self.beam = np.exp(-(rows / (0.8 * height)) ** 2).astype(np.float32)
+        # x, z, radius, attenuation per pixel
+        self.cylinders = [(0.0, 0.0, 0.35 * width, 0.002)]
+        for i in range(8):
+            r = rng.uniform(0.02, 0.08) * width
+            rho = rng.uniform(0, 0.3 * width - r)
+            phi = rng.uniform(0, 2 * np.pi)
+            self.cylinders.append((rho * np.cos(phi), rho * np.sin(phi), r,
+                                   rng.uniform(0.002, 0.01)))
+        self.dark_level = 100
+        noise = rng.normal(self.dark_level, 8, (height + self.NOISE_ROWS, width))
+        self.noise = np.clip(noise, 0, 2 * self.dark_level).astype(np.uint16)
+        self._rng = rng
+
+    def projection(self, angle):
+        """Transmission along detector columns at *angle* [deg]"""
+        theta = np.deg2rad(angle)
+        path = np.zeros_like(self.u)
+        for x, z, r, mu in self.cylinders:
+            c = x * np.cos(theta) + z * np.sin(theta)
+            chord = r * r - (self.u - c) ** 2
+            np.maximum(chord, 0, out=chord)
+            path += 2 * mu * np.sqrt(chord)
+        return np.exp(-path)
+
+    def render(self, roi, intensity, angle=None):
+        """Frame of *roi* (x0, y0, width, height) with flat level *intensity*,
+        angle None means sample out of the beam"""
+        x0, y0, w, h = roi
+        offset = self._rng.randint(self.NOISE_ROWS)
+        frame = self.noise[y0 + offset:y0 + offset + h, x0:x0 + w].copy()
+        if intensity > 0:
+            columns = np.full(w, intensity, dtype=np.float32)
+            if angle is not None:
+                columns *= self.projection(angle)[x0:x0 + w]
+            signal = np.multiply.outer(self.beam[y0:y0 + h], columns)
+            frame += signal.astype(np.uint16)
+        return frame
+
+
+def _bcd(value):
+    return (value // 10) * 16 + value % 10
+
+
+def write_time_stamp(frame, counter, t):
+    """PCO binary time stamp into first 14 pixels of *frame*"""
+    lt = time.localtime(t)
+    us = int((t % 1) * 1e6)
+    digits = [counter // 1000000 % 100, counter // 10000 % 100, counter // 100 % 100,
+              counter % 100, lt.tm_year // 100, lt.tm_year % 100, lt.tm_mon, lt.tm_mday,
+              lt.tm_hour, lt.tm_min, lt.tm_sec, us // 10000, us // 100 % 100, us % 100]
+    frame[0, :len(digits)] = [_bcd(d) for d in digits]
+
+
+class _SimUca(object):
+    """Parts of the libuca camera object which acquisitions use directly"""
+
+    enum_values = _Enum()
+    enum_values.storage_mode = _Enum('RECORDER', 'FIFO_BUFFER')
+    enum_values.record_mode = _Enum('SEQUENCE', 'RING_BUFFER')
+    enum_values.acquire_mode = _Enum('AUTO', 'EXTERNAL')
+    enum_values.timestamp_mode = _Enum('NONE', 'BINARY', 'ASCII', 'BOTH')
+
+    def __init__(self, camera):
+        self.camera = camera
+
+    def grab(self, pointer):
+        frame = self.camera._grab_real()
+        ctypes.memmove(pointer, frame.ctypes.data, frame.nbytes)
+        return True
+
+    def start_readout(self):
+        self.camera._start_readout()
+
+    def stop_readout(self):
+        self.camera._stop_readout()
+
+    def _unref(self):
+        pass
+
+
+class SimCamera(camera_base.Camera):
+
+    """
+    PCO camera stand-in. Frames are timed by exposure, line read-out
+    and frame rate; soft triggers and PSO pulses of a simulated stage start
+    exposures. Frames not grabbed in time are overwritten in the host buffer
+    (libuca buffer or a few frames without buffering), triggers arriving while
+    the sensor is busy are ignored. Dimax with storage mode RECORDER keeps
+    the frames in the camera memory until start_readout.
+    """
+
+    def __init__(self, model="PCO Edge", beamline=None):
+        super(SimCamera, self).__init__()
+        self.model = model
+        spec = CAMERA_MODELS[model]
+        self.beamline = beamline
+        self.uca = _SimUca(self)
+        self.line_time = spec['line_time']
+        self.memory = spec['memory']
+        self.transfer = spec['transfer']
+        width, height = spec['sensor']
+        self.sensor_width = width * q.pixel
+        self.sensor_height = height * q.pixel
+        self.roi_x0 = 0 * q.pixel
+        self.roi_y0 = 0 * q.pixel
+        self.roi_width = width * q.pixel
+        self.roi_height = height * q.pixel
+        self.exposure_time = 10 * q.msec
+        self.sensor_pixelrates = [95333333, 272250000]
+        self.sensor_pixelrate = self.sensor_pixelrates[-1]
+        self.buffered = False
+        self.num_buffers = 10
+        self.storage_mode = None
+        self.record_mode = None
+        self.acquire_mode = None
+        self.timestamp_mode = self.uca.enum_values.timestamp_mode.NONE
+        self.frame_grabber_ext_timeout = 5 * q.sec
+        # frames the host keeps without libuca buffering
+        self.fifo_frames = 4
+        # counts per ms of exposure in the open beam
+        self.flux = 2000.0
+        self.phantom = Phantom(width, height)
+        self._frame_rate = 100.0
+        self._trigger_source = self.trigger_sources.AUTO
+        self._cond = threading.Condition()
+        self._counter = 0
+        self._pending = []
+        self._records = []
+        self._readout = None
+        self.lost = 0
+
+    def _get_frame_rate(self):
+        return self._frame_rate / q.s
+
+    def _set_frame_rate(self, frame_rate):
+        self._frame_rate = frame_rate.to(1 / q.s).magnitude
+
+    def _get_trigger_source(self):
+        return self._trigger_source
+
+    def _set_trigger_source(self, source):
+        self._trigger_source = source
+
+    @property
+    def recorded_frames(self):
+        return len(self._records) * q.count
+
+    # timing
+    @property
+    def exposure(self):
+        return self.exposure_time.to(q.s).magnitude
+
+    @property
+    def readout_time(self):
+        return self.roi_height.magnitude * self.line_time
+
+    @property
+    def period(self):
+        """Shortest time between exposures with overlapping read-out"""
+        return max(1.0 / self._frame_rate, self.exposure, self.readout_time)
+
+    @property
+    def roi(self):
+        return (int(self.roi_x0.magnitude), int(self.roi_y0.magnitude),
+                int(self.roi_width.magnitude), int(self.roi_height.magnitude))
+
+    @property
+    def in_memory(self):
+        return self.memory > 0 and \
+            self.storage_mode == self.uca.enum_values.storage_mode.RECORDER
+
+    @property
+    def memory_frames(self):
+        return self.memory // (self.roi[2] * self.roi[3] * 2)
+
+    @property
+    def depth(self):
+        return int(self.num_buffers) if self.buffered else self.fifo_frames
+
+    def _record_real(self):
+        with self._cond:
+            self._t_start = time.time()
+            self._t_stop = None
+            self._busy = self._t_start
+            self._pending = []
+            self._records = []
+            self._next = 0
+            self._counter = 0
+            self.lost = 0
+
+    def _stop_real(self):
+        with self._cond:
+            self._t_stop = time.time()
+            if self.in_memory and self._trigger_source == self.trigger_sources.AUTO:
+                n = int((self._t_stop - self._t_start) / self.period)
+                starts = self._t_start + np.arange(n) * self.period
+                self._records = [(i + 1, t) for i, t in enumerate(starts)]
+            self._records = self._records[-self.memory_frames:] \
+                if self.record_mode == self.uca.enum_values.record_mode.RING_BUFFER \
+                else self._records[:self.memory_frames]
+            self._cond.notify_all()
+
+    def _expose(self, t):
+        """Exposure requested at *t*, ignored while sensor is busy"""
+        with self._cond:
+            if self.state != 'recording' or t < self._busy:
+                self.lost += 1
+                return
+            soft = self._trigger_source == self.trigger_sources.SOFTWARE
+            interval = self.exposure + self.readout_time if soft else self.period
+            self._busy = t + interval
+            self._counter += 1
+            if self.in_memory:
+                self._records.append((self._counter, t))
+            else:
+                self._pending.append((self._counter, t))
+            self._cond.notify_all()
+
+    def _trigger_real(self):
+        self._expose(time.time())
+
+    def external_trigger(self, t):
+        """PSO pulse of the stage"""
+        if self._trigger_source == self.trigger_sources.EXTERNAL:
+            self._expose(t)
+
+    def _start_readout(self):
+        with self._cond:
+            self._readout = 0
+            self._readout_time = time.time()
+
+    def _stop_readout(self):
+        with self._cond:
+            self._readout = None
+
+    def _next_frame(self):
+        """Counter and exposure start of the next frame to deliver, waits until
+        it is read out"""
+        deadline = time.time() + self.frame_grabber_ext_timeout.to(q.s).magnitude
+        ready_after = self.exposure + self.readout_time
+        with self._cond:
+            if self._readout is not None:
+                if self._readout >= len(self._records):
+                    raise CameraError('No more frames in camera memory')
+                record = self._records[self._readout]
+                self._readout += 1
+                self._readout_time += self.roi[2] * self.roi[3] * 2 / self.transfer
+                ready = self._readout_time
+            elif self._trigger_source == self.trigger_sources.AUTO:
+                if self.state != 'recording':
+                    raise CameraError('Camera is not recording')
+                now = time.time()
+                newest = int((now - self._t_start - ready_after) / self.period)
+                if newest - self._next >= self.depth:
+                    # overwritten in the host buffer
+                    self.lost += newest - self.depth + 1 - self._next
+                    self._next = newest - self.depth + 1
+                self._next += 1
+                record = (self._next, self._t_start + (self._next - 1) * self.period)
+                ready = record[1] + ready_after
+            else:
+                while not self._pending:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise CameraError('Timeout while waiting for trigger')
+                    self._cond.wait(remaining)
+                now = time.time()
+                while len(self._pending) > self.depth and \
+                        self._pending[self.depth][1] + ready_after <= now:
+                    self._pending.pop(0)
+                    self.lost += 1
+                record = self._pending.pop(0)
+                ready = record[1] + ready_after
+        delay = ready - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        return record
+
+    def _render(self, counter, t):
+        intensity = self.flux * self.exposure * 1000.0
+        angle = 0.0
+        if self.beamline is not None:
+            if not self.beamline.beam_on(t):
+                intensity = 0
+            if not self.beamline.sample_in_beam(t):
+                angle = None
+            else:
+                angle = self.beamline.angle_at(t + 0.5 * self.exposure)
+        frame = self.phantom.render(self.roi, min(intensity, 50000), angle)
+        if self.timestamp_mode == self.uca.enum_values.timestamp_mode.BINARY:
+            write_time_stamp(frame, counter, t)
+        return frame
+
+    def _grab_real(self):
+        counter, t = self._next_frame()
+        return self._render(counter, t)
+
+
+class SimShutter(shutter_base.Shutter):
+
+    """Fast imaging shutter stand-in which remembers when it was open"""
+
+    state = State(default='closed')
+
+    def __init__(self, transit_time=0.01):
+        super(SimShutter, self).__init__()
+        self.transit_time = transit_time
+        self._times = [0.0]
+        self._open_states = [False]
+        self.STATE = None
+
+    def _switch(self, value):
+        time.sleep(self.transit_time)
+        self._times.append(time.time())
+        self._open_states.append(value)
+
+    def _open(self):
+        self._switch(True)
+
+    def _close(self):
+        self._switch(False)
+
+    def is_open_at(self, t):
+        return self._open_states[bisect.bisect_right(self._times, t) - 1]
+
+
+class SimLinearStage(motor_base.LinearMotor):
+
+    """Linear stage (CLSLinear) stand-in with velocity and acceleration"""
+
+    state = State()
+
+    def __init__(self, name="SMTR-sim", velocity=5.0, accel=20.0):
+        super(SimLinearStage, self).__init__()
+        self.name = name
+        self.RBV = None
+        # mm/s, mm/s^2
+        self.max_velocity = velocity
+        self.accel = accel
+        self.base_vel = velocity * q.mm / q.sec
+        self.profile = _Profile()
+
+    def _get_state(self):
+        return 'moving' if self.profile.moving(time.time()) else 'standby'
+
+    def _get_position(self):
+        return self.profile.position(time.time()) * q.mm
+
+    def _set_position(self, position):
+        self.profile.move(time.time(), position.to(q.mm).magnitude,
+                          self.max_velocity, self.accel)
+        self._wait_until_stop()
+
+    def _wait_until_stop(self, poll=0.01):
+        while self.profile.moving(time.time()):
+            time.sleep(min(poll, max(self.profile.end - time.time(), 0)))
+
+    def _stop(self):
+        self.profile.stop(time.time(), self.accel)
+        self._wait_until_stop()
+
+    def _home(self):
+        self._set_position(0 * q.mm)
+
+    def position_at(self, t):
+        return self.profile.position(t)
+
+    def clear(self):
+        pass
+
+    def reset(self):
+        pass
+
+
+class SimRotationStage(motor_base.ContinuousRotationMotor):
+
+    """
+    Air-bearing rotation stage (ABRS) stand-in with step moves at
+    stepvelocity, continuous rotation at velocity and PSO pulse output
+    every stepangle over LENGTH. Pulses are sent to pso_listeners.
+    """
+
+    state = State()
+    stepvelocity = Quantity(q.deg / q.sec, help="Velocity of step moves and PSO scans")
+    stepangle = Quantity(q.deg, help="Angle between PSO pulses")
+
+    def __init__(self, name="ABRS-sim", accel=720.0):
+        super(SimRotationStage, self).__init__()
+        self.name = name
+        self.RBV = None
+        # deg/s^2
+        self.accel = accel
+        self.base_vel = 10.0 * q.deg / q.sec
+        self.LENGTH = 180 * q.deg
+        self.profile = _Profile()
+        self.pso_listeners = []
+        self._stepvelocity = 5.0
+        self._stepangle = 0.1
+        self._velocity = 0.0
+        self._pulses = None
+        self._abort_pulses = threading.Event()
+
+    def _get_state(self):
+        return 'moving' if self.profile.moving(time.time()) else 'standby'
+
+    def _get_position(self):
+        return self.profile.position(time.time()) * q.deg
+
+    def _set_position(self, position):
+        self.profile.move(time.time(), position.to(q.deg).magnitude,
+                          self._stepvelocity, self.accel)
+        self.wait_until_stop(timeout=0.01 * q.sec)
+
+    def _get_velocity(self):
+        return self._velocity * q.deg / q.sec
+
+    def _set_velocity(self, velocity):
+        self._velocity = velocity.to(q.deg / q.sec).magnitude
+        self.profile.rotate(time.time(), self._velocity, self.accel)
+
+    def _get_stepvelocity(self):
+        return self._stepvelocity * q.deg / q.sec
+
+    def _set_stepvelocity(self, velocity):
+        self._stepvelocity = velocity.to(q.deg / q.sec).magnitude
+
+    def _get_stepangle(self):
+        return self._stepangle * q.deg
+
+    def _set_stepangle(self, angle):
+        self._stepangle = angle.to(q.deg).magnitude
+
+    def _stop(self):
+        self._abort_pulses.set()
+        self._velocity = 0.0
+        self.profile.stop(time.time(), self.accel)
+        self.wait_until_stop(timeout=0.01 * q.sec)
+
+    def _home(self):
+        self._set_position(0 * q.deg)
+
+    def wait_until_stop(self, timeout=0.1 * q.sec):
+        poll = timeout.to(q.sec).magnitude
+        while self.profile.moving(time.time()):
+            time.sleep(min(poll, max(self.profile.end - time.time(), 0.001)))
+
+    def angle_at(self, t):
+        return self.profile.position(t)
+
+    def calc_vel(self, nsteps, period, angle_range):
+        """Velocity which makes one step per *period* [ms]"""
+        return angle_range / (nsteps * period / 1000.0) * q.deg / q.sec
+
+    def _send_pulses(self, times):
+        self._abort_pulses.clear()
+        for t in times:
+            delay = t - time.time()
+            if delay > 0 and self._abort_pulses.wait(delay):
+                break
+            for listener in self.pso_listeners:
+                listener(t)
+
+    def PSO_multi(self, wait=False):
+        """Rotate by LENGTH at stepvelocity, pulse every stepangle"""
+        t0 = time.time()
+        length = self.LENGTH.to(q.deg).magnitude
+        start = self.profile.position(t0)
+        self.profile.move(t0, start + length, self._stepvelocity, self.accel)
+        n = int(round(abs(length) / self._stepangle))
+        times = self.profile.times_at(np.arange(n) * self._stepangle)
+        self._pulses = threading.Thread(target=self._send_pulses, args=(times,))
+        self._pulses.daemon = True
+        self._pulses.start()
+        if wait:
+            self._pulses.join()
+
+    @async
+    def PSO_ttl(self, num, period):
+        """*num* pulses every *period* [ms] without motion"""
+        t0 = time.time()
+        self._send_pulses([t0 + i * period / 1000.0 for i in range(int(num))])
+
+    def clear(self):
+        pass
+
+    def reset(self):
+        pass
+
+
+class SimBeamline(object):
+
+    """
+    Simulation profile: camera, CT stage, sample stages and shutter which
+    know about each other. The camera sees the beam only when the shutter
+    is open and the phantom only when the horizontal stage holds the sample
+    at sample_position, rotated by the CT stage at the time of exposure.
+    """
+
+    def __init__(self, camera_model="PCO Edge"):
+        self.shutter = SimShutter()
+        self.ct_stage = SimRotationStage()
+        self.hor_motor = SimLinearStage("SMTR-sim-hor")
+        self.vert_motor = SimLinearStage("SMTR-sim-vert")
+        # sample is in the beam within sample_size of sample_position [mm]
+        self.sample_position = 0.0
+        self.sample_size = 1.0
+        self.camera = SimCamera(camera_model, beamline=self)
+        self.ct_stage.pso_listeners.append(self.camera.external_trigger)
+
+    @property
+    def motors(self):
+        """Motors under the names the GUI uses"""
+        return {"CT stage [deg]": self.ct_stage,
+                "Horizontal [mm]": self.hor_motor,
+                "Vertical [mm]": self.vert_motor}
+
+    def beam_on(self, t):
+        return self.shutter.is_open_at(t)
+
+    def sample_in_beam(self, t):
+        offset = self.hor_motor.position_at(t) - self.sample_position
+        return abs(offset) < self.sample_size
+
+    def angle_at(self, t):
+        return self.ct_stage.angle_at(t)
+
+    def setup(self, concert_scan, flat_position=10.0):
+        """Plug simulated devices into ConcertScanThread the way the GUI does"""
+        concert_scan.ffc_setup.shutter = self.shutter
+        concert_scan.ffc_setup.flat_motor = self.hor_motor
+        concert_scan.ffc_setup.radio_position = self.sample_position * q.mm
+        concert_scan.ffc_setup.flat_position = flat_position * q.mm
+        concert_scan.acq_setup.motor = self.ct_stage
+        concert_scan.acq_setup.units = q.deg
@@ -0,0 +1,133 @@
+"""Frames striped across several root directories (one per disk)"""
+
+import os
+import threading
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+from concert.coroutines.base import coroutine
+from concert.storage import Walker, StorageError, write_tiff
+from frame_pool import hold, release
+
+
+class StripedWalker(Walker):
+    """
+    Walker which distributes frames round-robin over several *roots*,
+    each root has its own writer thread so that the disks are written in
+    parallel. The directory tree is the same below every root. Every
+    acquisition directory of the first root gets a file *index_name*
+    with lines "<frame number> <path of the frame>".
+    Every thread buffers at most *max_bytes* of frames, if a disk falls
+    behind the acquisition waits for it.
+    """
+
+    def __init__(self, roots, dsetname='frame_{:>06}.tif', index_name='index.txt',
+                 max_bytes=2**30):
+        if len(roots) < 1:
+            raise StorageError("No root directory given")
+        for root in roots:
+            if not os.access(root, os.W_OK):
+                raise StorageError("Cannot write into {}".format(root))
+        super(StripedWalker, self).__init__(roots[0], dsetname=dsetname)
+        self.log = None
+        self.roots = list(roots)
+        self._path = []
+        self.dsetname = dsetname
+        self.index_name = index_name
+        self.max_bytes = max_bytes
+        self.queues = None
+        self.threads = []
+        self.error = None
+        self._indices = []
+
+    @property
+    def current(self):
+        return os.path.join(self.roots[0], *self._path)
+
+    def home(self):
+        self._path = []
+
+    def descend(self, name):
+        self._path.append(name)
+        for root in self.roots:
+            path = os.path.join(root, *self._path)
+            if not os.path.exists(path):
+                os.makedirs(path)
+        return self
+
+    def ascend(self):
+        if self._path:
+            self._path.pop()
+        return self
+
+    def exists(self, *paths):
+        return any(os.path.exists(os.path.join(root, *(self._path + list(paths))))
+                   for root in self.roots)
+
+    def _start(self, frame):
+        size = max(2, self.max_bytes // frame.nbytes)
+        self.queues = [Queue(maxsize=size) for root in self.roots]
+        for queue in self.queues:
+            thread = threading.Thread(target=self._write_files, args=(queue,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _write_files(self, queue):
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            fname, frame = item
+            if self.error is not None:
+                # keep draining so that the acquisition does not block forever
+                release(frame)
+                continue
+            try:
+                write_tiff(fname, frame)
+            except Exception as exp:
+                if self.log is not None:
+                    self.log.error(exp)
+                    self.log.error("Striped writer failed, frames are being dropped")
+                self.error = exp
+            finally:
+                release(frame)
+
+    def write(self, data=None, dsetname=None):
+        coro = self._write_coroutine(list(self._path), dsetname or self.dsetname)
+        if data is None:
+            return coro
+        for frame in data:
+            coro.send(frame)
+
+    @coroutine
+    def _write_coroutine(self, path, dsetname):
+        index = open(os.path.join(self.roots[0], *(path + [self.index_name])), 'w')
+        self._indices.append(index)
+        i = 0
+        while True:
+            frame = yield
+            if self.error is not None:
+                raise self.error
+            if self.queues is None:
+                self._start(frame)
+            stripe = i % len(self.roots)
+            fname = os.path.join(self.roots[stripe], *(path + [dsetname.format(i)]))
+            # pooled frames must not be overwritten before they are written
+            self.queues[stripe].put((fname, hold(frame)))
+            index.write("{} {}\n".format(i, fname))
+            i += 1
+
+    def close(self):
+        """Wait until all frames are written and close the index files"""
+        if self.queues is not None:
+            for queue in self.queues:
+                queue.put(None)
+            for thread in self.threads:
+                thread.join()
+            self.threads = []
+            self.queues = None
+        for index in self._indices:
+            index.close()
+        self._indices = []
@@ -0,0 +1,91 @@
+"""Per-frame timing of acquisition phases"""
+
+import os
+import time
+import numpy as np
+
+
+class FrameTimer(object):
+    """
+    Records how long every phase of every frame took in preallocated arrays.
+    Phases are measured as laps: lap(phase) stores the time since the previous
+    lap, done() closes the frame with the time consumers kept the frame
+    (everything between yield and the return of control to the generator).
+    """
+
+    PHASES = ('move', 'trigger', 'grab', 'consume')
+
+    def __init__(self, name, nframes):
+        self.name = name
+        nframes = max(int(nframes), 1)
+        self.columns = dict((p, i) for i, p in enumerate(self.PHASES))
+        self.durations = np.full((nframes, len(self.PHASES)), np.nan)
+        # moments when frames became available
+        self.stamps = np.full(nframes, np.nan)
+        self.count = 0
+        self.t0 = time.time()
+        self.last = self.t0
+
+    def _grow(self):
+        n = len(self.stamps)
+        durations = np.full((2 * n, len(self.PHASES)), np.nan)
+        durations[:n] = self.durations
+        stamps = np.full(2 * n, np.nan)
+        stamps[:n] = self.stamps
+        self.durations, self.stamps = durations, stamps
+
+    def start(self):
+        self.last = time.time()
+
+    def lap(self, phase):
+        now = time.time()
+        if self.count >= len(self.stamps):
+            self._grow()
+        self.durations[self.count, self.columns[phase]] = now - self.last
+        if phase == 'grab':
+            self.stamps[self.count] = now
+        self.last = now
+
+    def done(self):
+        self.lap('consume')
+        self.count += 1
+
+    def summary(self, fps=None):
+        """Lines with mean, p50 and p99 of every measured phase in ms
+        and effective frame rate"""
+        lines = ["Timing of {} ({} frames):".format(self.name, self.count)]
+        for phase in self.PHASES:
+            col = self.durations[:self.count, self.columns[phase]]
+            col = col[~np.isnan(col)] * 1000.0
+            if col.size == 0:
+                continue
+            lines.append(
+                "  {:<8} mean {:8.2f} ms, p50 {:8.2f} ms, p99 {:8.2f} ms".format(
+                    phase, col.mean(), np.percentile(col, 50), np.percentile(col, 99)))
+        effective = self.effective_fps()
+        if effective is not None:
+            line = "  effective fps {:.2f}".format(effective)
+            if fps:
+                line += ", requested fps {:.2f}".format(fps)
+            lines.append(line)
+        return lines
+
+    def effective_fps(self):
+        stamps = self.stamps[:self.count]
+        stamps = stamps[~np.isnan(stamps)]
+        if stamps.size > 1 and stamps[-1] > stamps[0]:
+            return (stamps.size - 1) / (stamps[-1] - stamps[0])
+        return None
+
+    def save(self, directory, fps=None):
+        """Dump timing profile into timing_<name>.npz in *directory*"""
+        fname = os.path.join(directory, "timing_{}.npz".format(self.name))
+        i = 1
+        while os.path.exists(fname):
+            fname = os.path.join(directory, "timing_{}_{}.npz".format(self.name, i))
+            i += 1
+        np.savez(fname, phases=np.array(self.PHASES),
+                 durations=self.durations[:self.count],
+                 stamps=self.stamps[:self.count] - self.t0,
+                 requested_fps=np.nan if fps is None else fps)
+        return fname
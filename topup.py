@@ -0,0 +1,103 @@
+"""Scheduling of acquisitions between top-up injections"""
+
+import threading
+import time
+
+
+class TopUpScheduler(object):
+    """
+    Predicts the next top-up injection from the injection countdown PV and
+    holds off blocks of acquisition which would not be over before the veto
+    goes on, i.e. pre-injection lead time before the injection. Values are
+    fed by the GUI from the ring status monitors.
+    """
+
+    def __init__(self):
+        self.log = None
+        self.enabled = False
+        # extra time kept free before the injection [s]
+        self.margin = 0.5
+        # how long the beam is disturbed after the veto is cleared [s]
+        self.settle_time = 0.5
+        # time between injections, measured
+        self.period = None
+        self.next_injection = None
+        # veto goes on this long before the injection [s]
+        self.lead = 0.0
+        self.veto = False
+        self.last_injection = None
+        self.cancelled = False
+        self.condition = threading.Condition()
+
+    def update_countdown(self, value):
+        # seconds until the next injection
+        with self.condition:
+            if value is None or value <= 0:
+                return
+            self.next_injection = time.time() + value
+            self.condition.notify_all()
+
+    def update_lead(self, value):
+        with self.condition:
+            if value is None or value < 0:
+                return
+            self.lead = value
+            self.condition.notify_all()
+
+    def update_veto(self, value):
+        with self.condition:
+            now = time.time()
+            if self.veto and not value:
+                # injection is over
+                if self.last_injection is not None:
+                    self.period = now - self.last_injection
+                self.last_injection = now
+                self.next_injection = None
+            self.veto = bool(value)
+            self.condition.notify_all()
+
+    def time_to_injection(self):
+        if self.next_injection is None:
+            return None
+        return self.next_injection - time.time()
+
+    def cancel(self):
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify_all()
+
+    def reset(self):
+        """Forget cancel() of an earlier scan, to be called when a scan starts"""
+        with self.condition:
+            self.cancelled = False
+
+    def fits(self, duration):
+        """True if *duration* seconds of acquisition end before the next injection"""
+        if self.veto:
+            return False
+        if self.last_injection is not None and \
+                time.time() - self.last_injection < self.settle_time:
+            return False
+        t = self.time_to_injection()
+        return t is None or t < 0 or duration + self.margin + self.lead <= t
+
+    def wait_for_window(self, duration, what="block"):
+        """Block until *duration* seconds of acquisition fit before the next
+        injection"""
+        if not self.enabled:
+            return
+        with self.condition:
+            needed = duration + self.margin + self.lead
+            if self.period is not None and needed > self.period:
+                if self.log is not None:
+                    self.log.warning("{} takes {:.1f} s, longer than top-up period "
+                                     "{:.1f} s, not waiting for injection".format(
+                                         what, duration, self.period))
+                return
+            t0 = time.time()
+            while not self.cancelled and not self.fits(duration):
+                self.condition.wait(0.1)
+            waited = time.time() - t0
+        if waited > 0.1 and self.log is not None:
+            self.log.info("Waited {:.1f} s for top-up injection before {}".format(
+                waited, what))
@@ -0,0 +1,140 @@
+"""
+Benchmark of the frame writers of the Dimax read-out and live-view
+streaming paths. Frames are produced as fast as the writer accepts them;
+besides throughput the longest blocking of the producer (the grab thread
+in real use) and the peak of dirty page cache are reported, which is
+where TiffWriter through the page cache and DirectRawWriter differ.
+
+    python writer_benchmark.py --dir /data/test --roi 2560x2160 --frames 5000
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+from concert.writers import TiffWriter
+from direct_writer import DirectRawWriter
+from queued_writer import QueuedTiffWriter
+
+
+def dirty_bytes():
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('Dirty:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+class DirtyProbe(threading.Thread):
+    """Samples Dirty of /proc/meminfo and keeps the peak"""
+
+    def __init__(self, period=0.1):
+        super(DirtyProbe, self).__init__()
+        self.daemon = True
+        self.period = period
+        self.peak = 0
+        self.running = True
+
+    def run(self):
+        while self.running:
+            self.peak = max(self.peak, dirty_bytes())
+            time.sleep(self.period)
+
+
+class TiffWriterAdapter(object):
+    """Synchronous TiffWriter with the put/close interface of the other writers"""
+
+    def __init__(self, filename, bytes_per_file):
+        self.writer = TiffWriter(filename, bytes_per_file=bytes_per_file)
+
+    def put(self, frame):
+        self.writer.write(frame)
+
+    def close(self):
+        self.writer.close()
+
+
+def make_writer(name, directory):
+    if name == "tiff":
+        return TiffWriterAdapter(os.path.join(directory, "frames.tif"), 2**37)
+    if name == "queued-tiff":
+        return QueuedTiffWriter(os.path.join(directory, "frames.tif"),
+                                bytes_per_file=2**37)
+    if name == "queued-tiff-files":
+        return QueuedTiffWriter(os.path.join(directory, "frame-{:>06}.tif"))
+    if name == "direct":
+        return DirectRawWriter(os.path.join(directory, "frames.raw"))
+    raise ValueError("Unknown writer {}".format(name))
+
+
+WRITERS = ["tiff", "queued-tiff", "queued-tiff-files", "direct"]
+
+
+def run_writer(name, args):
+    width, height = [int(i) for i in args.roi.split("x")]
+    # a few different frames so that nothing can be deduplicated
+    frames = [np.random.randint(0, 2**16, (height, width)).astype(np.uint16)
+              for i in range(8)]
+    directory = tempfile.mkdtemp(prefix="ezconcert-writer-", dir=args.dir)
+    probe = DirtyProbe()
+    probe.start()
+    try:
+        writer = make_writer(name, directory)
+        stalls = np.zeros(args.frames)
+        t0 = time.time()
+        for i in range(args.frames):
+            t = time.time()
+            writer.put(frames[i % len(frames)])
+            stalls[i] = time.time() - t
+        t_put = time.time() - t0
+        writer.close()
+        # data are on disk only after sync, page cache must not hide the disk
+        os.system("sync")
+        duration = time.time() - t0
+    finally:
+        probe.running = False
+        probe.join()
+        shutil.rmtree(directory, ignore_errors=True)
+    nbytes = args.frames * frames[0].nbytes
+    return {"writer": name, "roi": [width, height], "frames": args.frames,
+            "MBps_accepted": nbytes / t_put / 2**20,
+            "MBps_on_disk": nbytes / duration / 2**20,
+            "put_ms": {"p50": float(np.percentile(stalls, 50) * 1000),
+                       "p99": float(np.percentile(stalls, 99) * 1000),
+                       "max": float(stalls.max() * 1000)},
+            "dirty_peak_MB": probe.peak / 2.0**20}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("writers", nargs="*", default=WRITERS,
+                        help="writers to run: {}".format(", ".join(WRITERS)))
+    parser.add_argument("--roi", default="2560x2160", help="WIDTHxHEIGHT")
+    parser.add_argument("--frames", type=int, default=2000)
+    parser.add_argument("--dir", default=None, help="where to write the data")
+    parser.add_argument("-o", "--output", help="JSON file with results of all writers")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    results = []
+    for name in args.writers:
+        if name not in WRITERS:
+            sys.exit("Unknown writer {}".format(name))
+        res = run_writer(name, args)
+        results.append(res)
+        print(json.dumps(res))
+        sys.stdout.flush()
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()